@@ -39,4 +39,8 @@ class Config(metaclass=Singleton):
 
     @property
     def krest(self):
-        return self.config_object.krest
\ No newline at end of file
+        return self.config_object.krest
+
+    @property
+    def export(self):
+        return self.config_object.export
@@ -1,9 +1,12 @@
 import subprocess
+import threading
 import os
 import tomllib
 from sqlmodel import Session, create_engine, select
 import logging
-from datetime import datetime
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 from pprint import pprint
 
 from config import Config
@@ -15,14 +18,21 @@ from module.Dataclasses.conquest_dataclass import (
 	DICOMPatients,
 	DICOMSeries
 )
+from module.Dataclasses.plan_set_dataclass import PlanSet
 
 from module.Interfaces import (
 	aria_db_interface,
 	aria_dicom_interface,
 	conquest_db_interface,
 	conquest_dicom_interface,
-	export_logger_interface
+	export_logger_interface,
+	checkpoint_interface,
+	krest_dicom_interface,
+	inventory_interface,
 )
+from module.utils import association_pool, retry, peer_health, transfer_scheduler
+from module.utils.transfer_planner import AriaInventory, TransferPlanner
+from module.utils.storage_scp import StorageSCP
 
 logging.basicConfig(
 	filename="D:/Brokers/export.log", 
@@ -33,7 +43,55 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+parser = argparse.ArgumentParser(description="Export of proton RT data from ARIA to KREST")
+parser.add_argument("-w", "--workers", type=int, default=config.export.workers,
+	help=f"Number of patients exported in parallel (default {config.export.workers})")
+parser.add_argument("--import-json-log", nargs="?", const=config.log_db.file, metavar="PATH",
+	help=f"Import the JSON export log of earlier versions (default {config.log_db.file}) and exit")
+parser.add_argument("--full-rescan", action="store_true",
+	help=f"Query all treatment records since {config.export.start_date} instead of since the last run")
+parser.add_argument("--dry-run", action="store_true",
+	help="Print the planned C-MOVE requests against ARIA without moving anything")
+parser.add_argument("--health", nargs="?", type=int, const=3, metavar="ROUNDS",
+	help="C-ECHO / SELECT 1 all configured peers ROUNDS times (default 3), print the latencies and exit")
+args = parser.parse_args()
+
+if args.health is not None:
+	health_monitor = peer_health.HealthMonitor()
+	for _ in range(args.health):
+		health_monitor.check_all()
+	print(health_monitor.report())
+	raise SystemExit(1 if health_monitor.failing() else 0)
+
 log_database = export_logger_interface.LogDatabase()
+checkpoints = checkpoint_interface.CheckpointJournal()
+
+if args.import_json_log:
+	log_database.import_json_log(args.import_json_log)
+	raise SystemExit
+
+# A run is not started against a peer it needs that does not answer. During the run the peers
+# are checked again every health_interval seconds, and transfer_scheduler holds back
+# the transfers to a peer that is down and throttles those to a degraded peer
+health_monitor = peer_health.HealthMonitor()
+health_monitor.check_all()
+print(health_monitor.report())
+logger.info(f"Peer health at startup:\n{health_monitor.report()}")
+
+# Only the peers this run talks to must answer, e.g. KREST itself is not contacted
+# when conquest_krest moves the patients to it
+required_peers = peer_health.required_peers()
+unused_failing = {check.peer for check in health_monitor.failing()} - required_peers
+if unused_failing:
+	logger.warning(f"No answer from {', '.join(sorted(unused_failing))}, not used by this run")
+
+if health_monitor.failing(required_peers):
+	print(f"Not starting, no answer from {', '.join(sorted({check.peer for check in health_monitor.failing(required_peers)}))}")
+	raise SystemExit(1)
+
+if health_monitor.interval:
+	transfer_scheduler.set_health_monitor(health_monitor)
+	health_monitor.start()
 
 # FIND RT PLAN, RT DOSE FROM SQL
 # BUILD COMPLETE STUDY TREE
@@ -46,118 +104,436 @@ log_database = export_logger_interface.LogDatabase()
 # SEND TO MEDFYSHUS6666-2
 # SEND TO KREST-HUS
 
-dt = datetime(2025, 1, 1)
-plan_set = aria_db_interface.get_plan_set(dt)
+# Only the treatment records since the last completed run are queried, with an overlap
+# window for records that were written to ARIA after that run started
+run_start_dt = datetime.now()
+watermark = log_database.get_watermark()
 
-print(f"Found {len(plan_set)} patients since {dt.isoformat()}")
+if args.full_rescan or not watermark:
+	dt = datetime.combine(config.export.start_date, datetime.min.time())
+else:
+	dt = watermark - timedelta(days=config.export.watermark_overlap_days)
 
 """
-plan_set = 
-PatientSer { 
-	"PatientID",
-	"PlanSet" : {
-		RT Plan SOP UID : {
-			"RTPLAN": RT Plan SOP UID,
-			"RTPlanLabel", 
-			"RTDOSE": RT Dose SOP UID,
-			"RTSTRUCT": RT Struct SOP UID,
-			"RTRECORD": [ RT Treatment Record SOP UIDs ],
-			"CT": Plan CT Series Instance UID,
-		}
+plan_set = PlanSet
+PatientSer: PatientPlanSet(
+	patient_id,
+	plans = {
+		RT Plan SOP UID : PlanNode(
+			plan_uid: RT Plan SOP UID,
+			label: RTPlanLabel,
+			rtdose: { RT Dose SOP UIDs },
+			rtstruct: { RT Struct SOP UIDs },
+			rtrecord: { RT Treatment Record SOP UIDs },
+			ct: { Plan CT Series Instance UIDs },
+		)
 	}
-}
+)
 
+See module/Dataclasses/plan_set_dataclass.py
 """
 
-conquest_aria_engine = create_engine(config.conquest_aria.sql.uri)
-conquest_krest_engine = create_engine(config.conquest_krest.sql.uri)
+# Each worker holds at most one connection at a time, so the pool must be
+# at least as large as the number of workers
+conquest_aria_engine = create_engine(config.conquest_aria.sql.uri, pool_size=max(5, args.workers))
+conquest_krest_engine = create_engine(config.conquest_krest.sql.uri, pool_size=max(5, args.workers))
+
+# What Medfys-2 holds, refreshed from the changes since the last run
+krest_inventory = inventory_interface.SqlInventory("conquest_krest", conquest_krest_engine)
+krest_inventory.refresh(full=args.full_rescan)
+
+# KREST has no SQL access. With C-STORE forwarding its CT series are looked up per patient
+# with C-FIND, so a series that KREST already holds in full is not sent again
+krest_hus_inventory = None
+if config.krest.forward_mode == "store" and config.krest.dicom.server:
+	krest_hus_inventory = inventory_interface.CFindInventory("krest", "krest")
+	krest_hus_inventory.load()
+
+# With the storage SCP enabled, ARIA moves the objects to the exporter itself,
+# and they are looked up in its arrival index before conquest_aria
+storage_scp = StorageSCP() if config.export.scp.enabled and not args.dry_run else None
+arrivals = storage_scp.index if storage_scp else None
+aria_move_aet = config.export.scp.aet if storage_scp else config.conquest_aria.dicom.aet
+
+if storage_scp:
+	storage_scp.start()
+
+def existing_sops(uids) -> set:
+	"""The SOP Instance UIDs already received from ARIA"""
+	existing = arrivals.existing_sops(uids) if arrivals else set()
+	return existing | conquest_db_interface.get_existing_sops(conquest_aria_engine, set(uids) - existing)
+
+def existing_series(uids) -> set:
+	"""The Series Instance UIDs already received from ARIA"""
+	existing = arrivals.existing_series(uids) if arrivals else set()
+	return existing | conquest_db_interface.get_existing_series(conquest_aria_engine, set(uids) - existing)
+
+def existing_series_sops(series_uid) -> set:
+	"""The SOP Instance UIDs of the series already received from ARIA"""
+	sop_uids = set(arrivals.series_files([series_uid])) if arrivals else set()
+	return sop_uids | set(conquest_db_interface.get_series_object_files(conquest_aria_engine, [series_uid]).get(series_uid, ()))
+
+def existing_series_counts(uids) -> dict:
+	"""Instances received from ARIA per CT series, 0 for the series not received"""
+	uids = set(uids)
+	counts = conquest_db_interface.get_series_instance_counts(conquest_aria_engine, uids)
+
+	if arrivals:
+		for series_uid, n_arrived in arrivals.series_counts(uids).items():
+			# Received both by conquest_aria and by the SCP, so the instances are counted once
+			counts[series_uid] = len(existing_series_sops(series_uid)) if counts.get(series_uid) else n_arrived
+
+	return {uid: counts.get(uid, 0) for uid in uids}
+
+def find_missing_ct_instances(patient_ser, series_counts: dict) -> tuple:
+	"""Compares the received instances per CT series to ARIA. Returns ({Series Instance UID:
+	instances in ARIA}, SOP Instance UIDs missing from the partially received series,
+	AriaInventory of the missing instances for the transfer planner).
+	A series that already has its logged files_nb is not queried again."""
+
+	files_nb = {uid: n for uid, n in log_database.get_ct_files_nb(series_counts).items() if series_counts[uid] >= n}
+	unverified = [uid for uid, n in series_counts.items() if n and uid not in files_nb]
+	if not unverified:
+		return files_nb, set(), None
+
+	def find():
+		with association_pool.association("aria") as assoc:
+			aria_counts = aria_dicom_interface.find_series_instance_counts(assoc, unverified,
+				multi_uid=config.aria.dicom.multi_uid_move, max_uids=config.aria.dicom.max_uids_per_move)
+			incomplete = [uid for uid in unverified if series_counts[uid] < aria_counts[uid]]
+			return aria_counts, {uid: aria_dicom_interface.find_series_instances(assoc, uid) for uid in incomplete}
+
+	aria_counts, aria_instances = retry.retry_call(find, description=f"C-FIND of the CT series of patient {patient_ser} in ARIA")
+	files_nb.update(aria_counts)
+
+	# The series of every missing instance is known from the C-FIND above, so the
+	# planner does not need to look the instances up in ARIA one by one
+	inventory = AriaInventory(series_counts=dict(aria_counts))
+	for series_uid, sop_uids in aria_instances.items():
+		series_missing = sop_uids - existing_series_sops(series_uid)
+		print(f"- CT series {series_uid} has {series_counts[series_uid]} of {aria_counts[series_uid]} instances, {len(series_missing)} missing")
+		inventory.sop_locations.update(dict.fromkeys(series_missing, (None, series_uid)))
+
+	return files_nb, set(inventory.sop_locations), inventory
+
+def confirm_krest_series(patient_ser, patient, stored, files_nb: dict) -> None:
+	"""Confirms at the krest stage the stored CT series that KREST holds with all their
+	instances (files_nb), as found by C-FIND"""
+
+	series_uids = checkpoints.missing("krest", stored & patient.ct_series_uids) & files_nb.keys()
+	if not series_uids or not patient.patient_id:
+		return
+
+	retry.retry_call(lambda: krest_hus_inventory.refresh([patient.patient_id]),
+		description=f"C-FIND of patient {patient_ser} in {config.krest.name}")
+
+	complete = {uid for uid in series_uids if (krest_hus_inventory.series_count(uid) or 0) >= files_nb[uid]}
+	if complete:
+		print(f"- {len(complete)} CT series of patient {patient_ser} already in {config.krest.name}")
+		checkpoints.confirm(patient_ser, "krest", complete)
+
+def find_patient_id(patient):
+	for plan_sop_uid in patient.plans:
+		arrival = arrivals.arrivals.get(plan_sop_uid) if arrivals else None
+		if arrival and arrival.patient_id:
+			return arrival.patient_id
+
+		patient_id = conquest_db_interface.get_patient_id_from_plan_sop_uid(conquest_aria_engine, plan_sop_uid)
+		if patient_id:
+			return patient_id
+
+	return None
+
+planner = TransferPlanner(
+	multi_uid=config.aria.dicom.multi_uid_move,
+	max_uids_per_request=config.aria.dicom.max_uids_per_move,
+	series_threshold=config.export.series_move_threshold,
+	study_threshold=config.export.study_move_threshold,
+)
+
+def journal(patient_ser, source: str, destination: str):
+	"""on_result callback that writes every C-MOVE attempt to the transfer journal"""
+
+	def on_result(result):
+		request = result.request
+		log_database.add_transfer(patient_ser, request.uids, request.level, source, destination,
+			result.attempt, result.journal_status, result.error)
+
+	return on_result
+
+def find_aria_inventory(missing_sops, missing_series):
+	with association_pool.association("aria") as assoc:
+		return aria_dicom_interface.find_inventory(assoc, missing_sops, missing_series,
+			multi_uid=config.aria.dicom.multi_uid_move, max_uids=config.aria.dicom.max_uids_per_move)
+
+def move_from_aria(patient_ser, missing_sops=(), missing_series=(), inventory=None):
+	"""Moves the missing SOP Instances / CT Series of a patient from ARIA to conquest_aria (or the storage SCP),
+	coalesced into as few C-MOVE requests as the ARIA inventory allows (C-FIND, unless the
+	inventory is given). Returns the MoveResults.
+	Every attempt is journaled, and a request is confirmed when the objects it covers are found.
+	Raises RuntimeError if requests still fail after export.retry_attempts."""
+
+	# A single object is always a single request, so the C-FIND is only worth it for more
+	if inventory is None and config.export.plan_transfers and len(missing_sops) + len(missing_series) > 1:
+		inventory = retry.retry_call(lambda: find_aria_inventory(missing_sops, missing_series),
+			description=f"C-FIND of patient {patient_ser} in ARIA")
 
-transmitted = conquest_db_interface.get_patient_ids(conquest_krest_engine)
+	transfer_plan = planner.plan(patient_ser, missing_sops, missing_series, inventory)
+	logger.info(transfer_plan.report())
+
+	if args.dry_run:
+		print(transfer_plan.report())
+		return list()
+
+	for request in transfer_plan.requests:
+		print(f"- Moving {request}")
+
+	# The requests run concurrently on the pooled ARIA associations
+	results = aria_dicom_interface.c_move_requests(transfer_plan.requests, progress=logger.info,
+		move_aet=aria_move_aet, on_result=journal(patient_ser, "aria", aria_move_aet))
+
+	for result in results:
+		print(f"  {result}")
+		if not result.succeeded:
+			logger.warning(f"C-MOVE from ARIA did not succeed: {result}")
+
+	# A successful C-MOVE is only confirmed once the objects are found at the destination
+	found = existing_sops(missing_sops) | existing_series(missing_series)
+	confirmed = [request for request in transfer_plan.requests if request.covers <= found]
+	log_database.confirm_transfers(patient_ser, {uid for request in confirmed for uid in request.uids})
+
+	failed = [result for result in results if result.retryable]
+	if failed:
+		raise RuntimeError(f"{len(failed)} C-MOVEs from ARIA failed after {failed[0].attempt} attempts")
+
+	return results
+
+def process_patient(patient_ser, patient):
+	"""Exports a single patient: ARIA -> Conquest (Medfys-1) -> Conquest (Medfys-2) -> KREST.
+	Runs in a worker thread. All DICOM associations and SQL sessions are opened
+	inside this function, so no network state is shared between the workers."""
 
-for patient_ser in plan_set:
 	print("Working on patient", patient_ser)
 	sent_dt = log_database.check_patient(patient_ser)
 
 	if sent_dt:
-		print(f"- Patient was transmitted to {config.krest.name} at {sent_dt}")
-		# continue
+		print(f"- Patient {patient_ser} was transmitted to {config.krest.name} at {sent_dt}")
+		# return
 
-	for plan_sop_uid in plan_set[patient_ser]["PlanSet"]:
-		patient_id = conquest_db_interface.get_patient_id_from_plan_sop_uid(conquest_aria_engine, plan_sop_uid)
-		if patient_id:
-			break
+	patient_id = find_patient_id(patient)
+	patient.patient_id = patient_id
 
-	if patient_id and patient_id in transmitted:
+	if patient_id and patient_id in krest_inventory:
 		# print(f"Found patient in {config.conquest_aria.dicom.aet} database")
-		# continue
+		# return
 		pass
 
-	for plan_sop_uid in plan_set[patient_ser]["PlanSet"]:
-		# Move the treated RT Plans to Conquest
-
-		# Check if any of the RT PLAN or RT DOSE files are missing
-		uids = [plan_sop_uid]
-		for dose_uid in list(plan_set[patient_ser]["PlanSet"][plan_sop_uid]["RTDOSE"]):
-			uids.append(dose_uid)
-
-		uids_exist = { uid: conquest_db_interface.check_exists_sop(conquest_aria_engine, uid) for uid in uids}
-
-		# Keep single association if any of the files are missing
-		if not all(uids_exist.values()):
-			assoc = aria_dicom_interface.get_assoc()
-			for uid, status in uids_exist.items():
-				if not status:
-					print("- Moving RT Plan / Dose with SOP UID", uid)
-					aria_dicom_interface.c_move_image(assoc, uid)
-			assoc.release()
-
-		# Find the structure set UIDs + plan labels from the RT Plan file
-		structure_set_uids, plan_label = conquest_db_interface.get_rt_struct_uid(conquest_aria_engine, plan_sop_uid)
-
-		plan_set[patient_ser]["PlanSet"][plan_sop_uid]["RTPlanLabel"] = plan_label
-
-		for instance_uid in structure_set_uids:
-			plan_set[patient_ser]["PlanSet"][plan_sop_uid]["RTSTRUCT"].add(instance_uid)
-
-			if not conquest_db_interface.check_exists_sop(conquest_aria_engine, instance_uid):
-				print(f"- Moving structure set Instance UID {instance_uid}")
-				assoc = aria_dicom_interface.get_assoc()
-				aria_dicom_interface.c_move_image(assoc, instance_uid)
-				assoc.release()
-
-		# Download the associated CT
-		for instance_uid in structure_set_uids:
-			ct_series_uid_list = conquest_db_interface.find_referenced_ct_series(conquest_aria_engine, instance_uid)
-			for ct_series_uid in ct_series_uid_list:
-				plan_set[patient_ser]["PlanSet"][plan_sop_uid]["CT"].add(ct_series_uid)
-
-				if not conquest_db_interface.check_exists_series(conquest_aria_engine, ct_series_uid):
-					print(f"- Moving CT Series with Series UID", ct_series_uid)
-					assoc = aria_dicom_interface.get_assoc()
-					aria_dicom_interface.c_move_series(assoc, ct_series_uid)
-					assoc.release()
-
-	conquest_dicom_interface.c_move_to_medfys2(conquest_krest_engine, plan_set[patient_ser])
-	conquest_dicom_interface.c_move_to_krest_hus(plan_set[patient_ser].get("PatientID"))
-	
+	patient_plan_set = PlanSet({patient_ser: patient})
+
+	# Resolve RTSTRUCT / CT / RTPlanLabel for the plans already in Conquest in one pass
+	conquest_db_interface.resolve_plan_set(conquest_aria_engine, patient_plan_set, arrivals)
+
+	# Move the treated RT Plans and RT Doses to Conquest
+	uids = patient.plan_uids | patient.rtdose_uids
+	uids_missing = patient.missing_sops(existing_sops(uids), uids)
+
+	if uids_missing:
+		move_from_aria(patient_ser, missing_sops=uids_missing)
+
+	# Find the structure set UIDs + plan labels from the RT Plan files just moved
+	if uids_missing:
+		conquest_db_interface.resolve_rt_structs(conquest_aria_engine, patient_plan_set, arrivals)
+
+	structure_set_uids = patient.rtstruct_uids
+	structure_sets_missing = patient.missing_sops(existing_sops(structure_set_uids), structure_set_uids)
+
+	if structure_sets_missing:
+		move_from_aria(patient_ser, missing_sops=structure_sets_missing)
+
+	# Download the associated CT
+	if uids_missing or structure_sets_missing:
+		conquest_db_interface.resolve_ct_series(conquest_aria_engine, patient_plan_set, arrivals)
+
+	ct_series_counts = existing_series_counts(patient.ct_series_uids)
+	ct_series_missing = patient.missing_series({uid for uid, n in ct_series_counts.items() if n})
+
+	if ct_series_missing:
+		move_from_aria(patient_ser, missing_series=ct_series_missing)
+		if not args.dry_run:
+			ct_series_counts.update(existing_series_counts(ct_series_missing))
+
+	# A partially received series is completed with its missing instances only
+	ct_files_nb, ct_instances_missing, ct_inventory = find_missing_ct_instances(patient_ser, ct_series_counts)
+
+	if ct_instances_missing:
+		move_from_aria(patient_ser, missing_sops=ct_instances_missing, inventory=ct_inventory)
+
+	# Nothing was moved, so the later steps would only repeat what is already stored
+	if args.dry_run:
+		return
+
+	# The plans of a new patient were not in Conquest before the moves
+	if not patient.patient_id:
+		patient.patient_id = find_patient_id(patient)
+
+	stored = conquest_dicom_interface.c_move_to_medfys2(conquest_krest_engine, patient, checkpoints, arrivals, krest_inventory,
+		on_result=journal(patient_ser, config.conquest_aria.dicom.aet, config.conquest_krest.dicom.aet),
+		files_nb=ct_files_nb, source_engine=conquest_aria_engine)
+
+	# Estimated size of the patient, charged to the transfer windows of conquest_krest
+	n_objects = len(stored & patient.sop_uids) + sum(ct_files_nb.get(uid, 0) for uid in stored & patient.ct_series_uids)
+
+	# Re-sending a patient to KREST is the most expensive step, so it is skipped
+	# when everything stored in Medfys-2 was already part of a confirmed move
+	if not stored:
+		print(f"- Nothing stored in {config.conquest_krest.dicom.aet} for patient {patient_ser}")
+	elif not checkpoints.missing("krest", stored):
+		print(f"- Patient {patient_ser} already confirmed at {config.krest.name}")
+	elif config.krest.forward_mode == "store":
+		if krest_hus_inventory is not None:
+			confirm_krest_series(patient_ser, patient, stored, ct_files_nb)
+
+		not_sent = retry.retry_call(
+			lambda: krest_dicom_interface.c_store_to_krest(conquest_krest_engine, patient, stored, checkpoints),
+			is_done=lambda not_sent: not not_sent,
+			description=f"C-STORE of patient {patient_ser} to {config.krest.name}")
+		if not_sent:
+			raise RuntimeError(f"C-STORE of {len(not_sent)} objects of patient {patient_ser} to {config.krest.name} failed")
+	elif not patient.patient_id:
+		# An empty PatientID would match every patient in conquest_krest
+		raise RuntimeError(f"No PatientID found for patient {patient_ser}, not moving it to {config.krest.name}")
+	elif retry.retry_call(lambda: conquest_dicom_interface.c_move_to_krest_hus(patient.patient_id, n_objects),
+			is_done=bool, description=f"C-MOVE of patient {patient_ser} to {config.krest.name}"):
+		checkpoints.confirm(patient_ser, "krest", stored)
+	else:
+		raise RuntimeError(f"C-MOVE of patient {patient_ser} to {config.krest.name} failed")
+
+	# A patient sent in an earlier run keeps its sent_dt, but its new CT series get
+	# their rows, so that their files_nb is stored
 	if not sent_dt:
-		log_database.add_patient(patient_ser, plan_set[patient_ser])
-
-log_database.save()
+		log_database.add_patient(patient_ser, patient)
+	else:
+		log_database.save_plan_set(patient_ser, patient)
+	log_database.set_ct_files_nb(ct_files_nb)
+
+	# The failures of earlier runs are confirmed for the UIDs found at their destination:
+	# stored in Medfys-2, received from ARIA, and the failed patient row itself
+	verified = stored | existing_sops(patient.sop_uids) | existing_series(patient.ct_series_uids)
+	log_database.confirm_transfers(patient_ser, verified | {str(patient_ser)})
+
+def export_patient(patient_ser, patient, earlier=None):
+	"""process_patient, one export of the same patient at a time. The plan set of an
+	earlier export of the patient (earlier) is merged once that export has finished."""
+	with patient_locks[patient_ser]:
+		if earlier is not None:
+			patient.merge(earlier)
+		process_patient(patient_ser, patient)
+
+failed_patients = list()
+unsaved_patients = list()
+plan_sets = dict()
+patient_locks = dict()
+
+# Patients that failed in earlier runs are resumed from the export log and the transfer journal
+pending_patients = dict() if args.dry_run else dict(log_database.get_pending_patients())
+if pending_patients:
+	print(f"Resuming {len(pending_patients)} patients from earlier runs")
+
+# Patients are handed to the workers as soon as all their rows have arrived from ARIA.
+# A failing patient (association refused, missing file, ...) is logged and
+# does not stop the other workers
+with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="export") as executor:
+	futures = dict()
+
+	for patient_ser, patient in aria_db_interface.iter_patient_plan_sets(dt):
+		if patient_ser in pending_patients:
+			patient.merge(pending_patients.pop(patient_ser))
+		# The rows of the patient were not consecutive, so it is exported again with
+		# all its rows once the earlier export of the patient has finished
+		earlier = plan_sets.get(patient_ser)
+		if earlier is not None:
+			logger.warning(f"Rows of patient {patient_ser} are not consecutive, exporting the merged plan set")
+		plan_sets[patient_ser] = patient
+		patient_locks.setdefault(patient_ser, threading.Lock())
+		futures[executor.submit(export_patient, patient_ser, patient, earlier)] = patient_ser
+
+	print(f"Found {len(plan_sets)} patients since {dt.isoformat()}")
+
+	for patient_ser, patient in pending_patients.items():
+		plan_sets[patient_ser] = patient
+		patient_locks.setdefault(patient_ser, threading.Lock())
+		futures[executor.submit(export_patient, patient_ser, patient)] = patient_ser
+
+	for future in as_completed(futures):
+		patient_ser = futures[future]
+		try:
+			future.result()
+		except Exception as e:
+			logger.exception(f"Export of patient {patient_ser} failed")
+			print(f"- Export of patient {patient_ser} failed: {e}")
+			failed_patients.append(patient_ser)
+
+			if args.dry_run:
+				continue
+
+			# The patient is resumed on the next run, so the watermark can move on
+			try:
+				log_database.save_plan_set(patient_ser, plan_sets[patient_ser])
+				log_database.add_transfer(patient_ser, [str(patient_ser)], "PATIENT", "aria", config.krest.name, 1, "failed", str(e))
+			except Exception:
+				logger.exception(f"Cannot save patient {patient_ser} for the next run")
+				unsaved_patients.append(patient_ser)
+
+health_monitor.stop()
+association_pool.close_all()
+
+associations = association_pool.report()
+if associations:
+	print()
+	print(associations)
+	logger.info(f"Associations of this run:\n{associations}")
+
+if storage_scp:
+	storage_scp.shutdown()
+
+if args.dry_run:
+	print(f"Dry run, watermark is kept at {watermark}")
+elif unsaved_patients:
+	print(f"{len(unsaved_patients)} patients failed and could not be saved: {unsaved_patients}")
+	print(f"Watermark is kept at {watermark}, the failed patients are retried on the next run")
+else:
+	if failed_patients:
+		print(f"{len(failed_patients)} patients failed: {failed_patients}, they are resumed on the next run")
+
+	# Newest treatment record seen, or the start of the run if the stored
+	# procedure does not return the treatment record timestamps
+	last_dts = [patient.last_treatment_record_dt for patient in plan_sets.values()]
+	last_dts = [last_dt for last_dt in last_dts if last_dt]
+	new_watermark = max(last_dts) if last_dts else run_start_dt
+
+	if not watermark or new_watermark > watermark:
+		log_database.set_watermark(new_watermark)
+		print(f"Watermark set to {new_watermark.isoformat()}")
 
 n_dose = 0
 n_plan = 0
 n_dose_transmitted = 0
 n_plan_transmitted = 0
 
-for patient_ser in plan_set:
-	for plan_uid in plan_set[patient_ser]["PlanSet"]:
+all_uids = set()
+for patient_ser, patient in plan_sets.items():
+	all_uids |= patient.plan_uids | patient.rtdose_uids
+
+uids_existing = existing_sops(all_uids)
+
+for patient_ser, patient in plan_sets.items():
+	for plan_uid, plan in patient.plans.items():
 		n_plan += 1
-		if conquest_db_interface.check_exists_sop(conquest_aria_engine, plan_uid):
+		if plan_uid in uids_existing:
 			n_plan_transmitted += 1
-		for dose_uid in plan_set[patient_ser]["PlanSet"][plan_uid]["RTDOSE"]:
+		for dose_uid in plan.rtdose:
 			n_dose += 1
-			if not conquest_db_interface.check_exists_sop(conquest_aria_engine, dose_uid):
+			if dose_uid not in uids_existing:
 				print("CANNOT FIND RT DOSE FILE WITH UID", dose_uid)
 			else:
 				n_dose_transmitted += 1
@@ -8,4 +8,6 @@ class TxRecordsProtonToExport(BaseModel):
 	PatientSer: int
 	PlanUID: str
 	TreatmentRecordUID: str
-	DoseUID: str
\ No newline at end of file
+	DoseUID: str
+	# Not returned by older versions of the stored procedure
+	TreatmentRecordDateTime: Optional[datetime] = None
\ No newline at end of file
@@ -1,15 +1,29 @@
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from datetime import date, time
 
 class BaseSql(BaseModel):
     uri: Optional[str] = None
     file: Optional[str] = None
 
+class TransferWindow(BaseModel):
+    start: time = time(0, 0)
+    end: time = time(0, 0) # Same as start: the whole day. Before start: over midnight
+    max_concurrent: Optional[int] = None # Max concurrent transfers in the window
+    max_objects_per_minute: Optional[int] = None
+
 class BaseDicom(BaseModel):
     aet: str
     server: Optional[str] = None
     port: Optional[int] = None
     name: Optional[str] = None
+    max_associations: int = 2 # Max concurrent associations to this peer
+    keepalive: int = 30 # Seconds idle before a pooled association is checked with C-ECHO
+    max_idle: int = 300 # Seconds idle before a pooled association is dropped
+    multi_uid_move: bool = False # The node accepts a List of UID in C-FIND / C-MOVE identifiers
+    max_uids_per_move: int = 100 # Max UIDs in a single List of UID request
+    windows: List[TransferWindow] = [] # Transfer limits by time of day, no limits if empty
+    transfer_syntaxes: List[str] = [] # Preferred transfer syntaxes for C-STORE (pydicom names or UIDs), uncompressed if empty
 
 class Pacs(BaseModel):
     sql: BaseSql
@@ -19,10 +33,39 @@ class Pacs(BaseModel):
 class Krest(BaseModel):
     dicom: BaseDicom
     name: str
+    forward_mode: str = "move" # "move": C-MOVE of the whole patient from conquest_krest, "store": C-STORE of the new instances
+
+class Scp(BaseModel):
+    enabled: bool = False # Receive the C-MOVE output of ARIA in the exporter instead of in conquest_aria
+    aet: str = "EKSPORT"
+    port: int = 11112
+    storage_dir: str = "scp_storage"
+    transfer_syntaxes: List[str] = [] # Accepted in addition to the uncompressed syntaxes
+
+class Export(BaseModel):
+    workers: int = 1
+    start_date: date = date(2025, 1, 1) # First date of a full rescan
+    watermark_overlap_days: int = 1 # Days before the watermark that are queried again
+    reference_cache: Optional[str] = None # SQL uri of the parsed RT reference cache, disabled if empty
+    checkpoint_file: Optional[str] = None # Append-only journal of confirmed transfers, in memory only if empty
+    plan_transfers: bool = True # C-FIND the ARIA inventory and coalesce C-MOVE requests per series / study
+    series_move_threshold: float = 0.5 # Share of a series missing before the whole series is moved
+    study_move_threshold: float = 0.8 # Share of a study missing before the whole study is moved
+    retry_attempts: int = 3 # Attempts per transfer before the patient fails and is resumed on the next run
+    retry_base_delay: float = 5.0 # Seconds before the first retry, doubled for every attempt
+    retry_max_delay: float = 300.0
+    inventory_cache: Optional[str] = None # Folder of the cached destination inventories, rebuilt every run if empty
+    health_interval: int = 60 # Seconds between the C-ECHO / SELECT 1 checks of the peers during a run, disabled if 0
+    health_window: int = 50 # Checks kept per peer for the latency percentiles
+    health_latency_ms: float = 1000.0 # 95th percentile of the latency above which a peer is degraded
+    health_failures: int = 3 # Failed checks in a row before a peer is down
+    health_max_wait: int = 1800 # Seconds a transfer waits for a peer that is down before it fails, no limit if 0
+    scp: Scp = Field(default_factory=Scp)
 
 class ConfigDataclass(BaseModel):
     conquest_aria: Pacs
     conquest_krest: Pacs
     aria: Pacs
     log_db: BaseSql
-    krest: Krest
\ No newline at end of file
+    krest: Krest
+    export: Export = Field(default_factory=Export)
@@ -5,6 +5,9 @@ from sqlmodel import SQLModel, Field, Relationship
 
 # sent_status: Not started; Identified; Aria Exported; KREST Exported
 
+# RT Struct and CT series can be shared by several plans, so only the RT Plan
+# SOP Instance UID is unique. The other UIDs are indexed for lookups.
+
 # -------------------------
 # Patient
 # -------------------------
@@ -12,7 +15,11 @@ from sqlmodel import SQLModel, Field, Relationship
 class Patient(SQLModel, table=True):
     patient_ser: Optional[int] = Field(default=None, primary_key=True)
 
+    patient_id: Optional[str] = Field(default=None, index=True)
+    sent_dt: Optional[datetime] = None
+
     courses: List["Course"] = Relationship(back_populates="patient")
+    rtplans: List["RTPlan"] = Relationship(back_populates="patient")
 
 
 # -------------------------
@@ -36,16 +43,21 @@ class Course(SQLModel, table=True):
 class RTPlan(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
 
-    course_ser: int = Field(foreign_key="course.course_ser")
+    # blp_GetTxRecordsProtonToExport gives the patient, not the course
+    patient_ser: Optional[int] = Field(default=None, foreign_key="patient.patient_ser", index=True)
+    patient: Optional[Patient] = Relationship(back_populates="rtplans")
+
+    course_ser: Optional[int] = Field(default=None, foreign_key="course.course_ser")
     course: Optional[Course] = Relationship(back_populates="rtplans")
 
     sop_instance_uid: str = Field(unique=True, index=True)
-    series_instance_uid: str = Field(unique=True, index=True)
+    series_instance_uid: Optional[str] = Field(default=None, index=True)
+    rt_plan_label: Optional[str] = None
 
-    sent_dt: datetime
+    sent_dt: Optional[datetime] = None
     sent_status: str
 
-    file_dt: datetime
+    file_dt: Optional[datetime] = None
 
     apprec_code: Optional[str] = None
     apprec_text: Optional[str] = None
@@ -63,13 +75,13 @@ class RTPlan(SQLModel, table=True):
 class RTRecord(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
 
-    rtplan_id: int = Field(foreign_key="rtplan.id")
+    rtplan_id: int = Field(foreign_key="rtplan.id", index=True)
     rtplan: Optional[RTPlan] = Relationship(back_populates="rtrecords")
 
-    sop_instance_uid: str = Field(unique=True, index=True)
-    series_instance_uid: str = Field(unique=True, index=True)
+    sop_instance_uid: str = Field(index=True)
+    series_instance_uid: Optional[str] = Field(default=None, index=True)
 
-    file_dt: datetime
+    file_dt: Optional[datetime] = None
 
 
 # -------------------------
@@ -79,13 +91,13 @@ class RTRecord(SQLModel, table=True):
 class RTStruct(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
 
-    rtplan_id: int = Field(foreign_key="rtplan.id")
+    rtplan_id: int = Field(foreign_key="rtplan.id", index=True)
     rtplan: Optional[RTPlan] = Relationship(back_populates="rtstructs")
 
-    sop_instance_uid: str = Field(unique=True, index=True)
-    series_instance_uid: str = Field(unique=True, index=True)
+    sop_instance_uid: str = Field(index=True)
+    series_instance_uid: Optional[str] = Field(default=None, index=True)
 
-    file_dt: datetime
+    file_dt: Optional[datetime] = None
 
 
 # -------------------------
@@ -95,14 +107,14 @@ class RTStruct(SQLModel, table=True):
 class RTDose(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
 
-    rtplan_id: int = Field(foreign_key="rtplan.id")
+    rtplan_id: int = Field(foreign_key="rtplan.id", index=True)
     rtplan: Optional[RTPlan] = Relationship(back_populates="rtdoses")
 
-    sop_instance_uid: str = Field(unique=True, index=True)
-    series_instance_uid: str = Field(unique=True, index=True)
+    sop_instance_uid: str = Field(index=True)
+    series_instance_uid: Optional[str] = Field(default=None, index=True)
 
-    dose_type: str
-    file_dt: datetime
+    dose_type: Optional[str] = None
+    file_dt: Optional[datetime] = None
 
 
 # -------------------------
@@ -112,13 +124,13 @@ class RTDose(SQLModel, table=True):
 class CT(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
 
-    rtplan_id: int = Field(foreign_key="rtplan.id")
+    rtplan_id: int = Field(foreign_key="rtplan.id", index=True)
     rtplan: Optional[RTPlan] = Relationship(back_populates="cts")
 
-    series_instance_uid: str = Field(unique=True, index=True)
+    series_instance_uid: str = Field(index=True)
 
     files_nb: Optional[int] = None
-    file_dt: datetime
+    file_dt: Optional[datetime] = None
 
 
 # -------------------------
@@ -132,4 +144,43 @@ class NPR(SQLModel, table=True):
     course: Optional[Course] = Relationship(back_populates="nprs")
 
     sent_status: str
-    sent_dt: Optional[datetime]
\ No newline at end of file
+    sent_dt: Optional[datetime]
+
+
+# -------------------------
+# Transfer journal
+# -------------------------
+
+# One row per UID and attempt of every transfer. A row is confirmed when the object
+# is found at the destination, or the patient completes. Patients with unconfirmed
+# failed rows are resumed on the next run.
+# status: succeeded; not_found (the source does not have the object); failed
+
+class TransferJournal(SQLModel, table=True):
+    __tablename__ = "transfer_journal"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+
+    patient_ser: Optional[int] = Field(default=None, index=True)
+    uid: str = Field(index=True)
+    level: str
+    source: str
+    destination: str
+    attempt: int = 1
+    status: str
+    error: Optional[str] = None
+
+    dt: datetime
+    confirmed_dt: Optional[datetime] = Field(default=None, index=True)
+
+
+# -------------------------
+# Export state
+# -------------------------
+
+# Key/value state kept between runs, e.g. the treatment record watermark
+
+class ExportState(SQLModel, table=True):
+    key: str = Field(primary_key=True)
+    value: str
+    updated_dt: datetime
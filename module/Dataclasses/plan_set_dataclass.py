@@ -0,0 +1,213 @@
+import json
+import sys
+from datetime import datetime
+
+"""
+Plan set of the export: the RT objects of each patient, grouped per treated RT Plan.
+
+	PlanSet {PatientSer: PatientPlanSet}
+	PatientPlanSet
+		patient_ser, patient_id, last_treatment_record_dt
+		plans {RT Plan SOP UID: PlanNode}
+	PlanNode
+		plan_uid, label
+		rtdose, rtrecord, rtstruct	SOP Instance UIDs
+		ct							Series Instance UIDs
+
+The classes use __slots__ and the UIDs are interned, since the same UIDs are
+held by many plans and lookups in the export loop compare them repeatedly.
+to_dict() gives the format of the former nested dicts, also used for JSON.
+"""
+
+def intern_uid(uid):
+	return sys.intern(str(uid)) if uid else uid
+
+def intern_uids(uids) -> set:
+	return {intern_uid(uid) for uid in uids if uid}
+
+class PlanNode:
+	__slots__ = ("plan_uid", "label", "rtdose", "rtrecord", "rtstruct", "ct")
+
+	def __init__(self, plan_uid: str):
+		self.plan_uid = intern_uid(plan_uid)
+		self.label = str()
+		self.rtdose = set()
+		self.rtrecord = set()
+		self.rtstruct = set()
+		self.ct = set()
+
+	@property
+	def sop_uids(self) -> set:
+		"""All SOP Instance UIDs of the plan: the plan itself, doses, records and structure sets"""
+		return {self.plan_uid} | self.rtdose | self.rtrecord | self.rtstruct
+
+	def to_dict(self) -> dict:
+		return {
+			"RTPlanLabel": self.label,
+			"RTPLAN": [self.plan_uid],
+			"RTDOSE": sorted(self.rtdose),
+			"RTRECORD": sorted(self.rtrecord),
+			"RTSTRUCT": sorted(self.rtstruct),
+			"CT": sorted(self.ct),
+		}
+
+	@classmethod
+	def from_dict(cls, plan_uid: str, d: dict) -> "PlanNode":
+		node = cls(plan_uid)
+		node.label = d.get("RTPlanLabel") or str()
+		node.rtdose = intern_uids(d.get("RTDOSE") or [])
+		node.rtrecord = intern_uids(d.get("RTRECORD") or [])
+		node.rtstruct = intern_uids(d.get("RTSTRUCT") or [])
+		node.ct = intern_uids(d.get("CT") or [])
+		return node
+
+	def __repr__(self) -> str:
+		return f"PlanNode({self.plan_uid}, label={self.label!r}, rtdose={len(self.rtdose)}, rtstruct={len(self.rtstruct)}, ct={len(self.ct)})"
+
+class PatientPlanSet:
+	__slots__ = ("patient_ser", "patient_id", "last_treatment_record_dt", "plans")
+
+	def __init__(self, patient_ser, patient_id: str = None):
+		self.patient_ser = patient_ser
+		self.patient_id = patient_id
+		self.last_treatment_record_dt = None
+		self.plans = dict()
+
+	def plan(self, plan_uid: str) -> PlanNode:
+		"""The plan node of plan_uid, created if the plan is new"""
+
+		node = self.plans.get(plan_uid)
+		if node is None:
+			node = self.plans[intern_uid(plan_uid)] = PlanNode(plan_uid)
+		return node
+
+	def add_tx_record(self, row) -> None:
+		"""Folds a single row of blp_GetTxRecordsProtonToExport into the plan set"""
+
+		node = self.plan(row["PlanUID"])
+		if row["TreatmentRecordUID"]:
+			node.rtrecord.add(intern_uid(row["TreatmentRecordUID"]))
+		if row["DoseUID"]:
+			node.rtdose.add(intern_uid(row["DoseUID"]))
+
+		record_dt = row.get("TreatmentRecordDateTime")
+		if record_dt and (not self.last_treatment_record_dt or record_dt > self.last_treatment_record_dt):
+			self.last_treatment_record_dt = record_dt
+
+	def merge(self, other: "PatientPlanSet") -> None:
+		"""Adds the plans and objects of other, e.g. a plan set resumed from the export log"""
+
+		self.patient_id = self.patient_id or other.patient_id
+		if other.last_treatment_record_dt and (not self.last_treatment_record_dt or other.last_treatment_record_dt > self.last_treatment_record_dt):
+			self.last_treatment_record_dt = other.last_treatment_record_dt
+
+		for plan_uid, other_node in other.plans.items():
+			node = self.plan(plan_uid)
+			node.label = node.label or other_node.label
+			node.rtdose |= other_node.rtdose
+			node.rtrecord |= other_node.rtrecord
+			node.rtstruct |= other_node.rtstruct
+			node.ct |= other_node.ct
+
+	def _union(self, attr: str) -> set:
+		uids = set()
+		for node in self.plans.values():
+			uids |= getattr(node, attr)
+		return uids
+
+	@property
+	def plan_uids(self) -> set:
+		return set(self.plans)
+
+	@property
+	def rtdose_uids(self) -> set:
+		return self._union("rtdose")
+
+	@property
+	def rtrecord_uids(self) -> set:
+		return self._union("rtrecord")
+
+	@property
+	def rtstruct_uids(self) -> set:
+		return self._union("rtstruct")
+
+	@property
+	def ct_series_uids(self) -> set:
+		return self._union("ct")
+
+	@property
+	def sop_uids(self) -> set:
+		"""All SOP Instance UIDs of the patient, i.e. everything moved at IMAGE level"""
+		return self.plan_uids | self.rtdose_uids | self.rtrecord_uids | self.rtstruct_uids
+
+	def missing_sops(self, existing: set, uids: set = None) -> set:
+		"""The SOP Instance UIDs (default: all of the patient) that are not in existing"""
+		return (self.sop_uids if uids is None else set(uids)) - existing
+
+	def missing_series(self, existing: set) -> set:
+		"""The CT Series Instance UIDs of the patient that are not in existing"""
+		return self.ct_series_uids - existing
+
+	def to_dict(self) -> dict:
+		return {
+			"PatientID": self.patient_id,
+			"LastTreatmentRecordDateTime": self.last_treatment_record_dt.isoformat() if self.last_treatment_record_dt else None,
+			"PlanSet": {plan_uid: node.to_dict() for plan_uid, node in self.plans.items()},
+		}
+
+	@classmethod
+	def from_dict(cls, patient_ser, d: dict) -> "PatientPlanSet":
+		patient = cls(patient_ser, d.get("PatientID"))
+
+		last_dt = d.get("LastTreatmentRecordDateTime")
+		patient.last_treatment_record_dt = datetime.fromisoformat(last_dt) if isinstance(last_dt, str) else last_dt
+
+		for plan_uid, plan in (d.get("PlanSet") or dict()).items():
+			patient.plans[intern_uid(plan_uid)] = PlanNode.from_dict(plan_uid, plan)
+
+		return patient
+
+	def __repr__(self) -> str:
+		return f"PatientPlanSet({self.patient_ser}, patient_id={self.patient_id!r}, plans={len(self.plans)})"
+
+class PlanSet(dict):
+	"""{PatientSer: PatientPlanSet}"""
+
+	__slots__ = ()
+
+	def patient(self, patient_ser) -> PatientPlanSet:
+		"""The plan set of patient_ser, created if the patient is new"""
+
+		patient = self.get(patient_ser)
+		if patient is None:
+			patient = self[patient_ser] = PatientPlanSet(patient_ser)
+		return patient
+
+	@property
+	def sop_uids(self) -> set:
+		uids = set()
+		for patient in self.values():
+			uids |= patient.sop_uids
+		return uids
+
+	@property
+	def ct_series_uids(self) -> set:
+		uids = set()
+		for patient in self.values():
+			uids |= patient.ct_series_uids
+		return uids
+
+	def to_dict(self) -> dict:
+		return {patient_ser: patient.to_dict() for patient_ser, patient in self.items()}
+
+	def to_json(self, **kwargs) -> str:
+		return json.dumps(self.to_dict(), **kwargs)
+
+	@classmethod
+	def from_dict(cls, d: dict) -> "PlanSet":
+		return cls({patient_ser: PatientPlanSet.from_dict(patient_ser, patient) for patient_ser, patient in d.items()})
+
+	@classmethod
+	def from_json(cls, s: str) -> "PlanSet":
+		# JSON object keys are strings, PatientSer is an integer in ARIA
+		return cls.from_dict({int(patient_ser): patient for patient_ser, patient in json.loads(s).items()})
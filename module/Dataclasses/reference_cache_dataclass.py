@@ -0,0 +1,23 @@
+from typing import Optional
+
+from sqlmodel import SQLModel, Field
+
+# -------------------------
+# Parsed references of an RT object in Conquest
+# -------------------------
+
+# DICOM objects are immutable once stored, so the references read from a file are
+# valid as long as the file itself is unchanged (same mtime and size)
+
+class RTReference(SQLModel, table=True):
+    __tablename__ = "rt_reference"
+
+    sop_instance_uid: str = Field(primary_key=True)
+
+    file_mtime: float
+    file_size: int
+
+    # JSON list of the referenced UIDs:
+    # RTPLAN -> RTSTRUCT SOP UIDs, RTSTRUCT -> CT Series UIDs, RTDOSE -> RTPLAN SOP UIDs
+    references: str
+    rt_plan_label: Optional[str] = None
@@ -1,8 +1,8 @@
 from module.interfaces.NPR_ident_interface import NPRIdentInterface
 from module.interfaces.NPR_interface import NPRInterface
 
-from module.interfaces.DICOM_interface import DICOMInterface, makeDataset
-from module.interfaces.ConquestInterface import ConquestInterface
+from module.utils.DICOMSR import DICOMSR, makeDataset
+from module.utils import association_pool
 
 from pydicom.uid import generate_uid
 import pathlib
@@ -72,14 +72,14 @@ if args.inputFile:
 else:
 	print("Using dummy data generation.")
 	NPRObject = NPRInterface()
-	NPRObject.fillWithDummy()
+	NPRObject.fill_with_dummy()
 
 # Validate XML before encapsulating to ensure it can be read again
 
-XMLString = NPRObject.getXML()
+XMLString = NPRObject.get_XML()
 
 parentUID = args.parentUID or generate_uid()
-patients = NPRObject.getPatients()
+patients = NPRObject.get_patients()
 if len(patients) == 1:
 	patientName = args.name or str(patients[0].pasientNr)
 	patientID = args.id or str(patients[0].pasientNr)
@@ -90,17 +90,17 @@ else:
 if args.print:
 	rich.print(NPRObject.npr)
 
-# Returns DicomInterface object
+# Returns DICOMSR object
 basicSR = makeDataset(parentUID, patientID, patientName, XMLString)
 basicSR.saveFile(output)
 
 if args.outputConquest:
-	# Which Conquest to send to here? Provide list? Local / registry?
-	# the config.py settings are used for connection.
+	# Sent to conquest_krest (Medfys-2), see association_pool.PEERS.
+	# For many files, use module/utils/DICOMSR_batch.py
 
-	conquest = ConquestInterface()
-	response, config = conquest.sendDS(basicSR.ds)
-	print(f"File {output} sent to Conquest at {config['conquestIP']}:{config['conquestPort']}.")
+	with association_pool.association("conquest_krest_sr") as assoc:
+		status = assoc.send_c_store(basicSR.ds)
+	print(f"File {output} sent to {assoc.acceptor.ae_title}: 0x{status.Status:04X}" if status else f"Sending {output} failed.")
 
 if not args.outputFile:
 	os.remove(output)
\ No newline at end of file
@@ -1,5 +1,7 @@
+import io
 import pathlib
 import numpy as np
+from lxml import etree
 
 from module.dataclass import NPR_dataclass
 from module.dataclass.ICD10 import ICD10
@@ -10,22 +12,106 @@ from module.dataclass.NKPK import NKPK
 """
 This file is responsible for extracting data from the NPR XML file.
 The XML file is either parsed from DICOM SR here, or earlier in the process.
+
+NPRInterface builds the whole MsgHead tree. For large deliveries, iter_objektholder()
+streams the file instead: one validated Objektholder (one patient) at a time, with the
+parsed elements cleared as it goes, so memory stays flat.
+
+	for objekt in iter_objektholder("NPR_2025.xml"):
+		print(objekt.pasientNr)
+
+NPRInterface(path, stream=True) does not build the tree, and its iter_objektholder()
+and dose columns are streamed from the file. The per-patient accessors need the tree.
 """
 
+NPR_NAMESPACE = "http://www.npr.no/xmlstds/57_0_1_str"
+OBJEKTHOLDER_TAG = f"{{{NPR_NAMESPACE}}}Objektholder"
+
+# One row per Dosebidrag, see NPRInterface.get_dose_columns()
+DOSE_COLUMNS = ("pasientNr", "serieID", "episodeID", "dato", "referansevolumID", "planDose", "gittDose", "objektNr", "stralingNr")
+
 class ListStructureAssertionException(Exception):
 	pass
 
+def _group(*keys) -> tuple:
+	"""The unique combinations of the key columns, one array per key, and the group of every row"""
+
+	if not len(keys[0]):
+		return [np.array(list(), dtype=key.dtype) for key in keys], np.array(list(), dtype=np.intp)
+
+	unique, groups = np.unique(np.stack(keys, axis=1), axis=0, return_inverse=True)
+	return [unique[:, i] for i in range(len(keys))], groups.reshape(-1)
+
+def _dose_reductions(columns: dict, groups: np.ndarray, n_groups: int) -> dict:
+	"""Sums of the doses per group, the number of fremmøter (distinct episodes) per group,
+	and the deviation of the given from the planned dose"""
+
+	plan = np.bincount(groups, weights=columns["planDose"], minlength=n_groups)
+	gitt = np.bincount(groups, weights=columns["gittDose"], minlength=n_groups)
+
+	# Several ApparatFremmote (devices) of the same episode are one fraction
+	_, episodes = np.unique(columns["episodeID"], return_inverse=True)
+	fractions = np.zeros(n_groups, dtype=np.int64)
+	if len(groups):
+		group_episodes = np.unique(np.stack([groups, episodes.reshape(-1)], axis=1), axis=0)
+		fractions = np.bincount(group_episodes[:, 0], minlength=n_groups)
+
+	deviation = gitt - plan
+	with np.errstate(divide="ignore", invalid="ignore"):
+		relative_deviation = np.where(plan != 0, deviation / plan, np.nan)
+
+	return {
+		"planDose": plan,
+		"gittDose": gitt,
+		"fractions": fractions,
+		"deviation": deviation,
+		"relative_deviation": relative_deviation,
+	}
+
+def iter_objektholder(source, encoding: str = None):
+	"""Yields the Objektholder elements of an NPR XML document as NPR_dataclass.Objektholder.
+	source is a path, a file object or the XML as str / bytes. The encoding of the XML
+	declaration is used unless encoding is given."""
+
+	if isinstance(source, str) and source.lstrip().startswith("<"):
+		source = source.encode(encoding or "utf-8")
+	if isinstance(source, bytes):
+		source = io.BytesIO(source)
+	elif isinstance(source, pathlib.Path):
+		source = str(source)
+
+	context = etree.iterparse(source, events=("end",), tag=OBJEKTHOLDER_TAG, encoding=encoding, huge_tree=True)
+
+	for _, element in context:
+		objekt = NPR_dataclass.Objektholder.from_xml_tree(element)
+
+		# The cleared element and the siblings before it are still referenced by the parent
+		element.clear(keep_tail=True)
+		while element.getprevious() is not None:
+			del element.getparent()[0]
+
+		yield objekt
+
+	del context
+
 
 class NPRInterface:
-	def __init__(self, path: str = None, xml_string: str = None, encoding: str = "utf-8") -> None:
+	def __init__(self, path: str = None, xml_string: str = None, encoding: str = "utf-8", stream: bool = False) -> None:
 		# Reads files fine with utf-8, crashes with iso-8859-1
 		# even if the source document is the latter...?
 		self.path = path
 		self.encoding = encoding
 		self.xml_string = xml_string
+		self.stream = stream
 		self.npr = None
+		self.indexes = None # See _index()
+		self.dose_columns = None # See get_dose_columns()
 
-		if self.path:
+		if self.stream:
+			# The document is only read by iter_objektholder()
+			self.inst = None
+
+		elif self.path:
 			self.xml_doc = pathlib.Path(self.path).read_text().encode(self.encoding)
 			self.npr = NPR_dataclass.MsgHead.from_xml(self.xml_doc)
 			self.inst = self.npr.Document.RefDoc.Content.Melding.Institusjon[0]
@@ -44,6 +130,19 @@ class NPRInterface:
 	def fill_with_dummy(self) -> None:
 		self.npr = NPR_dataclass.MsgHeadFactory.build()
 		self.inst = self.npr.Document.RefDoc.Content.Melding.Institusjon[0]
+		self.indexes = None
+		self.dose_columns = None
+
+	def iter_objektholder(self):
+		"""The Objektholder elements, from the parsed tree, or streamed from the file / XML
+		string with stream=True"""
+
+		if self.inst:
+			yield from self.inst.Objektholder
+		elif self.path:
+			yield from iter_objektholder(self.path)
+		elif self.xml_string:
+			yield from iter_objektholder(self.xml_string)
 
 	def get_XML(self) -> str:
 		if not self.npr:
@@ -63,33 +162,64 @@ class NPRInterface:
 
 		return [obj.Pasient.pasientNr for obj in self.inst.Objektholder]
 
+	def _index(self, name: str) -> dict:
+		"""Dictionaries over the parsed tree, built on first use:
+			objektholder: {pasientNr: first Objektholder}
+			episodes: {pasientNr: [Episode of all the Objektholder of the patient]}
+			medisinskStraling: {medisinskStralingID: [MedisinskStraling]}
+			referansevolum: {medisinskStralingID: {referansevolumID: Referansevolum}}"""
+
+		if self.indexes is None:
+			objektholder = dict()
+			episodes = dict()
+			medisinskStraling = dict()
+			referansevolum = dict()
+
+			for objekt in self.inst.Objektholder:
+				objektholder.setdefault(objekt.pasientNr, objekt)
+				episodes.setdefault(objekt.pasientNr, list()).extend(objekt.episode)
+
+				for straling in objekt.medisinskStraling:
+					medisinskStraling.setdefault(straling.medisinskStralingID, list()).append(straling)
+					referansevolum.setdefault(straling.medisinskStralingID, dict()).update(
+						{v.referansevolumID: v for v in straling.referansevolum})
+
+			self.indexes = {
+				"objektholder": objektholder,
+				"episodes": episodes,
+				"medisinskStraling": medisinskStraling,
+				"referansevolum": referansevolum,
+			}
+
+		return self.indexes[name]
+
 	def get_patient(self, pasientNr: int):
 		if not self.inst:
 			return None
 
-		for objekt in self.inst.Objektholder:
-			if objekt.pasientNr != pasientNr:
-				continue
+		objekt = self._index("objektholder").get(pasientNr)
+		if not objekt:
+			return None
 
-			if len(objekt.medisinskStraling) > 1:
-				raise ListStructureAssertionException(
-					 'medisinskStraling encountered more than one')
+		if len(objekt.medisinskStraling) > 1:
+			raise ListStructureAssertionException(
+				 'medisinskStraling encountered more than one')
 
-			return objekt.Pasient
+		return objekt.Pasient
 
 	def get_behandlingsserie(self, pasientNr: int) -> list:
 		if not self.inst:
 			return list()
 
-		for objekt in self.inst.Objektholder:
-			if not objekt.pasientNr == pasientNr:
-				continue
+		objekt = self._index("objektholder").get(pasientNr)
+		if not objekt or not objekt.medisinskStraling:
+			return list()
 
-			if len(objekt.medisinskStraling) > 1:
-				raise ListStructureAssertionException(
-					 'medisinskStraling encountered more than one')
+		if len(objekt.medisinskStraling) > 1:
+			raise ListStructureAssertionException(
+				 'medisinskStraling encountered more than one')
 
-			return objekt.medisinskStraling[0].behandlingsserie
+		return objekt.medisinskStraling[0].behandlingsserie
 
 	def get_referenced_volumes(self, pasientNr: int) -> list:
 		# TODO: Sjekk at pasientNr == attr i medisinsk stråling her i stedet for å bruke indeksert patID
@@ -97,18 +227,12 @@ class NPRInterface:
 		if not self.inst:
 			return list()
 
-		vols = None
-		for objekt in self.inst.Objektholder:
-			for medisinskStraling in objekt.medisinskStraling:
-				if not medisinskStraling.medisinskStralingID == pasientNr:
-					continue
-
-				if isinstance(vols, list):
-					raise ListStructureAssertionException('medisinskStraling encountered more than one')
+		if len(self._index("medisinskStraling").get(pasientNr, ())) > 1:
+			raise ListStructureAssertionException('medisinskStraling encountered more than one')
 
-				vols = medisinskStraling.referansevolum
+		vols = self._index("referansevolum").get(pasientNr, dict())
 
-		return {v.referansevolumID: v.referansevolumNavn for v in vols}
+		return {v.referansevolumID: v.referansevolumNavn for v in vols.values()}
 
 	def get_dose_fractions(self, pasientNr: int) -> dict:
 		if not self.inst:
@@ -144,6 +268,73 @@ class NPRInterface:
 
 		return dose_fractions_total
 
+	def get_dose_columns(self) -> dict:
+		"""All Dosebidrag of the document as NumPy columns, one row per Dosebidrag, built in one pass:
+			pasientNr, serieID, referansevolumID: int64
+			episodeID: str, the fremmøte of the ApparatFremmote
+			dato: datetime64[s], innDatoTid of the episode (NaT if the episode is not found)
+			planDose, gittDose: float64
+			objektNr, stralingNr: int64, the Objektholder of the patient and its medisinskStraling (0: the first)"""
+
+		if self.dose_columns is not None:
+			return self.dose_columns
+
+		rows = {name: list() for name in DOSE_COLUMNS}
+		n_objekt = dict() # pasientNr: Objektholder seen
+
+		for objekt in self.iter_objektholder():
+			dates = {episode.episodeID: episode.innDatoTid for episode in objekt.episode}
+			objektNr = n_objekt.get(objekt.pasientNr, 0)
+			n_objekt[objekt.pasientNr] = objektNr + 1
+
+			for stralingNr, straling in enumerate(objekt.medisinskStraling):
+				for behandlingsserie in straling.behandlingsserie:
+					for apparatFremmote in behandlingsserie.ApparatFremmote:
+						dato = dates.get(apparatFremmote.episodeID)
+						for doseBidrag in apparatFremmote.doseBidrag:
+							rows["pasientNr"].append(objekt.pasientNr)
+							rows["serieID"].append(behandlingsserie.serieID)
+							rows["episodeID"].append(apparatFremmote.episodeID)
+							rows["dato"].append(dato)
+							rows["referansevolumID"].append(doseBidrag.referansevolumID)
+							rows["planDose"].append(doseBidrag.planDose)
+							rows["gittDose"].append(doseBidrag.gittDose)
+							rows["objektNr"].append(objektNr)
+							rows["stralingNr"].append(stralingNr)
+
+		self.dose_columns = {
+			"pasientNr": np.array(rows["pasientNr"], dtype=np.int64),
+			"serieID": np.array(rows["serieID"], dtype=np.int64),
+			"episodeID": np.array(rows["episodeID"], dtype=str),
+			"dato": np.array([np.datetime64(dato, "s") if dato else np.datetime64("NaT", "s") for dato in rows["dato"]], dtype="datetime64[s]"),
+			"referansevolumID": np.array(rows["referansevolumID"], dtype=np.int64),
+			"planDose": np.array(rows["planDose"], dtype=np.float64),
+			"gittDose": np.array(rows["gittDose"], dtype=np.float64),
+			"objektNr": np.array(rows["objektNr"], dtype=np.int64),
+			"stralingNr": np.array(rows["stralingNr"], dtype=np.int64),
+		}
+
+		return self.dose_columns
+
+	def get_dose_per_volume(self) -> dict:
+		"""Dose per patient and Referansevolum, as columns: pasientNr, referansevolumID,
+		planDose, gittDose, fractions, deviation (gitt - plan), relative_deviation (NaN if nothing is planned)"""
+
+		columns = self.get_dose_columns()
+		(pasientNr, referansevolumID), groups = _group(columns["pasientNr"], columns["referansevolumID"])
+
+		return {"pasientNr": pasientNr, "referansevolumID": referansevolumID,
+			**_dose_reductions(columns, groups, len(pasientNr))}
+
+	def get_dose_per_patient(self) -> dict:
+		"""Dose per patient over all Referansevolum, as columns: pasientNr, planDose, gittDose,
+		fractions, deviation, relative_deviation"""
+
+		columns = self.get_dose_columns()
+		(pasientNr,), groups = _group(columns["pasientNr"])
+
+		return {"pasientNr": pasientNr, **_dose_reductions(columns, groups, len(pasientNr))}
+
 	def get_behandlingsserie_navn(self, pasientNr: int) -> set:
 		if not self.inst:
 			return set()
@@ -162,15 +353,7 @@ class NPRInterface:
 			return list()
 
 		# episode id: diagnosis, treatment code
-		episodes = list()
-		for obj in self.inst.Objektholder:
-			if not obj.pasientNr == pasientNr:
-				continue
-
-			for episode in obj.episode:
-				episodes.append(episode)
-
-		return episodes
+		return list(self._index("episodes").get(pasientNr, ()))
 
 	def get_diagnoses(self, pasientNr: int) -> dict:
 		if not self.inst:
@@ -201,3 +384,57 @@ class NPRInterface:
 							prosedyrer.add(kode.kodeVerdi)
 
 		return {pros: self.NKPK.getNKPKDefinition(pros) for pros in prosedyrer}
+
+	# Bulk accessors: {pasientNr: result} for every patient in the document
+
+	def _for_all(self, accessor) -> dict:
+		if not self.inst:
+			return dict()
+
+		return {pasientNr: accessor(pasientNr) for pasientNr in self._index("objektholder")}
+
+	def get_all_patients(self) -> dict:
+		return self._for_all(self.get_patient)
+
+	def get_all_episodes(self) -> dict:
+		return self._for_all(self.get_episodes)
+
+	def get_all_dose_fractions(self) -> dict:
+		return self._for_all(self.get_dose_fractions)
+
+	def get_all_dose_totals(self) -> dict:
+		"""As get_dose_total for every patient: the Dosebidrag of the first Objektholder of the
+		patient and its medisinskStraling, summed per Referansevolum name from the grouped
+		sums of get_dose_columns()"""
+
+		if not self.inst:
+			return dict()
+
+		totals = dict()
+		for pasientNr in self._index("objektholder"):
+			# Raises as get_dose_total for more than one medisinskStraling
+			self.get_behandlingsserie(pasientNr)
+			totals[pasientNr] = {structureName: {'gitt': 0.0, 'plan': 0.0}
+				for structureName in self.get_referenced_volumes(pasientNr).values()}
+
+		columns = self.get_dose_columns()
+		scope = (columns["objektNr"] == 0) & (columns["stralingNr"] == 0)
+		(group_pasientNr, group_volumID), groups = _group(columns["pasientNr"][scope], columns["referansevolumID"][scope])
+		group_plan = np.bincount(groups, weights=columns["planDose"][scope], minlength=len(group_pasientNr))
+		group_gitt = np.bincount(groups, weights=columns["gittDose"][scope], minlength=len(group_pasientNr))
+
+		# One step per (pasientNr, referansevolumID) group: volumes with the same name
+		# are summed together, as in get_dose_fractions
+		volumes = self._index("referansevolum")
+		for pasientNr, referansevolumID, plan, gitt in zip(group_pasientNr.tolist(), group_volumID.tolist(), group_plan, group_gitt):
+			total = totals[pasientNr][volumes[pasientNr][referansevolumID].referansevolumNavn]
+			total['plan'] += plan
+			total['gitt'] += gitt
+
+		return totals
+
+	def get_all_diagnoses(self) -> dict:
+		return self._for_all(self.get_diagnoses)
+
+	def get_all_prosedyrer(self) -> dict:
+		return self._for_all(self.get_prosedyrer)
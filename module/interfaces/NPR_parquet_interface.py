@@ -0,0 +1,221 @@
+import argparse
+import pathlib
+
+from module.dataclass import NPR_dataclass
+from module.interfaces.NPR_interface import NPRInterface, iter_objektholder
+
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+	pq = None
+
+"""
+Export of NPR reports to normalized Parquet tables, for registry analysis without
+parsing the XML again:
+
+	patients, episodes, diagnoses, procedures, treatment_series,
+	reference_volumes, fractions, dose_contributions
+
+The tables are joined on source (the file) and pasientNr, and then on episodeID,
+serieID and referansevolumID. The code columns (Kodeverk, kodeVerdi, names) are
+dictionary encoded.
+
+	export_parquet("D:/NPR/2025", "D:/NPR/parquet")
+
+	python -m module.interfaces.NPR_parquet_interface D:/NPR/2025 D:/NPR/parquet
+
+Files are streamed one Objektholder at a time (see NPR_interface.iter_objektholder),
+and the rows are written in row groups of ROW_GROUP_SIZE, so a directory of yearly
+deliveries is exported with flat memory.
+
+Needs pyarrow, which is not required by the rest of the exporter: pip install pyarrow
+"""
+
+ROW_GROUP_SIZE = 100_000
+
+class PyarrowMissingException(ImportError):
+	pass
+
+def _require_pyarrow() -> None:
+	if pa is None:
+		raise PyarrowMissingException("The Parquet export of NPR needs pyarrow, install it with: pip install pyarrow")
+
+def _schemas() -> dict:
+	code = pa.dictionary(pa.int32(), pa.string())
+	source = ("source", code)
+	pasientNr = ("pasientNr", pa.int64())
+	episodeID = ("episodeID", pa.string())
+	serieID = ("serieID", pa.int64())
+	kode = [("kodeNr", pa.int32()), ("Kodeverk", code), ("kodeVersjon", pa.int32()), ("kodeVerdi", code)]
+
+	return {
+		"patients": pa.schema([source, pasientNr,
+			("pasientGUID", pa.string()), ("kjonn", pa.int32()), ("fodselsar", pa.int32()), ("fodselsvekt", pa.int32())]),
+		"episodes": pa.schema([source, pasientNr, episodeID, serieID,
+			("innDatoTid", pa.timestamp("s")), ("utDatoTid", pa.timestamp("s")), ("omsorgsniva", pa.int32()),
+			("innmateHast", pa.int32()), ("inntilstand", pa.int32()), ("utTilstand", pa.int32()),
+			("debitor", pa.int32()), ("komNrHjem", pa.int32())]),
+		"diagnoses": pa.schema([source, pasientNr, episodeID, ("tilstNr", pa.int32())] + kode),
+		"procedures": pa.schema([source, pasientNr, episodeID,
+			("typeTiltak", pa.int32()), ("startDatoTid", pa.timestamp("s")), ("prosNr", pa.int32()), ("tilstNr", pa.int32())] + kode),
+		"treatment_series": pa.schema([source, pasientNr, ("medisinskStralingID", pa.int64()), serieID,
+			("behandlingsserieNavn", code), ("intensjon", pa.int32()), ("nyPasient", pa.int32()), ("datoForste", pa.date32())]),
+		"reference_volumes": pa.schema([source, pasientNr, ("medisinskStralingID", pa.int64()),
+			("referansevolumID", pa.int64()), ("referansevolumNavn", code), ("regionkode", pa.int32()), ("regionNavn", code),
+			("planlagtTotalDose", pa.float64()), ("dosekorreksjon", pa.int32())]),
+		"fractions": pa.schema([source, pasientNr, serieID, episodeID, ("refUtstyr", pa.int64()), ("dato", pa.timestamp("s"))]),
+		"dose_contributions": pa.schema([source, pasientNr, serieID, episodeID, ("refUtstyr", pa.int64()),
+			("referansevolumID", pa.int64()), ("planDose", pa.float64()), ("gittDose", pa.float64())]),
+	}
+
+def _kode_columns(kode: NPR_dataclass.Kode) -> dict:
+	return dict(kodeNr=kode.kodeNr, Kodeverk=kode.Kodeverk, kodeVersjon=kode.kodeVersjon, kodeVerdi=kode.kodeVerdi)
+
+class NPRParquetWriter:
+	"""Writes the rows of Objektholder elements to one Parquet file per table in output_dir"""
+
+	def __init__(self, output_dir, row_group_size: int = ROW_GROUP_SIZE):
+		_require_pyarrow()
+
+		self.output_dir = pathlib.Path(output_dir)
+		self.output_dir.mkdir(parents=True, exist_ok=True)
+		self.row_group_size = row_group_size
+
+		self.schemas = _schemas()
+		self.rows = {table: {name: list() for name in schema.names} for table, schema in self.schemas.items()}
+		self.writers = dict()
+		self.n_rows = dict.fromkeys(self.schemas, 0)
+
+	def _append(self, table: str, **row) -> None:
+		columns = self.rows[table]
+		for name, values in columns.items():
+			values.append(row.get(name))
+
+	def add(self, objekt: NPR_dataclass.Objektholder, source: str = None) -> None:
+		pasient = objekt.Pasient
+		self._append("patients", source=source, pasientNr=objekt.pasientNr, pasientGUID=pasient.pasientGUID,
+			kjonn=pasient.kjonn, fodselsar=pasient.fodselsar, fodselsvekt=pasient.fodselsvekt)
+
+		dates = dict()
+		for episode in objekt.episode:
+			dates[episode.episodeID] = episode.innDatoTid
+			ids = dict(source=source, pasientNr=objekt.pasientNr, episodeID=episode.episodeID)
+
+			self._append("episodes", serieID=episode.serieID, innDatoTid=episode.innDatoTid, utDatoTid=episode.utDatoTid,
+				omsorgsniva=episode.omsorgsniva, innmateHast=episode.innmateHast, inntilstand=episode.inntilstand,
+				utTilstand=episode.utTilstand, debitor=episode.debitor, komNrHjem=episode.komNrHjem, **ids)
+
+			for tilstand in episode.tilstand:
+				for kode in tilstand.kode:
+					self._append("diagnoses", tilstNr=tilstand.tilstNr, **_kode_columns(kode), **ids)
+
+			for tjeneste in episode.tjeneste:
+				for tiltak in tjeneste.tiltak:
+					for prosedyre in tiltak.prosedyre:
+						for kode in prosedyre.kode or ():
+							self._append("procedures", typeTiltak=tiltak.typeTiltak,
+								startDatoTid=tiltak.startDatoTid or tjeneste.startDatoTid,
+								prosNr=prosedyre.prosNr, tilstNr=prosedyre.tilstNr, **_kode_columns(kode), **ids)
+
+		for straling in objekt.medisinskStraling:
+			ids = dict(source=source, pasientNr=objekt.pasientNr, medisinskStralingID=straling.medisinskStralingID)
+
+			for volum in straling.referansevolum:
+				self._append("reference_volumes", referansevolumID=volum.referansevolumID,
+					referansevolumNavn=volum.referansevolumNavn, regionkode=volum.regionkode, regionNavn=volum.regionNavn,
+					planlagtTotalDose=volum.planlagtTotalDose, dosekorreksjon=volum.dosekorreksjon, **ids)
+
+			for serie in straling.behandlingsserie:
+				self._append("treatment_series", serieID=serie.serieID, behandlingsserieNavn=serie.behandlingsserieNavn,
+					intensjon=serie.intensjon, nyPasient=serie.nyPasient, datoForste=serie.datoForste, **ids)
+
+				for fremmote in serie.ApparatFremmote:
+					fremmote_ids = dict(source=source, pasientNr=objekt.pasientNr, serieID=serie.serieID,
+						episodeID=fremmote.episodeID, refUtstyr=fremmote.refUtstyr)
+
+					self._append("fractions", dato=dates.get(fremmote.episodeID), **fremmote_ids)
+					for bidrag in fremmote.doseBidrag:
+						self._append("dose_contributions", referansevolumID=bidrag.referansevolumID,
+							planDose=bidrag.planDose, gittDose=bidrag.gittDose, **fremmote_ids)
+
+		if max(len(columns["source"]) for columns in self.rows.values()) >= self.row_group_size:
+			self.flush()
+
+	def flush(self) -> None:
+		"""Writes the buffered rows of every table as a row group"""
+
+		for table, columns in self.rows.items():
+			n = len(columns["source"])
+			if not n:
+				continue
+
+			schema = self.schemas[table]
+			batch = pa.table({name: pa.array(values, type=schema.field(name).type) for name, values in columns.items()}, schema=schema)
+
+			if table not in self.writers:
+				self.writers[table] = pq.ParquetWriter(self.output_dir / f"{table}.parquet", schema)
+			self.writers[table].write_table(batch)
+
+			self.n_rows[table] += n
+			for values in columns.values():
+				values.clear()
+
+	def close(self) -> dict:
+		"""Writes the remaining rows, and an empty file for the tables without rows. Returns {table: rows}"""
+
+		self.flush()
+
+		for table, schema in self.schemas.items():
+			if table in self.writers:
+				self.writers.pop(table).close()
+			elif not self.n_rows[table]:
+				pq.write_table(schema.empty_table(), self.output_dir / f"{table}.parquet")
+
+		return dict(self.n_rows)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+def _iter_sources(source):
+	"""(Objektholder, source name) of a MsgHead, an NPRInterface, an XML file or a directory of XML files"""
+
+	if isinstance(source, NPR_dataclass.MsgHead):
+		for institusjon in source.Document.RefDoc.Content.Melding.Institusjon:
+			for objekt in institusjon.Objektholder:
+				yield objekt, None
+
+	elif isinstance(source, NPRInterface):
+		name = pathlib.Path(source.path).name if source.path else None
+		for objekt in source.iter_objektholder():
+			yield objekt, name
+
+	else:
+		path = pathlib.Path(source)
+		paths = sorted(path.glob("*.xml")) if path.is_dir() else [path]
+		for xml_path in paths:
+			for objekt in iter_objektholder(xml_path):
+				yield objekt, xml_path.name
+
+def export_parquet(source, output_dir, row_group_size: int = ROW_GROUP_SIZE) -> dict:
+	"""Writes the NPR tables of source (MsgHead, NPRInterface, path of an XML file or of a
+	directory) to output_dir/<table>.parquet. Returns {table: rows}."""
+
+	with NPRParquetWriter(output_dir, row_group_size) as writer:
+		for objekt, name in _iter_sources(source):
+			writer.add(objekt, name)
+
+	return writer.n_rows
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Export of NPR XML reports to Parquet tables")
+	parser.add_argument("source", help="NPR XML file or directory of NPR XML files")
+	parser.add_argument("output", help="Output directory of the Parquet files")
+	args = parser.parse_args()
+
+	for table, n_rows in export_parquet(args.source, args.output).items():
+		print(f"{table}: {n_rows} rows")
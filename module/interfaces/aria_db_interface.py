@@ -11,10 +11,14 @@ from datetime import datetime
 from config import Config
 
 from module.Dataclasses.aria_dataclass import TxRecordsProtonToExport
+from module.Dataclasses.plan_set_dataclass import PlanSet, PatientPlanSet
 
 config = Config()
 logger = logging.getLogger(__name__)
 
+# Rows fetched per round trip when streaming blp_GetTxRecordsProtonToExport
+STREAM_CHUNK_SIZE = 1000
+
 # Aria SQL Interface
 
 def get_sqlalchemy():
@@ -22,43 +26,54 @@ def get_sqlalchemy():
 	engine = create_engine(conn_string)
 	return engine
 
-def blp_GetTxRecordsProtonToExport(from_dt: datetime = None) -> List[TxRecordsProtonToExport]:
+def iter_tx_records_proton_to_export(from_dt: datetime = None, yield_per: int = STREAM_CHUNK_SIZE):
+	"""Yields the rows of blp_GetTxRecordsProtonToExport as mappings, fetched yield_per
+	rows at a time through a server-side cursor instead of loading the whole result."""
+
 	engine_aria = get_sqlalchemy()
 
 	with engine_aria.connect() as conn:
+		conn = conn.execution_options(stream_results=True, yield_per=yield_per)
+
 		if from_dt:
 			result = conn.execute(text("SET NOCOUNT ON; EXEC blp_GetTxRecordsProtonToExport @FromDateTime = :from_datetime"), 
 				{"from_datetime": from_dt.strftime("%Y%m%d")})
 		else:
 			result = conn.execute(text("SET NOCOUNT ON; EXEC blp_GetTxRecordsProtonToExport"))
-		rows = result.mappings().all()
-
-		return [TxRecordsProtonToExport(**dict(row)) for row in rows]
-
-def get_plan_set(from_dt: datetime):
-	rtrecords = blp_GetTxRecordsProtonToExport(from_dt)
-	plan_set = dict()
-
-	for rtrecord in rtrecords:
-		if not rtrecord.PatientSer in plan_set:
-			plan_set[rtrecord.PatientSer] = {
-				"PatientID": None,
-				"PlanSet": dict(),
-			}
-		
-
-		if rtrecord.PlanUID not in plan_set[rtrecord.PatientSer]["PlanSet"]:
-			plan_set[rtrecord.PatientSer]["PlanSet"][rtrecord.PlanUID] = {
-				"RTPlanLabel": str(),
-				"RTDOSE": set(),
-				"RTRECORD": set(),
-				"RTSTRUCT": set(),
-				"RTPLAN": set(),
-				"CT": set()
-			}
-		
-		plan_set[rtrecord.PatientSer]["PlanSet"][rtrecord.PlanUID]["RTPLAN"].add(rtrecord.PlanUID)
-		plan_set[rtrecord.PatientSer]["PlanSet"][rtrecord.PlanUID]["RTRECORD"].add(rtrecord.TreatmentRecordUID)
-		plan_set[rtrecord.PatientSer]["PlanSet"][rtrecord.PlanUID]["RTDOSE"].add(rtrecord.DoseUID)
-
-	return plan_set
\ No newline at end of file
+
+		for row in result.mappings():
+			yield row
+
+def blp_GetTxRecordsProtonToExport(from_dt: datetime = None) -> List[TxRecordsProtonToExport]:
+	return [TxRecordsProtonToExport(**dict(row)) for row in iter_tx_records_proton_to_export(from_dt)]
+
+def iter_patient_plan_sets(from_dt: datetime):
+	"""Yields (PatientSer, PatientPlanSet) as soon as all rows of a patient have arrived,
+	relying on the rows of a patient being consecutive in the result.
+	If a patient shows up again later, the new rows are yielded as a second plan set
+	for the same patient, which the caller merges (PatientPlanSet.merge) with the first
+	and must not export concurrently with it."""
+
+	patient_ser = None
+	patient_entry = None
+
+	for row in iter_tx_records_proton_to_export(from_dt):
+		if row["PatientSer"] != patient_ser:
+			if patient_entry is not None:
+				yield patient_ser, patient_entry
+
+			patient_ser = row["PatientSer"]
+			patient_entry = PatientPlanSet(patient_ser)
+
+		patient_entry.add_tx_record(row)
+
+	if patient_entry is not None:
+		yield patient_ser, patient_entry
+
+def get_plan_set(from_dt: datetime) -> PlanSet:
+	plan_set = PlanSet()
+
+	for row in iter_tx_records_proton_to_export(from_dt):
+		plan_set.patient(row["PatientSer"]).add_tx_record(row)
+
+	return plan_set
@@ -29,6 +29,10 @@ from config import Config
 from module.Interfaces import (
 	aria_db_interface,
 )
+from module.utils import association_pool, move_executor
+from module.utils.move_executor import MoveResult, move_identifier
+from module.utils.transfer_planner import AriaInventory, MoveRequest
+from module.Dataclasses.plan_set_dataclass import intern_uid
 
 # debug_logger()
 
@@ -38,54 +42,34 @@ config = Config()
 engine = create_engine(config.aria.sql.uri)
 
 def get_assoc():
-	ae = AE(ae_title=config.conquest_aria.dicom.aet)
-	ae.add_requested_context(PatientRootQueryRetrieveInformationModelMove)
-	ae.add_requested_context(PatientRootQueryRetrieveInformationModelFind)
+	"""New, unpooled association to ARIA. The exporter uses association_pool.association("aria")."""
+	return association_pool.get_pool("aria").connect()
 
-	assoc = ae.associate(
-		config.aria.dicom.server,
-		config.aria.dicom.port,
-		ae_title=config.aria.dicom.aet
-	)
+def c_move_request(association, request: MoveRequest, progress=None) -> MoveResult:
+	"""C-MOVE of a planned request to conquest_aria. progress gets the Pending updates."""
 
-	if not assoc.is_established:
-		raise RuntimeError("Association to ARIA failed")
+	result = move_executor.c_move(association, move_identifier(request), config.conquest_aria.dicom.aet, request, progress)
 
-	return assoc
+	if result.error:
+		print("[GET] Connection timed out")
 
-def c_move_image(association, uid):
-	ds = Dataset()
-	ds.QueryRetrieveLevel = "IMAGE"
-	ds.SOPInstanceUID = uid
+	return result
 
-	responses = association.send_c_move(
-		ds,
-		move_aet=config.conquest_aria.dicom.aet,
-		query_model=PatientRootQueryRetrieveInformationModelMove
-	)
+def c_move_requests(requests: list, progress=None, move_aet: str = None, on_result=None) -> list:
+	"""C-MOVE of the planned requests to move_aet (default conquest_aria), run concurrently
+	on up to aria.dicom.max_associations pooled associations. Failed requests are retried
+	with backoff, on_result(result) is called for every attempt. Returns the MoveResults in order."""
 
-	for status, identifier in responses:
-		if status:
-			pass
-		else:
-			print("[GET] Connection timed out")
+	move_aet = move_aet or config.conquest_aria.dicom.aet
 
-def c_move_series(association, uid):
-	ds = Dataset()
-	ds.QueryRetrieveLevel = "SERIES"
-	ds.SeriesInstanceUID = uid
+	with move_executor.MoveExecutor("aria", move_aet, progress=progress) as executor:
+		return executor.map_retry([(request, move_identifier(request)) for request in requests], on_result=on_result)
 
-	responses = association.send_c_move(
-		ds,
-		move_aet=config.conquest_aria.dicom.aet,
-		query_model=PatientRootQueryRetrieveInformationModelMove
-	)
+def c_move_image(association, uid, progress=None) -> MoveResult:
+	return c_move_request(association, MoveRequest("IMAGE", [uid], 1, "single UID"), progress)
 
-	for status, identifier in responses:
-		if status:
-			pass
-		else:
-			print("[GET] Connection timed out")
+def c_move_series(association, uid, progress=None) -> MoveResult:
+	return c_move_request(association, MoveRequest("SERIES", [uid], 0, "series"), progress)
 
 def c_find_study(association, uid):
 	ds = Dataset()
@@ -93,6 +77,7 @@ def c_find_study(association, uid):
 	ds.StudyInstanceUID = uid
 	ds.SeriesInstanceUID = ""
 	ds.Modality = ""
+	ds.NumberOfSeriesRelatedInstances = ""
 
 	result = list()
 
@@ -105,10 +90,106 @@ def c_find_study(association, uid):
 				"SeriesInstanceUID": identifier.get("SeriesInstanceUID"),
 				"StudyInstanceUID": identifier.get("StudyInstanceUID"),
 				"Modality": identifier.get("Modality"),
+				"NumberOfSeriesRelatedInstances": identifier.get("NumberOfSeriesRelatedInstances"),
 			})
 
 	return result
 
+def _c_find_locations(association, level: str, key: str, uids: list, inventory: AriaInventory):
+	ds = Dataset()
+	ds.QueryRetrieveLevel = level
+	setattr(ds, key, uids if len(uids) > 1 else uids[0])
+	ds.PatientID = ""
+	ds.StudyInstanceUID = ""
+	ds.SeriesInstanceUID = ""
+
+	responses = association.send_c_find(ds, PatientRootQueryRetrieveInformationModelFind)
+
+	for status, identifier in responses:
+		if status and status.Status in (0xFF00, 0xFF01):
+			study_uid = intern_uid(identifier.get("StudyInstanceUID"))
+			series_uid = intern_uid(identifier.get("SeriesInstanceUID"))
+
+			inventory.patient_id = inventory.patient_id or identifier.get("PatientID") or None
+			if series_uid and study_uid:
+				inventory.series_study[series_uid] = study_uid
+			if level == "IMAGE" and identifier.get("SOPInstanceUID"):
+				inventory.sop_locations[intern_uid(identifier.SOPInstanceUID)] = (study_uid, series_uid)
+
+def find_inventory(association, sop_uids=(), series_uids=(), multi_uid: bool = False, max_uids: int = 100) -> AriaInventory:
+	"""Where the given SOP Instances / Series are in ARIA, and the number of instances
+	of every series in their studies. Used by the transfer planner to choose between
+	IMAGE, SERIES and STUDY level C-MOVE."""
+
+	inventory = AriaInventory()
+	step = max_uids if multi_uid else 1
+
+	sop_uids = sorted(sop_uids)
+	for i in range(0, len(sop_uids), step):
+		_c_find_locations(association, "IMAGE", "SOPInstanceUID", sop_uids[i:i + step], inventory)
+
+	series_uids = sorted(series_uids)
+	for i in range(0, len(series_uids), step):
+		_c_find_locations(association, "SERIES", "SeriesInstanceUID", series_uids[i:i + step], inventory)
+
+	for study_uid in set(inventory.series_study.values()):
+		for series in c_find_study(association, study_uid):
+			series_uid = intern_uid(series["SeriesInstanceUID"])
+			if not series_uid:
+				continue
+			inventory.series_study[series_uid] = study_uid
+			if series["NumberOfSeriesRelatedInstances"] is not None:
+				inventory.series_counts[series_uid] = int(series["NumberOfSeriesRelatedInstances"])
+
+	return inventory
+
+def find_series_instances(association, series_uid) -> set:
+	"""SOP Instance UIDs of the series in ARIA (C-FIND at IMAGE level)"""
+
+	ds = Dataset()
+	ds.QueryRetrieveLevel = "IMAGE"
+	ds.SeriesInstanceUID = series_uid
+	ds.SOPInstanceUID = ""
+
+	sop_uids = set()
+	responses = association.send_c_find(ds, PatientRootQueryRetrieveInformationModelFind)
+
+	for status, identifier in responses:
+		if status and status.Status in (0xFF00, 0xFF01) and identifier.get("SOPInstanceUID"):
+			sop_uids.add(intern_uid(identifier.SOPInstanceUID))
+
+	return sop_uids
+
+def find_series_instance_counts(association, series_uids, multi_uid: bool = False, max_uids: int = 100) -> dict:
+	"""{Series Instance UID: number of instances in ARIA}, from NumberOfSeriesRelatedInstances.
+	The series for which ARIA does not return the count are counted at IMAGE level."""
+
+	counts = dict()
+	step = max_uids if multi_uid else 1
+	series_uids = sorted(series_uids)
+
+	for i in range(0, len(series_uids), step):
+		chunk = series_uids[i:i + step]
+
+		ds = Dataset()
+		ds.QueryRetrieveLevel = "SERIES"
+		ds.SeriesInstanceUID = chunk if len(chunk) > 1 else chunk[0]
+		ds.NumberOfSeriesRelatedInstances = ""
+
+		responses = association.send_c_find(ds, PatientRootQueryRetrieveInformationModelFind)
+
+		for status, identifier in responses:
+			if status and status.Status in (0xFF00, 0xFF01):
+				n_instances = identifier.get("NumberOfSeriesRelatedInstances")
+				if identifier.get("SeriesInstanceUID") and n_instances not in (None, ""):
+					counts[intern_uid(identifier.SeriesInstanceUID)] = int(n_instances)
+
+	for series_uid in series_uids:
+		if series_uid not in counts:
+			counts[series_uid] = len(find_series_instances(association, series_uid))
+
+	return counts
+
 def get_study_uid_from_plan_sop_uid(association, plan_sop_uid):
 	ds = Dataset()
 	ds.QueryRetrieveLevel = "IMAGE"
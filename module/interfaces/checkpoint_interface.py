@@ -0,0 +1,113 @@
+import datetime
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+from config import Config
+
+config = Config()
+logger = logging.getLogger(__name__)
+
+"""
+Append-only journal of confirmed transfers, one JSON line per UID and stage:
+
+	{"dt": "...", "patient_ser": 123, "stage": "krest", "uid": "1.2.3..."}
+
+Every confirm() is flushed and fsync'ed before it returns, so the journal survives
+a crash in the middle of a run. On the next run the confirmed UIDs are loaded
+and the transfers they cover are skipped.
+
+Stages:
+	conquest_krest	The object is stored in Conquest (Medfys-2)
+	krest			The object was part of a successful C-MOVE to KREST
+"""
+
+STAGES = ("conquest_krest", "krest")
+
+class CheckpointJournal:
+	def __init__(self, path: str = None):
+		self.path = path if path is not None else config.export.checkpoint_file
+		self.lock = threading.Lock()
+		self.confirmed = {stage: set() for stage in STAGES}
+
+		if self.path:
+			Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+			self.repair()
+			self.load()
+
+	def repair(self) -> None:
+		"""Truncates a last line cut off by a crash during the write, so that the next
+		confirm() is not appended to it. The cut off entry was never confirmed."""
+
+		if not os.path.exists(self.path):
+			return
+
+		with open(self.path, "rb+") as journal_file:
+			size = journal_file.seek(0, os.SEEK_END)
+			if not size:
+				return
+
+			journal_file.seek(size - 1)
+			if journal_file.read(1) == b"\n":
+				return
+
+			# Search backwards for the end of the last complete line
+			end = size
+			while end > 0:
+				start = max(0, end - 65536)
+				journal_file.seek(start)
+				newline = journal_file.read(end - start).rfind(b"\n")
+				if newline >= 0:
+					end = start + newline + 1
+					break
+				end = start
+
+			logger.warning(f"Truncating the incomplete last line of {self.path} ({size - end} bytes)")
+			journal_file.truncate(end)
+			journal_file.flush()
+			os.fsync(journal_file.fileno())
+
+	def load(self) -> None:
+		if not os.path.exists(self.path):
+			return
+
+		n_lines = 0
+		with open(self.path, "r", encoding="utf-8") as input_file:
+			for line in input_file:
+				try:
+					entry = json.loads(line)
+				except json.JSONDecodeError:
+					# Last line may be cut off by a crash during the write
+					logger.warning(f"Skipping unreadable line in {self.path}")
+					continue
+
+				self.confirmed.setdefault(entry["stage"], set()).add(entry["uid"])
+				n_lines += 1
+
+		print(f"Found {n_lines} checkpoints in {self.path}.")
+
+	def confirm(self, patient_ser, stage: str, uids) -> None:
+		with self.lock:
+			uids = set(uids) - self.confirmed[stage]
+			if not uids:
+				return
+
+			if self.path:
+				dt = datetime.datetime.now().isoformat()
+				with open(self.path, "a", encoding="utf-8") as output_file:
+					for uid in uids:
+						output_file.write(json.dumps({"dt": dt, "patient_ser": patient_ser, "stage": stage, "uid": uid}) + "\n")
+					output_file.flush()
+					os.fsync(output_file.fileno())
+
+			self.confirmed[stage].update(uids)
+
+	def is_confirmed(self, stage: str, uid: str) -> bool:
+		return uid in self.confirmed[stage]
+
+	def missing(self, stage: str, uids) -> set:
+		"""The UIDs not yet confirmed at stage."""
+		with self.lock:
+			return set(uids) - self.confirmed[stage]
@@ -3,7 +3,7 @@ import logging
 from configparser import ConfigParser
 import shlex
 import subprocess
-from sqlmodel import Session, create_engine, select
+from sqlmodel import Session, create_engine, select, func
 import pydicom
 
 
@@ -18,23 +18,31 @@ from sqlmodel import select
 from config import Config
 from pathlib import Path
 
+from module.Interfaces.reference_cache_interface import ReferenceCache
+from module.Dataclasses.plan_set_dataclass import intern_uids
+
 config = Config()
 
+reference_cache = ReferenceCache() if config.export.reference_cache else None
+
 logger = logging.getLogger(__name__ + f" (config.HF)")
 
-# Conquest SQL Interface | Datamodel
+# Max number of UIDs per IN (...) list. Kept well below the parameter limits of
+# MySQL / MSSQL (2100 parameters per statement for the latter)
+EXISTS_CHUNK_SIZE = 500
 
-def get_patient_ids(engine):
-	patient_ids = list()
+# Only the reference sequences are parsed from the RT objects
+PLAN_REFERENCE_TAGS = ["RTPlanLabel", "ReferencedStructureSetSequence"]
+STRUCT_REFERENCE_TAGS = ["ReferencedFrameOfReferenceSequence"]
+DOSE_REFERENCE_TAGS = ["ReferencedRTPlanSequence"]
 
-	with Session(engine) as session:
-		statement = select(DICOMPatients)
-		results = session.exec(statement).all()
+# Conquest SQL Interface | Datamodel
 
-		for result in results:
-			patient_ids.append(result.PatientID)
+def get_patient_ids(engine) -> set:
+	"""All PatientIDs in Conquest. The exporter uses inventory_interface.SqlInventory."""
 
-	return patient_ids
+	with Session(engine) as session:
+		return set(session.exec(select(DICOMPatients.PatientID)).all())
 
 def check_rtdose_beam_or_plansum(engine, rtdose_series_uid_list):
 	rtdose_files = list()
@@ -61,26 +69,168 @@ def check_rtdose_beam_or_plansum(engine, rtdose_series_uid_list):
 
 	return rtdose_output
 
-def get_rt_struct_uid(engine, plan_sop_uid):
+def get_object_files(engine, uids, root_dir: str = None) -> dict:
+	"""Returns {SOP Instance UID: path to the DICOM file} for the UIDs found in DICOMImages,
+	using the same chunked IN (...) queries as get_existing_sops. root_dir is the data
+	folder of the Conquest node behind engine (default conquest_aria)."""
+
+	root_dir = root_dir or config.conquest_aria.root_dir
+	object_files = dict()
+	uids = {uid for uid in uids if uid}
+	if not uids:
+		return object_files
+
 	with Session(engine) as session:
-		statement = select(DICOMImages).where(DICOMImages.SOPInstanceUID == plan_sop_uid)
-		result = session.exec(statement)
-		try:
-			ds_path = config.conquest_aria.root_dir + result.one().ObjectFile
-		except Exception as e:
-			print("Cannot find structure files! ", e)
-			return list()
-
-	ds = pydicom.dcmread(ds_path)
-	structure_sets = list()
-	for seq in ds.ReferencedStructureSetSequence:
-		structure_sets.append(seq.ReferencedSOPInstanceUID)
-	
+		for chunk in _chunks(uids):
+			statement = select(DICOMImages.SOPInstanceUID, DICOMImages.ObjectFile).where(DICOMImages.SOPInstanceUID.in_(chunk))
+			for sop_uid, object_file in session.exec(statement).all():
+				object_files[sop_uid] = root_dir + object_file
+
+	return object_files
+
+def get_series_object_files(engine, series_uids, root_dir: str = None) -> dict:
+	"""Returns {Series Instance UID: {SOP Instance UID: path to the DICOM file}}"""
+
+	root_dir = root_dir or config.conquest_aria.root_dir
+	series_files = dict()
+	series_uids = {uid for uid in series_uids if uid}
+	if not series_uids:
+		return series_files
+
+	with Session(engine) as session:
+		for chunk in _chunks(series_uids):
+			statement = select(DICOMImages.SeriesInst, DICOMImages.SOPInstanceUID, DICOMImages.ObjectFile).where(DICOMImages.SeriesInst.in_(chunk))
+			for series_uid, sop_uid, object_file in session.exec(statement).all():
+				series_files.setdefault(series_uid, dict())[sop_uid] = root_dir + object_file
+
+	return series_files
+
+def read_plan_references(ds_path) -> tuple:
+	"""Referenced structure set SOP UIDs and the RTPlanLabel of an RT Plan file."""
+
+	ds = pydicom.dcmread(ds_path, stop_before_pixels=True, specific_tags=PLAN_REFERENCE_TAGS)
+	structure_sets = [seq.ReferencedSOPInstanceUID for seq in ds.get("ReferencedStructureSetSequence", [])]
+
 	if len(structure_sets) != 1:
 		print(f"-----------  {len(structure_sets) = } --------- ")
 
 	return structure_sets, ds.get("RTPlanLabel")
 
+def read_struct_references(ds_path) -> set:
+	"""Referenced CT Series Instance UIDs of an RT Struct file."""
+
+	ds = pydicom.dcmread(ds_path, stop_before_pixels=True, specific_tags=STRUCT_REFERENCE_TAGS)
+	ct_series_uid = set()
+	for ref_frame_of_reference_seq in ds.get("ReferencedFrameOfReferenceSequence", []):
+		for rt_ref_study_seq in ref_frame_of_reference_seq.get("RTReferencedStudySequence", []):
+			for rt_ref_series_seq in rt_ref_study_seq.get("RTReferencedSeriesSequence", []):
+				ct_series_uid.add(rt_ref_series_seq.SeriesInstanceUID)
+
+	if len(ct_series_uid) != 1:
+		print(f"-----------  {len(ct_series_uid) = } --------- ")
+
+	return ct_series_uid
+
+def read_dose_references(ds_path) -> list:
+	"""Referenced RT Plan SOP UIDs of an RT Dose file."""
+
+	ds = pydicom.dcmread(ds_path, stop_before_pixels=True, specific_tags=DOSE_REFERENCE_TAGS)
+	plan_uid = [seq.ReferencedSOPInstanceUID for seq in ds.get("ReferencedRTPlanSequence", [])]
+
+	if len(plan_uid) != 1:
+		print(f"-----------  {len(plan_uid) = } --------- ")
+
+	return plan_uid
+
+def read_references(object_files: dict, reader) -> dict:
+	"""Returns {SOP UID: (references, RTPlanLabel)} for the files in object_files {SOP UID: path}.
+	reader(path) parses a single file. The persistent reference cache is checked first,
+	so only new or changed files are read."""
+
+	references = reference_cache.get_many(object_files) if reference_cache else dict()
+	parsed = dict()
+
+	for uid, ds_path in object_files.items():
+		if uid in references:
+			continue
+
+		try:
+			parsed[uid] = reader(ds_path)
+		except Exception as e:
+			print(f"Cannot read DICOM file for {uid}: ", e)
+
+	if parsed and reference_cache:
+		reference_cache.put_many(object_files, parsed)
+
+	references.update(parsed)
+	return references
+
+def _object_files(engine, uids, arrivals=None) -> dict:
+	object_files = arrivals.files(uids) if arrivals else dict()
+	object_files.update(get_object_files(engine, set(uids) - object_files.keys()))
+	return object_files
+
+def resolve_rt_structs(engine, plan_set, arrivals=None) -> set:
+	"""Fills rtstruct and label for every plan in plan_set (a PlanSet, as returned by
+	aria_db_interface.get_plan_set) whose RT Plan file is found in Conquest, or in
+	arrivals (the ArrivalIndex of the storage SCP).
+	Returns the set of all referenced structure set SOP UIDs."""
+
+	plan_nodes = dict()
+	for patient in plan_set.values():
+		plan_nodes.update(patient.plans)
+
+	structure_set_uids = set()
+	object_files = _object_files(engine, plan_nodes, arrivals)
+
+	for plan_uid, (structure_sets, plan_label) in read_references(object_files, read_plan_references).items():
+		plan_nodes[plan_uid].rtstruct.update(intern_uids(structure_sets))
+		plan_nodes[plan_uid].label = plan_label or str()
+		structure_set_uids.update(structure_sets)
+
+	return structure_set_uids
+
+def resolve_ct_series(engine, plan_set, arrivals=None) -> set:
+	"""Fills ct for every plan in plan_set from the structure sets already resolved by
+	resolve_rt_structs, for the structure sets that are found in Conquest.
+	Returns the set of all referenced CT Series Instance UIDs."""
+
+	struct_plans = dict()
+	for patient in plan_set.values():
+		for plan in patient.plans.values():
+			for struct_uid in plan.rtstruct:
+				struct_plans.setdefault(struct_uid, list()).append(plan)
+
+	ct_series_uids = set()
+	object_files = _object_files(engine, struct_plans, arrivals)
+
+	references = read_references(object_files, lambda ds_path: (read_struct_references(ds_path), None))
+
+	for struct_uid, (series_uids, _) in references.items():
+		series_uids = intern_uids(series_uids)
+		for plan in struct_plans[struct_uid]:
+			plan.ct.update(series_uids)
+		ct_series_uids.update(series_uids)
+
+	return ct_series_uids
+
+def resolve_plan_set(engine, plan_set, arrivals=None):
+	"""Fills the rtstruct / ct / label graph of the whole plan_set: one ObjectFile
+	query per level, and only the reference sequences are read from the files."""
+
+	resolve_rt_structs(engine, plan_set, arrivals)
+	resolve_ct_series(engine, plan_set, arrivals)
+
+	return plan_set
+
+def get_rt_struct_uid(engine, plan_sop_uid):
+	object_files = get_object_files(engine, [plan_sop_uid])
+	if not object_files:
+		print("Cannot find structure files! ", plan_sop_uid)
+		return list(), None
+
+	return read_references(object_files, read_plan_references).get(plan_sop_uid, (list(), None))
+
 
 def get_patient_id_from_plan_sop_uid(engine, plan_sop_uid: str) -> str:
 	with Session(engine) as session:
@@ -94,62 +244,92 @@ def get_patient_id_from_plan_sop_uid(engine, plan_sop_uid: str) -> str:
 
 
 def find_referenced_ct_series(engine, rtstruct_instance_uid):
-	with Session(engine) as session:
-		statement = select(DICOMImages).where(DICOMImages.SOPInstanceUID == rtstruct_instance_uid)
-		result = session.exec(statement)
-		try:
-			ds_path = config.conquest_aria.root_dir + result.one().ObjectFile
-		except Exception as e:
-			print("Cannot find CT series: ", e)
-			return None
+	object_files = get_object_files(engine, [rtstruct_instance_uid])
+	if not object_files:
+		print("Cannot find CT series: ", rtstruct_instance_uid)
+		return None
 
-	ct_series_uid = set()
-	ds = pydicom.dcmread(ds_path)
-	for ref_frame_of_reference_seq in ds.ReferencedFrameOfReferenceSequence:
-		for rt_ref_study_seq in ref_frame_of_reference_seq.RTReferencedStudySequence:
-			for rt_ref_series_seq in rt_ref_study_seq.RTReferencedSeriesSequence:
-				ct_series_uid.add(rt_ref_series_seq.SeriesInstanceUID)
+	references = read_references(object_files, lambda ds_path: (read_struct_references(ds_path), None))
+	return set(references.get(rtstruct_instance_uid, (set(), None))[0])
 
-	
-	if len(ct_series_uid) != 1:
-		print(f"-----------  {len(ct_series_uid) = } --------- ")
+def find_referenced_plan_uids_from_rt_dose(engine, rt_dose_series_uids) -> dict:
+	"""Returns {RT Dose Series Instance UID: [referenced RT Plan SOP UIDs]}"""
 
-	return ct_series_uid
+	dose_files = dict()
+	dose_series = dict()
+	rt_dose_series_uids = {uid for uid in rt_dose_series_uids if uid}
 
-def find_referenced_plan_uid_from_rt_dose_sql(engine, rt_dose_uid):
 	with Session(engine) as session:
-		statement = select(DICOMImages).where(DICOMImages.SeriesInst == rt_dose_uid)
-		result = session.exec(statement)
-		try:
-			ds_path = config.conquest_aria.root_dir + result.one().ObjectFile
-		except:
-			return list()
+		for chunk in _chunks(rt_dose_series_uids):
+			statement = select(DICOMImages.SeriesInst, DICOMImages.SOPInstanceUID, DICOMImages.ObjectFile).where(DICOMImages.SeriesInst.in_(chunk))
+			for series_uid, sop_uid, object_file in session.exec(statement).all():
+				dose_files[sop_uid] = config.conquest_aria.root_dir + object_file
+				dose_series[sop_uid] = series_uid
 
-	plan_uid = list()
+	references = read_references(dose_files, lambda ds_path: (read_dose_references(ds_path), None))
 
-	ds = pydicom.dcmread(ds_path, stop_before_pixels=True)
-	for seq in ds.ReferencedRTPlanSequence:
-		plan_uid.append(seq.ReferencedSOPInstanceUID)
+	return {dose_series[sop_uid]: list(plan_uids) for sop_uid, (plan_uids, _) in references.items()}
 
-	if len(plan_uid) != 1:
-		print(f"-----------  {len(plan_uid) = } --------- ")
+def find_referenced_plan_uid_from_rt_dose_sql(engine, rt_dose_uid):
+	return find_referenced_plan_uids_from_rt_dose(engine, [rt_dose_uid]).get(rt_dose_uid, list())
 
-	return plan_uid
+def _chunks(uids, size=EXISTS_CHUNK_SIZE):
+	uids = list(uids)
+	for i in range(0, len(uids), size):
+		yield uids[i:i + size]
+
+def get_existing_sops(engine, uids) -> set:
+	"""Returns the subset of the SOP Instance UIDs that are found in DICOMImages.
+	The UIDs are queried in chunks of IN (...) lists, one round trip per chunk."""
+
+	existing = set()
+	uids = {uid for uid in uids if uid}
+	if not uids:
+		return existing
 
-def check_exists_sop(engine, uid):
 	with Session(engine) as session:
-		statement = select(DICOMImages).where(DICOMImages.SOPInstanceUID == uid)
-		result = session.exec(statement)
-		if result.first() is not None:
-			return True
-	
-	return False
-
-def check_exists_series(engine, uid):	
+		for chunk in _chunks(uids):
+			statement = select(DICOMImages.SOPInstanceUID).where(DICOMImages.SOPInstanceUID.in_(chunk))
+			existing.update(session.exec(statement).all())
+
+	return existing
+
+def get_existing_series(engine, uids) -> set:
+	"""Returns the subset of the Series Instance UIDs that are found in DICOMSeries."""
+
+	existing = set()
+	uids = {uid for uid in uids if uid}
+	if not uids:
+		return existing
+
 	with Session(engine) as session:
-		statement = select(DICOMSeries).where(DICOMSeries.SeriesInstanceUID == uid)
-		result = session.exec(statement)
-		if result.first() is not None:
-			return True
-	
-	return False
+		for chunk in _chunks(uids):
+			statement = select(DICOMSeries.SeriesInstanceUID).where(DICOMSeries.SeriesInstanceUID.in_(chunk))
+			existing.update(session.exec(statement).all())
+
+	return existing
+
+def get_series_instance_counts(engine, uids) -> dict:
+	"""Returns {Series Instance UID: number of rows in DICOMImages} of the series found.
+	A series that is only partially received has fewer rows than the source holds."""
+
+	counts = dict()
+	uids = {uid for uid in uids if uid}
+	if not uids:
+		return counts
+
+	with Session(engine) as session:
+		for chunk in _chunks(uids):
+			statement = select(DICOMImages.SeriesInst, func.count()).where(DICOMImages.SeriesInst.in_(chunk)).group_by(DICOMImages.SeriesInst)
+			counts.update(session.exec(statement).all())
+
+	return counts
+
+def check_exists_sop(engine, uid):
+	return uid in get_existing_sops(engine, [uid])
+
+def check_exists_series(engine, uid, expected: int = None):
+	"""The series is found, with at least expected instances if given"""
+	if expected is None:
+		return uid in get_existing_series(engine, [uid])
+	return get_series_instance_counts(engine, [uid]).get(uid, 0) >= expected
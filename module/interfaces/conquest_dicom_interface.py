@@ -1,3 +1,5 @@
+import logging
+
 from pynetdicom import AE, evt, build_role
 from pynetdicom.sop_class import (
 	PatientRootQueryRetrieveInformationModelGet,
@@ -8,76 +10,190 @@ from pynetdicom.sop_class import (
 )
 from pydicom.dataset import Dataset
 from module.Interfaces import conquest_db_interface
+from module.utils import association_pool, move_executor, transfer_scheduler, transfer_syntax
+from module.utils.transfer_planner import MoveRequest
 
 from config import Config
 
 config = Config()
+logger = logging.getLogger(__name__)
 
-def c_move_to_krest_hus(patient_id):
-	this_ae = AE(ae_title="PYTHON")
-	this_ae.add_requested_context(PatientRootQueryRetrieveInformationModelMove)
-
-	assoc = this_ae.associate(
-		config.conquest_krest.dicom.server,
-        config.conquest_krest.dicom.port,
-        ae_title=config.conquest_krest.dicom.aet
-	)
+def c_move_to_krest_hus(patient_id, n_objects: int = 1) -> bool:
+	"""Moves the whole patient from Conquest (Medfys-2) to KREST.
+	n_objects is the estimated size of the patient, charged to the transfer windows of
+	conquest_krest together with the objects moved beyond it.
+	Returns True if all sub-operations succeeded."""
 
-	if not assoc.is_established:
-		raise RuntimeError(f"Association to {config.conquest_krest.dicom.aet} failed")
-
-	# Send SOP Series UID for CT
-	# Send SOP Instance UID for all others
+	# An empty PatientID is a universal match
+	if not patient_id:
+		raise ValueError("C-MOVE to KREST needs a PatientID")
 
 	ds = Dataset()
 	ds.QueryRetrieveLevel = "PATIENT"
 	ds.PatientID = patient_id
 
-	responses = assoc.send_c_move(
-		ds,
-		move_aet=config.krest.dicom.aet,
-		query_model=PatientRootQueryRetrieveInformationModelMove
-	)
+	n_objects = max(1, n_objects)
+	with transfer_scheduler.slot("conquest_krest", n_objects), association_pool.association("conquest_krest") as assoc:
+		result = move_executor.c_move(assoc, ds, config.krest.dicom.aet, f"Patient {patient_id}")
+
+	transfer_scheduler.debit("conquest_krest", result.completed + result.failed + result.warning - n_objects)
+
+	print(f"- {result}")
+	return result.succeeded
+
+def c_store_files(peer: str, object_files: dict) -> set:
+	"""C-STORE of the files {SOP Instance UID: path} to the peer, on one pooled association.
+	The files are sent as stored, without being decoded, unless a preferred transfer syntax
+	of the peer was accepted (see transfer_syntax). Returns the stored UIDs, a file that
+	cannot be sent is logged and left out."""
+
+	stored = set()
+	pool = association_pool.get_pool(peer)
+
+	with pool.association() as assoc:
+		for uid, path in object_files.items():
+			# A file the peer has no accepted context for (SOP class or transfer syntax)
+			# is left out, and the rest of the batch is sent
+			try:
+				with transfer_scheduler.slot(peer):
+					status = assoc.send_c_store(transfer_syntax.prepare_for_store(assoc, path, pool.transfer_syntaxes))
+			except (ValueError, OSError) as e:
+				logger.warning(f"C-STORE of {uid} ({path}) to {peer} failed: {e}")
+				print(f"- C-STORE of {uid} to {peer} failed: {e}")
+				if not assoc.is_established:
+					break
+				continue
 
-	assoc.release()
+			if status and status.Status in (0x0000, 0xB000, 0xB007, 0xB006):
+				stored.add(uid)
+			else:
+				print(f"- C-STORE of {uid} to {peer} failed: {status.Status if status else 'no response'}")
 
-def c_move_to_medfys2(engine, plan_set):
-	this_ae = AE(ae_title="PYTHON")
-	this_ae.add_requested_context(PatientRootQueryRetrieveInformationModelMove)
+	return stored
 
-	assoc = this_ae.associate(
-		config.conquest_aria.dicom.server,
-        config.conquest_aria.dicom.port,
-        ae_title=config.conquest_aria.dicom.aet
-	)
+def c_move_to_medfys2(engine, patient, checkpoints=None, arrivals=None, inventory=None, on_result=None,
+		files_nb: dict = None, source_engine=None) -> set:
+	"""Moves the objects of a patient's PatientPlanSet that are missing in Conquest (Medfys-2)
+	from Conquest (Medfys-1). Returns the UIDs that are stored in Medfys-2 afterwards.
+	UIDs already confirmed in checkpoints are neither looked up nor moved again,
+	and every successful move is confirmed there. Objects received by the storage SCP
+	(arrivals) are sent with C-STORE from its storage instead. Series found in the
+	inventory of Medfys-2 are not looked up in SQL. Failed moves are retried, on_result(result)
+	is called for every attempt, and a RuntimeError is raised if moves still fail.
 
-	if not assoc.is_established:
-		raise RuntimeError(f"Association to {config.conquest_aria.dicom.aet} failed")
+	The CT series with a verified instance count (files_nb, {Series Instance UID: count}) are
+	counted in Medfys-2 on every call, and only count as stored with all their instances.
+	The instances missing from a partially stored series are sent one by one, looked up in
+	Medfys-1 (source_engine) and in arrivals, and are returned as stored as well."""
 
 	# Send SOP Series UID for CT
 	# Send SOP Instance UID for all others
 
-	for plan_uid, plan_set in plan_set["PlanSet"].items():
-		for modality, uid_set in plan_set.items():
-			if modality == "RTPlanLabel":
-				continue
-
-			for uid in uid_set:
-				ds = Dataset()
-				if modality == "CT":
-					ds.QueryRetrieveLevel = "SERIES"
-					ds.SeriesInstanceUID = uid
-					exists = conquest_db_interface.check_exists_series(engine, uid)
-				else:
-					ds.QueryRetrieveLevel = "IMAGE"
-					ds.SOPInstanceUID = uid
-					exists = conquest_db_interface.check_exists_sop(engine, uid)
-
-				if not exists:
-					responses = assoc.send_c_move(
-						ds,
-						move_aet=config.conquest_krest.dicom.aet,
-						query_model=PatientRootQueryRetrieveInformationModelMove
-					)
-
-	assoc.release()
\ No newline at end of file
+	patient_ser = patient.patient_ser
+	series_uids = patient.ct_series_uids
+	sop_uids = patient.sop_uids
+	files_nb = {uid: n for uid, n in (files_nb or dict()).items() if uid in series_uids and n}
+
+	if checkpoints:
+		# A series confirmed while partially stored would never be completed
+		series_pending = checkpoints.missing("conquest_krest", series_uids) | files_nb.keys()
+		sop_pending = checkpoints.missing("conquest_krest", sop_uids)
+	else:
+		series_pending = series_uids
+		sop_pending = sop_uids
+
+	series_counts = conquest_db_interface.get_series_instance_counts(engine, files_nb)
+	series_complete = {uid for uid, n in files_nb.items() if series_counts.get(uid, 0) >= n}
+	series_partial = {uid for uid in files_nb if 0 < series_counts.get(uid, 0) < files_nb[uid]}
+
+	series_unverified = series_pending - files_nb.keys()
+	series_existing = inventory.existing_series(series_unverified) if inventory else set()
+	series_existing |= conquest_db_interface.get_existing_series(engine, series_unverified - series_existing)
+	series_existing |= series_complete
+	sop_existing = conquest_db_interface.get_existing_sops(engine, sop_pending)
+	stored = (series_uids - series_pending) | (sop_uids - sop_pending) | series_existing | sop_existing
+
+	if checkpoints:
+		checkpoints.confirm(patient_ser, "conquest_krest", series_existing | sop_existing)
+
+	series_missing = series_pending - series_existing - series_partial
+	sop_missing = sop_pending - sop_existing
+
+	# Only the instances missing from a partially stored series are sent again
+	instance_missing = set()
+	if series_partial:
+		instance_missing = find_missing_instances(engine, series_partial, source_engine, arrivals)
+		if source_engine is None:
+			# Without Medfys-1 the missing instances are only known for the received series
+			series_missing |= {uid for uid in series_partial if not arrivals or not arrivals.existing_series([uid])}
+		print(f"- {len(series_partial)} CT series of patient {patient_ser} are partially stored in "
+			f"{config.conquest_krest.dicom.aet}, {len(instance_missing)} instances missing")
+
+	if arrivals:
+		series_received = arrivals.existing_series(series_missing)
+		sop_received = arrivals.existing_sops(sop_missing | instance_missing)
+		object_files = arrivals.series_files(series_received)
+		object_files.update(arrivals.files(sop_received))
+
+		if object_files:
+			sent = c_store_files("conquest_krest_store", object_files)
+			# A series counts as stored when all its received instances were sent
+			series_stored = {uid for uid in series_received if arrivals.series_files([uid]).keys() <= sent}
+			sop_stored = sop_received & sent
+
+			stored |= (series_stored - files_nb.keys()) | sop_stored
+			if checkpoints:
+				checkpoints.confirm(patient_ser, "conquest_krest", (series_stored - files_nb.keys()) | (sop_stored - instance_missing))
+
+		series_missing -= series_received
+		sop_missing -= sop_received
+		instance_missing -= sop_received
+
+	requests = [MoveRequest("SERIES", [uid], files_nb.get(uid, 0), "CT series", covers={uid}) for uid in series_missing]
+	requests += [MoveRequest("IMAGE", [uid], 1, "single UID", covers={uid}) for uid in sop_missing | instance_missing]
+
+	results = list()
+	if requests:
+		with move_executor.MoveExecutor("conquest_aria", config.conquest_krest.dicom.aet) as executor:
+			results = executor.map_retry([(request, move_executor.move_identifier(request)) for request in requests], on_result=on_result)
+
+	for result in results:
+		# The counted series are confirmed below, once all their instances are found
+		covers = result.request.covers - files_nb.keys()
+		if result.succeeded:
+			stored |= covers
+			if checkpoints:
+				checkpoints.confirm(patient_ser, "conquest_krest", covers - instance_missing)
+
+	# A counted series that was sent to is only stored once it has all its instances
+	series_sent = files_nb.keys() - series_existing
+	if series_sent:
+		series_counts = conquest_db_interface.get_series_instance_counts(engine, series_sent)
+		series_completed = {uid for uid in series_sent if series_counts.get(uid, 0) >= files_nb[uid]}
+		stored |= series_completed
+		if checkpoints:
+			checkpoints.confirm(patient_ser, "conquest_krest", series_completed)
+
+		for uid in series_sent - series_completed:
+			print(f"- CT series {uid} has {series_counts.get(uid, 0)} of {files_nb[uid]} instances in {config.conquest_krest.dicom.aet}")
+
+	failed = [result for result in results if result.retryable]
+	if failed:
+		raise RuntimeError(f"C-MOVE of {len(failed)} objects to {config.conquest_krest.dicom.aet} failed after {failed[0].attempt} attempts")
+
+	return stored
+
+def find_missing_instances(engine, series_uids, source_engine=None, arrivals=None) -> set:
+	"""The SOP Instance UIDs of the series in Medfys-1 (source_engine) and in arrivals
+	that are not stored in Conquest (Medfys-2)"""
+
+	source_sops = set(arrivals.series_files(series_uids)) if arrivals else set()
+	if source_engine is not None:
+		for files in conquest_db_interface.get_series_object_files(source_engine, series_uids).values():
+			source_sops |= files.keys()
+
+	stored_sops = set()
+	for files in conquest_db_interface.get_series_object_files(engine, series_uids, root_dir=config.conquest_krest.root_dir).values():
+		stored_sops |= files.keys()
+
+	return source_sops - stored_sops
@@ -1,8 +1,42 @@
 import datetime
+import logging
+import threading
+from pathlib import Path
 from config import Config
 import json
 
+from sqlalchemy import func
+from sqlalchemy.engine import make_url
+from sqlmodel import Session, SQLModel, create_engine, select
+
+from module.Dataclasses.export_logger_dataclass import (
+	Patient,
+	Course,
+	RTPlan,
+	RTRecord,
+	RTStruct,
+	RTDose,
+	CT,
+	NPR,
+	ExportState,
+	TransferJournal,
+)
+from module.Dataclasses.plan_set_dataclass import PatientPlanSet, intern_uids
+
 config = Config()
+logger = logging.getLogger(__name__)
+
+LOG_TABLES = [table.__table__ for table in (Patient, Course, RTPlan, RTRecord, RTStruct, RTDose, CT, NPR, ExportState, TransferJournal)]
+
+WATERMARK_KEY = "tx_records_watermark"
+
+# PlanNode attribute: (table, UID column) of the objects logged under each RT Plan
+PLAN_CHILDREN = {
+	"rtrecord": (RTRecord, "sop_instance_uid"),
+	"rtstruct": (RTStruct, "sop_instance_uid"),
+	"rtdose": (RTDose, "sop_instance_uid"),
+	"ct": (CT, "series_instance_uid"),
+}
 
 class SetEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -10,39 +44,227 @@ class SetEncoder(json.JSONEncoder):
             return list(obj)
         return json.JSONEncoder.default(self, obj)
 
+def get_engine(uri: str):
+	"""SQL engine for the export log. A SQLite file is created together with its folder,
+	and may be used from all the export workers."""
+
+	url = make_url(uri)
+	connect_args = dict()
+
+	if url.get_backend_name() == "sqlite":
+		connect_args["check_same_thread"] = False
+		if url.database:
+			Path(url.database).parent.mkdir(parents=True, exist_ok=True)
+
+	return create_engine(uri, connect_args=connect_args)
+
 class LogDatabase:
-	def __init__(self):
-		self.log = self.get_log()
-
-	def get_log(self):
-		try:
-			with open(config.log_db.file, "r", encoding="utf-8") as input_file:
-				d =  json.load(input_file)
-				print(f"Found {len(d)} patients in {config.log_db.file}.")
-				return d
-		except Exception as e:
-			print("LogDatabase __init__ error: ", e)
-			return list()
+	"""Log of exported patients, stored in the tables of export_logger_dataclass.
+	Lookups go through the indexed primary keys / UIDs, and every add_patient is
+	committed in its own transaction. Writes are serialized through self.lock,
+	since the log is shared between the export workers."""
+
+	def __init__(self, uri: str = None):
+		self.uri = uri or config.log_db.uri
+		self.lock = threading.Lock()
+
+		self.engine = get_engine(self.uri)
+		SQLModel.metadata.create_all(self.engine, tables=LOG_TABLES)
+
+		with Session(self.engine) as session:
+			n_patients = session.exec(select(func.count()).select_from(Patient)).one()
+			print(f"Found {n_patients} patients in the export log.")
 
 	def save(self):
-		with open(config.log_db.file, "w", encoding="utf-8") as output_file:
-			json.dump(self.log, output_file, indent=3, cls=SetEncoder)
-		
- 
-	def add_patient(self, patient_ser, plan_set: dict):
-		new_entry = {
-			"sent_dt": datetime.datetime.now().isoformat(),
-			"patient_ser": patient_ser,
-			"plan_set": plan_set["PlanSet"]
-		}
-		self.log.append(new_entry)
+		"""Kept for compatibility: add_patient commits immediately."""
+		pass
+
+	def add_patient(self, patient_ser, plan_set: PatientPlanSet, sent_dt: datetime.datetime = None):
+		self._merge_plan_set(patient_ser, plan_set, sent_dt or datetime.datetime.now())
+
+	def save_plan_set(self, patient_ser, plan_set: PatientPlanSet):
+		"""Stores the plan set of a patient that is not (yet) sent, so that a failed
+		export can be resumed from the log. The sent_dt of earlier exports is kept."""
+		self._merge_plan_set(patient_ser, plan_set, None)
+
+	def _merge_plan_set(self, patient_ser, plan_set: PatientPlanSet, sent_dt: datetime.datetime):
+		with self.lock, Session(self.engine) as session:
+			patient = session.get(Patient, patient_ser) or Patient(patient_ser=patient_ser)
+			patient.patient_id = plan_set.patient_id or patient.patient_id
+			patient.sent_dt = sent_dt or patient.sent_dt
+			session.add(patient)
+
+			for plan_uid, plan in plan_set.plans.items():
+				statement = select(RTPlan).where(RTPlan.sop_instance_uid == plan_uid)
+				rtplan = session.exec(statement).first() or RTPlan(sop_instance_uid=plan_uid, sent_status="Identified")
+
+				rtplan.patient_ser = patient_ser
+				rtplan.rt_plan_label = plan.label or rtplan.rt_plan_label
+				if sent_dt:
+					rtplan.sent_dt = sent_dt
+					rtplan.sent_status = "KREST Exported"
+				session.add(rtplan)
+				session.flush()
+
+				for attr, (table, column) in PLAN_CHILDREN.items():
+					uid_column = getattr(table, column)
+					statement = select(uid_column).where(table.rtplan_id == rtplan.id)
+					logged = set(session.exec(statement).all())
+
+					for uid in getattr(plan, attr) - logged:
+						session.add(table(rtplan_id=rtplan.id, **{column: uid}))
+
+			session.commit()
 
 	def check_patient(self, patient_ser: str) -> bool:
-		for entry in self.log:
-			if entry.get("patient_ser") == patient_ser:
-				return entry.get("sent_dt")
+		with Session(self.engine) as session:
+			patient = session.get(Patient, patient_ser)
+
+			if patient and patient.sent_dt:
+				return patient.sent_dt.isoformat()
+
 		return False
 
+	def get_plan_set(self, patient_ser) -> PatientPlanSet:
+		"""The logged plan set of a patient"""
+
+		with Session(self.engine) as session:
+			patient = session.get(Patient, patient_ser)
+			if not patient:
+				return None
+
+			plan_set = PatientPlanSet(patient_ser, patient.patient_id)
+
+			for rtplan in patient.rtplans:
+				node = plan_set.plan(rtplan.sop_instance_uid)
+				node.label = rtplan.rt_plan_label or str()
+				node.rtdose = intern_uids(row.sop_instance_uid for row in rtplan.rtdoses)
+				node.rtrecord = intern_uids(row.sop_instance_uid for row in rtplan.rtrecords)
+				node.rtstruct = intern_uids(row.sop_instance_uid for row in rtplan.rtstructs)
+				node.ct = intern_uids(row.series_instance_uid for row in rtplan.cts)
+
+		return plan_set
+
+	def get_ct_files_nb(self, series_uids) -> dict:
+		"""{Series Instance UID: files_nb} of the CT series with a verified instance count"""
+
+		series_uids = set(series_uids)
+		if not series_uids:
+			return dict()
+
+		with Session(self.engine) as session:
+			statement = select(CT.series_instance_uid, func.max(CT.files_nb)).where(
+				CT.series_instance_uid.in_(series_uids), CT.files_nb != None).group_by(CT.series_instance_uid)
+			return dict(session.exec(statement).all())
+
+	def set_ct_files_nb(self, files_nb: dict) -> None:
+		"""Stores the verified instance count of the CT series, {Series Instance UID: count}"""
+
+		if not files_nb:
+			return
+
+		with self.lock, Session(self.engine) as session:
+			statement = select(CT).where(CT.series_instance_uid.in_(set(files_nb)))
+			for ct in session.exec(statement).all():
+				ct.files_nb = files_nb[ct.series_instance_uid]
+				session.add(ct)
+			session.commit()
+
+	def add_transfer(self, patient_ser, uids, level: str, source: str, destination: str,
+			attempt: int, status: str, error: str = None) -> None:
+		"""Journals one attempt of a transfer, one row per UID"""
+
+		dt = datetime.datetime.now()
+		with self.lock, Session(self.engine) as session:
+			for uid in uids:
+				session.add(TransferJournal(
+					patient_ser=patient_ser,
+					uid=uid,
+					level=level,
+					source=source,
+					destination=destination,
+					attempt=attempt,
+					status=status,
+					error=error,
+					dt=dt,
+				))
+			session.commit()
+
+	def confirm_transfers(self, patient_ser, uids=None) -> None:
+		"""Confirms the journaled transfers of the UIDs, all of the patient's if uids is None"""
+
+		dt = datetime.datetime.now()
+		with self.lock, Session(self.engine) as session:
+			statement = select(TransferJournal).where(TransferJournal.patient_ser == patient_ser, TransferJournal.confirmed_dt == None)
+			for row in session.exec(statement).all():
+				if uids is None or row.uid in uids:
+					row.confirmed_dt = dt
+					session.add(row)
+			session.commit()
+
+	def get_pending_patients(self) -> list:
+		"""[(PatientSer, PatientPlanSet)] of the patients with unconfirmed failed transfers"""
+
+		with Session(self.engine) as session:
+			statement = select(TransferJournal.patient_ser).where(
+				TransferJournal.status == "failed",
+				TransferJournal.confirmed_dt == None,
+			).distinct()
+			patient_sers = [patient_ser for patient_ser in session.exec(statement).all() if patient_ser is not None]
+
+		pending = list()
+		for patient_ser in patient_sers:
+			plan_set = self.get_plan_set(patient_ser)
+			if plan_set:
+				pending.append((patient_ser, plan_set))
+
+		return pending
+
+	def get_watermark(self) -> datetime.datetime:
+		"""Timestamp of the last treatment record covered by a completed run, or None"""
+
+		with Session(self.engine) as session:
+			state = session.get(ExportState, WATERMARK_KEY)
+
+		return datetime.datetime.fromisoformat(state.value) if state else None
+
+	def set_watermark(self, dt: datetime.datetime) -> None:
+		with self.lock, Session(self.engine) as session:
+			state = session.get(ExportState, WATERMARK_KEY) or ExportState(key=WATERMARK_KEY, value="", updated_dt=datetime.datetime.now())
+			state.value = dt.isoformat()
+			state.updated_dt = datetime.datetime.now()
+			session.add(state)
+			session.commit()
+
+	def import_json_log(self, path: str = None) -> int:
+		"""One-time import of the JSON log written by earlier versions (config.log_db.file).
+		Patients already in the log are updated, so the import can be repeated."""
+
+		path = path or config.log_db.file
+
+		with open(path, "r", encoding="utf-8") as input_file:
+			entries = json.load(input_file)
+
+		for entry in entries:
+			sent_dt = entry.get("sent_dt")
+			sent_dt = datetime.datetime.fromisoformat(sent_dt) if sent_dt else None
+
+			plan_set = PatientPlanSet.from_dict(entry["patient_ser"], {"PlanSet": entry.get("plan_set")})
+			self.add_patient(entry["patient_ser"], plan_set, sent_dt=sent_dt)
+
+		print(f"Imported {len(entries)} patients from {path}.")
+		return len(entries)
+
 	@property
 	def plan_set(self):
-		return self.log
\ No newline at end of file
+		"""All logged patients, in the format of the former JSON log. Loads the whole log."""
+
+		with Session(self.engine) as session:
+			patients = session.exec(select(Patient)).all()
+			entries = [(patient.patient_ser, patient.sent_dt) for patient in patients]
+
+		return [{
+			"sent_dt": sent_dt.isoformat() if sent_dt else None,
+			"patient_ser": patient_ser,
+			"plan_set": self.get_plan_set(patient_ser).to_dict()["PlanSet"],
+		} for patient_ser, sent_dt in entries]
@@ -0,0 +1,298 @@
+import datetime
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Optional
+
+from pydicom.dataset import Dataset
+from pynetdicom.sop_class import PatientRootQueryRetrieveInformationModelFind
+from sqlalchemy import func
+from sqlmodel import Session, select
+
+from config import Config
+from module.Dataclasses.conquest_dataclass import (
+	DICOMImages,
+	DICOMSeries,
+	DICOMStudies,
+	DICOMPatients,
+)
+from module.Dataclasses.plan_set_dataclass import intern_uid
+from module.utils import association_pool
+
+"""
+Snapshot of what a destination holds: patients -> studies -> series -> number of instances.
+
+	inventory = SqlInventory("conquest_krest", conquest_krest_engine)
+	inventory.refresh()
+
+	patient_id in inventory
+	inventory.has_series(series_uid)
+	inventory.series_count(series_uid)
+
+All lookups are dict lookups. SqlInventory is built from projection queries against the
+Conquest tables (no ORM objects are loaded), and refreshed incrementally from the
+AccessTime that Conquest updates when a series is written. CFindInventory covers peers
+without SQL access, per patient with C-FIND at STUDY and SERIES level (KREST, when
+krest.forward_mode is "store").
+
+With export.inventory_cache set, the snapshot is kept between runs, so a run only
+queries what changed since the last one.
+"""
+
+config = Config()
+logger = logging.getLogger(__name__)
+
+# Seconds before the last seen AccessTime that are queried again
+ACCESS_TIME_OVERLAP = 60
+
+@dataclass
+class SeriesEntry:
+	patient_id: Optional[str]
+	study_uid: Optional[str]
+	modality: Optional[str]
+	n_instances: Optional[int]
+
+class Inventory:
+	def __init__(self, name: str, cache_dir: str = None):
+		self.name = name
+		self.lock = threading.RLock()
+		self.patients = dict() # PatientID: {Study UIDs}
+		self.studies = dict() # Study UID: {Series UIDs}
+		self.series = dict() # Series UID: SeriesEntry
+		self.refreshed_dt = None
+
+		cache_dir = cache_dir if cache_dir is not None else config.export.inventory_cache
+		self.cache_path = Path(cache_dir) / f"{name}.json" if cache_dir else None
+
+	def add_patient(self, patient_id: str) -> None:
+		with self.lock:
+			self.patients.setdefault(patient_id, set())
+
+	def add_series(self, series_uid: str, study_uid: str = None, patient_id: str = None,
+			modality: str = None, n_instances: int = None) -> None:
+
+		series_uid, study_uid = intern_uid(series_uid), intern_uid(study_uid)
+
+		with self.lock:
+			self.series[series_uid] = SeriesEntry(patient_id, study_uid, modality, n_instances)
+			if study_uid:
+				self.studies.setdefault(study_uid, set()).add(series_uid)
+			if patient_id:
+				self.patients.setdefault(patient_id, set())
+				if study_uid:
+					self.patients[patient_id].add(study_uid)
+
+	def has_patient(self, patient_id: str) -> bool:
+		return patient_id in self.patients
+
+	def has_study(self, study_uid: str) -> bool:
+		return study_uid in self.studies
+
+	def has_series(self, series_uid: str) -> bool:
+		return series_uid in self.series
+
+	def existing_series(self, series_uids) -> set:
+		return {uid for uid in series_uids if uid in self.series}
+
+	def series_count(self, series_uid: str) -> Optional[int]:
+		"""Number of instances of the series, None if the series is not known"""
+		entry = self.series.get(series_uid)
+		return entry.n_instances if entry else None
+
+	@property
+	def patient_ids(self) -> set:
+		return set(self.patients)
+
+	def __contains__(self, patient_id) -> bool:
+		return self.has_patient(patient_id)
+
+	def __len__(self) -> int:
+		return len(self.patients)
+
+	def state(self) -> dict:
+		"""Extra state of the subclasses that is cached with the snapshot"""
+		return dict()
+
+	def load_state(self, state: dict) -> None:
+		pass
+
+	def load(self) -> bool:
+		if not self.cache_path or not self.cache_path.exists():
+			return False
+
+		try:
+			with open(self.cache_path, "r", encoding="utf-8") as input_file:
+				cached = json.load(input_file)
+		except (OSError, json.JSONDecodeError) as e:
+			logger.warning(f"Cannot read inventory cache {self.cache_path}: {e}")
+			return False
+
+		with self.lock:
+			for patient_id in cached["patients"]:
+				self.add_patient(patient_id)
+			for series_uid, entry in cached["series"].items():
+				self.add_series(series_uid, entry["study_uid"], entry["patient_id"], entry["modality"], entry["n_instances"])
+			self.load_state(cached.get("state") or dict())
+
+		return True
+
+	def save(self) -> None:
+		if not self.cache_path:
+			return
+
+		# Held while writing, since CFindInventory is refreshed from the export workers
+		with self.lock:
+			cached = {
+				"refreshed_dt": self.refreshed_dt.isoformat() if self.refreshed_dt else None,
+				"state": self.state(),
+				"patients": sorted(self.patients),
+				"series": {series_uid: asdict(entry) for series_uid, entry in self.series.items()},
+			}
+
+			self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+			part_path = self.cache_path.with_suffix(".part")
+			with open(part_path, "w", encoding="utf-8") as output_file:
+				json.dump(cached, output_file)
+			os.replace(part_path, self.cache_path)
+
+class SqlInventory(Inventory):
+	"""Inventory of a Conquest node, from its SQL database"""
+
+	def __init__(self, name: str, engine, cache_dir: str = None):
+		super().__init__(name, cache_dir)
+		self.engine = engine
+		self.access_time = None # Highest AccessTime seen
+
+	def state(self) -> dict:
+		return {"access_time": self.access_time}
+
+	def load_state(self, state: dict) -> None:
+		self.access_time = state.get("access_time")
+
+	def refresh(self, full: bool = False) -> None:
+		"""Reads the series written since the last refresh (all series if full, or on the first
+		refresh without cache). Deleted objects are only noticed by a full refresh."""
+
+		if full:
+			with self.lock:
+				self.patients, self.studies, self.series = dict(), dict(), dict()
+				self.access_time = None
+		elif self.access_time is None:
+			self.load()
+
+		since = self.access_time - ACCESS_TIME_OVERLAP if self.access_time is not None else None
+
+		with Session(self.engine) as session:
+			statement = select(DICOMPatients.PatientID)
+			if since is not None:
+				statement = statement.where(DICOMPatients.AccessTime >= since)
+			patient_ids = session.exec(statement).all()
+
+			statement = (
+				select(
+					DICOMSeries.SeriesInstanceUID,
+					DICOMSeries.StudyInsta,
+					DICOMStudies.PatientID,
+					DICOMSeries.Modality,
+					DICOMSeries.AccessTime,
+					func.count(DICOMImages.SOPInstanceUID),
+				)
+				.join(DICOMStudies, DICOMStudies.StudyInstanceUID == DICOMSeries.StudyInsta, isouter=True)
+				.join(DICOMImages, DICOMImages.SeriesInst == DICOMSeries.SeriesInstanceUID, isouter=True)
+				.group_by(
+					DICOMSeries.SeriesInstanceUID,
+					DICOMSeries.StudyInsta,
+					DICOMStudies.PatientID,
+					DICOMSeries.Modality,
+					DICOMSeries.AccessTime,
+				)
+			)
+			if since is not None:
+				statement = statement.where(DICOMSeries.AccessTime >= since)
+			rows = session.exec(statement).all()
+
+		with self.lock:
+			for patient_id in patient_ids:
+				self.add_patient(patient_id)
+
+			for series_uid, study_uid, patient_id, modality, access_time, n_instances in rows:
+				self.add_series(series_uid, study_uid, patient_id, modality, int(n_instances))
+				if access_time is not None and (self.access_time is None or int(access_time) > self.access_time):
+					self.access_time = int(access_time)
+
+			self.refreshed_dt = datetime.datetime.now()
+
+		print(f"Inventory of {self.name}: {len(self.patients)} patients, {len(self.series)} series ({len(rows)} series updated)")
+		self.save()
+
+class CFindInventory(Inventory):
+	"""Inventory of a DICOM node without SQL access, per patient with C-FIND"""
+
+	def __init__(self, name: str, peer: str, cache_dir: str = None, max_age: int = 24 * 3600):
+		super().__init__(name, cache_dir)
+		self.peer = peer
+		self.max_age = max_age # Seconds before a patient is queried again
+		self.patient_dt = dict() # PatientID: when the patient was last queried
+
+	def state(self) -> dict:
+		return {"patient_dt": {patient_id: dt.isoformat() for patient_id, dt in self.patient_dt.items()}}
+
+	def load_state(self, state: dict) -> None:
+		self.patient_dt = {patient_id: datetime.datetime.fromisoformat(dt) for patient_id, dt in (state.get("patient_dt") or dict()).items()}
+
+	def _find(self, assoc, ds) -> list:
+		identifiers = list()
+		for status, identifier in assoc.send_c_find(ds, PatientRootQueryRetrieveInformationModelFind):
+			if status and status.Status in (0xFF00, 0xFF01) and identifier:
+				identifiers.append(identifier)
+		return identifiers
+
+	def refresh(self, patient_ids, full: bool = False) -> None:
+		"""Queries the patients that were not queried within max_age (all of them if full)"""
+
+		if not self.patient_dt and not full:
+			self.load()
+
+		now = datetime.datetime.now()
+		patient_ids = [patient_id for patient_id in patient_ids if patient_id and (full
+			or patient_id not in self.patient_dt
+			or (now - self.patient_dt[patient_id]).total_seconds() > self.max_age)]
+
+		if not patient_ids:
+			return
+
+		with association_pool.association(self.peer) as assoc:
+			for patient_id in patient_ids:
+				ds = Dataset()
+				ds.QueryRetrieveLevel = "STUDY"
+				ds.PatientID = patient_id
+				ds.StudyInstanceUID = ""
+				studies = self._find(assoc, ds)
+
+				with self.lock:
+					# Only patients that exist in the node are added
+					self.patients.pop(patient_id, None)
+					if studies:
+						self.add_patient(patient_id)
+
+				for study in studies:
+					ds = Dataset()
+					ds.QueryRetrieveLevel = "SERIES"
+					ds.PatientID = patient_id
+					ds.StudyInstanceUID = study.StudyInstanceUID
+					ds.SeriesInstanceUID = ""
+					ds.Modality = ""
+					ds.NumberOfSeriesRelatedInstances = ""
+
+					for series in self._find(assoc, ds):
+						n_instances = series.get("NumberOfSeriesRelatedInstances")
+						self.add_series(series.SeriesInstanceUID, study.StudyInstanceUID, patient_id,
+							series.get("Modality"), int(n_instances) if n_instances not in (None, "") else None)
+
+				self.patient_dt[patient_id] = now
+
+		self.refreshed_dt = now
+		self.save()
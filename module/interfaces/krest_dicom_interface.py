@@ -0,0 +1,71 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from config import Config
+from module.Interfaces import conquest_db_interface, conquest_dicom_interface
+from module.utils import association_pool
+
+"""
+Forwarding to KREST with C-STORE, as an alternative to the C-MOVE of the whole
+patient from conquest_krest (krest.forward_mode = "store").
+
+Only the instances of a patient that are not yet confirmed at KREST in the checkpoint
+journal are sent, straight from the files of Medfys-2, over at most
+krest.dicom.max_associations associations. The presentation contexts for RT Plan,
+RT Dose, RT Struct, RT (Ion) Beams Treatment Record and CT are proposed up front
+(association_pool.STORAGE_CONTEXTS).
+"""
+
+config = Config()
+logger = logging.getLogger(__name__)
+
+PEER = "krest_store"
+
+def c_store_batches(peer: str, object_files: dict) -> set:
+	"""C-STORE of the files {SOP Instance UID: path}, split over the associations of the
+	peer's pool. Returns the stored UIDs."""
+
+	n_batches = max(1, min(association_pool.get_pool(peer).max_associations, len(object_files)))
+	items = sorted(object_files.items())
+	batches = [dict(items[i::n_batches]) for i in range(n_batches)]
+
+	stored = set()
+	with ThreadPoolExecutor(max_workers=n_batches, thread_name_prefix=f"store-{peer}") as executor:
+		for batch_stored in executor.map(lambda batch: conquest_dicom_interface.c_store_files(peer, batch), batches):
+			stored |= batch_stored
+
+	return stored
+
+def c_store_to_krest(engine, patient, stored: set, checkpoints) -> set:
+	"""Sends the objects of the patient stored in Medfys-2 (stored, as returned by
+	conquest_dicom_interface.c_move_to_medfys2) that KREST does not have yet.
+	CT series are sent per instance, so a series that was partly sent before is completed.
+	Returns the UIDs that could not be sent."""
+
+	patient_ser = patient.patient_ser
+	pending = checkpoints.missing("krest", stored)
+	series_pending = pending & patient.ct_series_uids
+	sop_pending = pending - series_pending
+
+	root_dir = config.conquest_krest.root_dir
+	object_files = conquest_db_interface.get_object_files(engine, sop_pending, root_dir=root_dir)
+	series_files = conquest_db_interface.get_series_object_files(engine, series_pending, root_dir=root_dir)
+
+	for files in series_files.values():
+		for sop_uid in checkpoints.missing("krest", files):
+			object_files[sop_uid] = files[sop_uid]
+
+	if object_files:
+		print(f"- Sending {len(object_files)} instances of patient {patient_ser} to {config.krest.name}")
+		sent = c_store_batches(PEER, object_files)
+		checkpoints.confirm(patient_ser, "krest", sent & sop_pending)
+	else:
+		sent = set()
+
+	# A series is complete at KREST when all its instances are
+	for series_uid, files in series_files.items():
+		checkpoints.confirm(patient_ser, "krest", sent & files.keys())
+		if not checkpoints.missing("krest", files):
+			checkpoints.confirm(patient_ser, "krest", [series_uid])
+
+	return checkpoints.missing("krest", pending)
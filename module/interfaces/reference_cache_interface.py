@@ -0,0 +1,80 @@
+import json
+import logging
+import os
+import threading
+
+from sqlmodel import Session, SQLModel, select
+
+from config import Config
+
+from module.Dataclasses.reference_cache_dataclass import RTReference
+from module.Interfaces.export_logger_interface import get_engine
+
+config = Config()
+logger = logging.getLogger(__name__)
+
+"""
+Persistent cache of the references parsed from RT Plan, RT Struct and RT Dose files,
+keyed by SOP Instance UID. An entry is only used if the mtime and size of the file
+in Conquest are unchanged since it was parsed, so a re-imported object is read again.
+"""
+
+CHUNK_SIZE = 500
+
+class ReferenceCache:
+	def __init__(self, uri: str = None):
+		self.uri = uri or config.export.reference_cache
+
+		self.engine = get_engine(self.uri)
+		SQLModel.metadata.create_all(self.engine, tables=[RTReference.__table__])
+
+		# SQLite only allows a single writer
+		self.lock = threading.Lock()
+
+	@staticmethod
+	def stat(ds_path: str):
+		try:
+			st = os.stat(ds_path)
+		except OSError:
+			return None
+
+		return st.st_mtime, st.st_size
+
+	def get_many(self, object_files: dict) -> dict:
+		"""Returns {SOP UID: (references, RTPlanLabel)} for the entries of
+		object_files {SOP UID: path} with a valid cache entry."""
+
+		stats = {uid: self.stat(path) for uid, path in object_files.items()}
+		stats = {uid: st for uid, st in stats.items() if st}
+
+		cached = dict()
+		uids = list(stats)
+
+		with Session(self.engine) as session:
+			for i in range(0, len(uids), CHUNK_SIZE):
+				statement = select(RTReference).where(RTReference.sop_instance_uid.in_(uids[i:i + CHUNK_SIZE]))
+				for entry in session.exec(statement).all():
+					mtime, size = stats[entry.sop_instance_uid]
+					if entry.file_mtime == mtime and entry.file_size == size:
+						cached[entry.sop_instance_uid] = (json.loads(entry.references), entry.rt_plan_label)
+
+		return cached
+
+	def put_many(self, object_files: dict, references: dict) -> None:
+		"""Stores {SOP UID: (references, RTPlanLabel)} for the files in object_files."""
+
+		with self.lock, Session(self.engine) as session:
+			for uid, (refs, rt_plan_label) in references.items():
+				st = self.stat(object_files[uid])
+				if not st:
+					continue
+
+				session.merge(RTReference(
+					sop_instance_uid=uid,
+					file_mtime=st[0],
+					file_size=st[1],
+					references=json.dumps(sorted(refs)),
+					rt_plan_label=rt_plan_label,
+				))
+
+			session.commit()
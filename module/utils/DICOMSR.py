@@ -86,11 +86,11 @@ class DICOMSR:
       self.ds.save_as(filename, write_like_original=False)
 
    def getXML(self) -> str:
-      self.xml_doc = sr.ContentSequence[0].TextValue
+      self.xml_doc = self.ds.ContentSequence[0].TextValue
       return self.xml_doc
 
-def makeDataset(parentUID: str, patientID: str, patientName: str, XMLString: str) -> DICOMInterface:
-   basicSR = DICOMInterface()
+def makeDataset(parentUID: str, patientID: str, patientName: str, XMLString: str) -> DICOMSR:
+   basicSR = DICOMSR()
    basicSR.addUIDs(parentUID)
    basicSR.addPatient(patientID=patientID, patientName=patientName)
    basicSR.addDatetimes()
@@ -0,0 +1,194 @@
+import argparse
+import datetime
+import glob
+import hashlib
+import json
+import logging
+import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Optional
+
+from pydicom.uid import generate_uid
+
+from module.interfaces.NPR_interface import NPRInterface
+from module.utils.DICOMSR import makeDataset
+
+"""
+Batch conversion of NPR XML reports to DICOM SR (see DICOMSR_example.py for a single file).
+
+Parsing with pydantic-xml is CPU bound, so the files are converted on a process pool.
+Every SR is written to output_dir/<name of the XML>.dcm (<name>_<hash of the path>.dcm
+when XML files of the same name come from several directories) with a sidecar <name>.dcm.json
+holding the SHA-256 of the XML and when the SR was sent. A file whose SR exists with
+the same hash is not converted again. The SRs not yet sent are sent with C-STORE over
+a single pooled association (association_pool peer conquest_krest_sr).
+
+	python -m module.utils.DICOMSR_batch "D:/NPR/2025/*.xml" -o D:/NPR/SR --send
+"""
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class Conversion:
+	source: str
+	output: str
+	status: str # converted; skipped (the SR of the same XML exists); failed
+	patient_id: Optional[str] = None
+	error: Optional[str] = None
+
+	def __str__(self) -> str:
+		return f"{self.source}: {self.status}" + (f" ({self.error})" if self.error else "")
+
+def expand_inputs(inputs) -> list:
+	"""The XML files of the given files, directories (all *.xml) and glob patterns"""
+
+	paths = list()
+	for item in inputs:
+		path = pathlib.Path(item)
+		if path.is_dir():
+			paths.extend(sorted(path.glob("*.xml")))
+		elif path.is_file():
+			paths.append(path)
+		else:
+			paths.extend(pathlib.Path(match) for match in sorted(glob.glob(item)))
+
+	return list(dict.fromkeys(paths))
+
+def output_paths(paths, output_dir) -> dict:
+	"""{XML path: SR path} in output_dir. XML files of the same name in different
+	directories get the hash of their path in the name, so they do not overwrite each other."""
+
+	stems = dict()
+	for path in paths:
+		stems.setdefault(path.stem, list()).append(path)
+
+	outputs = dict()
+	for stem, same_stem in stems.items():
+		for path in same_stem:
+			if len(same_stem) > 1:
+				path_hash = hashlib.sha256(str(path.resolve()).encode()).hexdigest()[:8]
+				outputs[path] = output_dir / f"{stem}_{path_hash}.dcm"
+			else:
+				outputs[path] = output_dir / f"{stem}.dcm"
+
+	return outputs
+
+def content_hash(path) -> str:
+	sha256 = hashlib.sha256()
+	with open(path, "rb") as xml_file:
+		for chunk in iter(lambda: xml_file.read(1 << 20), b""):
+			sha256.update(chunk)
+	return sha256.hexdigest()
+
+def sidecar_path(output) -> pathlib.Path:
+	return pathlib.Path(f"{output}.json")
+
+def read_sidecar(output) -> dict:
+	try:
+		return json.loads(sidecar_path(output).read_text())
+	except (OSError, ValueError):
+		return dict()
+
+def write_sidecar(output, **values) -> None:
+	sidecar = read_sidecar(output)
+	sidecar.update(values)
+	part_path = pathlib.Path(f"{output}.json.part")
+	part_path.write_text(json.dumps(sidecar))
+	os.replace(part_path, sidecar_path(output))
+
+def convert_file(source: str, output: str, parent_uid: str = None) -> Conversion:
+	"""Converts one NPR XML file to an SR at output, unless the SR of the same content
+	exists. Runs in a worker process."""
+
+	digest = content_hash(source)
+	sidecar = read_sidecar(output)
+	if pathlib.Path(output).exists() and sidecar.get("sha256") == digest:
+		return Conversion(source, output, "skipped", sidecar.get("patient_id"))
+
+	try:
+		npr = NPRInterface(source)
+
+		# Validate XML before encapsulating to ensure it can be read again
+		xml_string = npr.get_XML()
+
+		patients = npr.get_patients()
+		if len(patients) == 1:
+			patient_name = patient_id = str(patients[0].pasientNr)
+		else:
+			patient_name, patient_id = "Many", "123"
+
+		basic_sr = makeDataset(parent_uid or generate_uid(), patient_id, patient_name, xml_string)
+
+		part_path = f"{output}.part"
+		basic_sr.saveFile(part_path)
+		os.replace(part_path, output)
+		# A changed XML gets a new SR, which must be sent again
+		write_sidecar(output, sha256=digest, patient_id=patient_id, converted_dt=datetime.datetime.now().isoformat(), sent_dt=None)
+	except Exception as e:
+		return Conversion(source, output, "failed", error=str(e))
+
+	return Conversion(source, output, "converted", patient_id)
+
+def convert_files(inputs, output_dir, parent_uid: str = None, max_workers: int = None) -> list:
+	"""Converts the XML files of inputs (files, directories, globs) on a process pool.
+	Returns the Conversions in completion order."""
+
+	output_dir = pathlib.Path(output_dir)
+	output_dir.mkdir(parents=True, exist_ok=True)
+
+	results = list()
+	with ProcessPoolExecutor(max_workers=max_workers) as executor:
+		futures = [executor.submit(convert_file, str(path), str(output), parent_uid)
+			for path, output in output_paths(expand_inputs(inputs), output_dir).items()]
+
+		for future in as_completed(futures):
+			result = future.result()
+			print(f"- {result}")
+			results.append(result)
+
+	return results
+
+def send_files(outputs, peer: str = "conquest_krest_sr") -> list:
+	"""C-STORE of the SRs over one pooled association to peer. The sidecar of every
+	stored SR is marked as sent. Returns the outputs that failed."""
+
+	# Imported here, so that the conversion does not need the exporter config
+	from module.utils import association_pool
+
+	failed = list()
+	with association_pool.association(peer) as assoc:
+		for output in outputs:
+			status = assoc.send_c_store(output)
+			# Warnings (coercion, elements discarded) are stored all the same, as in c_store_files
+			if status and status.Status in (0x0000, 0xB000, 0xB007, 0xB006):
+				write_sidecar(output, sent_dt=datetime.datetime.now().isoformat())
+			else:
+				logger.warning(f"C-STORE of {output} to {peer} failed: {status}")
+				failed.append(output)
+
+	return failed
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Batch conversion of NPR XML files to DICOM SR")
+	parser.add_argument("inputs", nargs="+", help="NPR XML files, directories or glob patterns")
+	parser.add_argument("-o", "--output-dir", required=True, help="Output directory of the DICOM SR files")
+	parser.add_argument("-p", "--parentUID", type=str, help="Study UID of parent DICOM dataset")
+	parser.add_argument("-w", "--workers", type=int, help="Worker processes (default: number of CPUs)")
+	parser.add_argument("-s", "--send", action="store_true", help="Send the SRs not yet sent to conquest_krest")
+	args = parser.parse_args()
+
+	results = convert_files(args.inputs, args.output_dir, args.parentUID, args.workers)
+
+	counts = {status: sum(1 for result in results if result.status == status) for status in ("converted", "skipped", "failed")}
+	print(f"{counts['converted']} converted, {counts['skipped']} skipped, {counts['failed']} failed")
+
+	if args.send:
+		unsent = [result.output for result in results if result.status != "failed" and not read_sidecar(result.output).get("sent_dt")]
+		if unsent:
+			from module.utils import association_pool
+
+			failed = send_files(unsent)
+			association_pool.close_all()
+			print(f"{len(unsent) - len(failed)} of {len(unsent)} SRs sent")
@@ -0,0 +1,292 @@
+import datetime
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Optional
+
+from pynetdicom import AE, evt
+from pynetdicom.sop_class import (
+	PatientRootQueryRetrieveInformationModelMove,
+	PatientRootQueryRetrieveInformationModelFind,
+	Verification,
+	CTImageStorage,
+	RTPlanStorage,
+	RTIonPlanStorage,
+	RTDoseStorage,
+	RTStructureSetStorage,
+	RTBeamsTreatmentRecordStorage,
+	RTIonBeamsTreatmentRecordStorage,
+	BasicTextSRStorage,
+)
+
+from config import Config
+from module.utils import transfer_syntax
+
+"""
+Reusable DICOM associations per peer.
+
+Setting up an association against ARIA costs as much as a small C-MOVE, so the
+associations are kept open between requests and handed out to the export workers.
+An idle association is checked with a C-ECHO before it is reused, and replaced
+if the peer has released or aborted it in the mean time.
+
+	with association_pool.association("aria") as assoc:
+		aria_dicom_interface.c_move_image(assoc, uid)
+
+The negotiated transfer syntaxes and the bytes sent / received are kept per association,
+see report().
+"""
+
+config = Config()
+logger = logging.getLogger(__name__)
+
+QUERY_RETRIEVE_CONTEXTS = [
+	PatientRootQueryRetrieveInformationModelMove,
+	PatientRootQueryRetrieveInformationModelFind,
+	Verification,
+]
+
+# The objects of an export, for C-STORE
+STORAGE_CONTEXTS = [
+	CTImageStorage,
+	RTPlanStorage,
+	RTIonPlanStorage,
+	RTDoseStorage,
+	RTStructureSetStorage,
+	RTBeamsTreatmentRecordStorage,
+	RTIonBeamsTreatmentRecordStorage,
+	Verification,
+]
+
+# The NPR reports encapsulated in DICOM SR, see module/utils/DICOMSR_batch.py
+SR_CONTEXTS = [
+	BasicTextSRStorage,
+	Verification,
+]
+
+# Peer name: (calling AE title, config entry of the called peer, presentation contexts)
+# ARIA only accepts the Conquest AE title as calling AE, the Conquest nodes accept anyone
+PEERS = {
+	"aria": (lambda: config.conquest_aria.dicom.aet, lambda: config.aria, QUERY_RETRIEVE_CONTEXTS),
+	"conquest_aria": (lambda: "PYTHON", lambda: config.conquest_aria, QUERY_RETRIEVE_CONTEXTS),
+	"conquest_krest": (lambda: "PYTHON", lambda: config.conquest_krest, QUERY_RETRIEVE_CONTEXTS),
+	"conquest_krest_store": (lambda: "PYTHON", lambda: config.conquest_krest, STORAGE_CONTEXTS),
+	"conquest_krest_sr": (lambda: "PYTHON", lambda: config.conquest_krest, SR_CONTEXTS),
+	# KREST only accepts objects and queries from Medfys-2
+	"krest": (lambda: config.conquest_krest.dicom.aet, lambda: config.krest, QUERY_RETRIEVE_CONTEXTS),
+	"krest_store": (lambda: config.conquest_krest.dicom.aet, lambda: config.krest, STORAGE_CONTEXTS),
+}
+
+@dataclass
+class AssociationStats:
+	peer: str
+	opened_dt: datetime.datetime
+	accepted: dict = field(default_factory=dict) # SOP Class name: [accepted transfer syntax names]
+	bytes_sent: int = 0
+	bytes_received: int = 0
+	closed_dt: Optional[datetime.datetime] = None
+
+	def __str__(self) -> str:
+		syntaxes = sorted({ts for transfer_syntaxes in self.accepted.values() for ts in transfer_syntaxes})
+		return f"{self.peer:<22} {self.bytes_sent / 1e6:>10.1f} MB sent {self.bytes_received / 1e6:>10.1f} MB received  {', '.join(syntaxes)}"
+
+class AssociationPool:
+	def __init__(self, name: str, ae_title: str, server: str, port: int, called_aet: str,
+			contexts: list = None, max_associations: int = 2, keepalive: int = 30, max_idle: int = 300,
+			transfer_syntaxes: list = None):
+		self.name = name
+		self.ae_title = ae_title
+		self.server = server
+		self.port = port
+		self.called_aet = called_aet
+		self.contexts = contexts or QUERY_RETRIEVE_CONTEXTS
+		self.keepalive = keepalive
+		self.max_idle = max_idle
+		self.max_associations = max_associations
+		# Proposed for the storage contexts, most preferred first
+		self.transfer_syntaxes = transfer_syntax.preferences(transfer_syntaxes)
+
+		# Totals of all the associations of the run, kept per pool instead of per association.
+		# The bytes of an association are added when it is closed
+		self.totals = AssociationStats(name, datetime.datetime.now())
+		self.n_associations = 0
+		self.idle = deque()
+		self.lock = threading.Lock()
+		self.slots = threading.BoundedSemaphore(max_associations)
+
+	def connect(self):
+		"""Builds a new, unpooled association to the peer."""
+
+		ae = AE(ae_title=self.ae_title)
+		for context in self.contexts:
+			if context in STORAGE_CONTEXTS and context != Verification:
+				# One context per syntax, so the peer may accept several
+				for ts in self.transfer_syntaxes:
+					ae.add_requested_context(context, ts)
+			else:
+				ae.add_requested_context(context)
+
+		stats = AssociationStats(self.name, datetime.datetime.now())
+
+		def count_sent(event):
+			stats.bytes_sent += len(event.data)
+
+		def count_received(event):
+			stats.bytes_received += len(event.data)
+
+		assoc = ae.associate(self.server, self.port, ae_title=self.called_aet,
+			evt_handlers=[(evt.EVT_DATA_SENT, count_sent), (evt.EVT_DATA_RECV, count_received)])
+
+		if not assoc.is_established:
+			raise RuntimeError(f"Association to {self.name} ({self.called_aet}) failed")
+
+		for cx in assoc.accepted_contexts:
+			stats.accepted.setdefault(getattr(cx.abstract_syntax, "name", str(cx.abstract_syntax)), list()).append(transfer_syntax.name(cx.transfer_syntax[0]))
+
+		logger.info(f"Association to {self.name}: {stats.accepted}")
+		assoc.stats = stats
+		with self.lock:
+			self.n_associations += 1
+			for sop_class, transfer_syntaxes in stats.accepted.items():
+				accepted = self.totals.accepted.setdefault(sop_class, list())
+				accepted.extend(ts for ts in transfer_syntaxes if ts not in accepted)
+
+		return assoc
+
+	def is_healthy(self, assoc, last_used: float) -> bool:
+		if not assoc.is_established or assoc.is_aborted:
+			return False
+
+		idle_time = time.monotonic() - last_used
+		if idle_time > self.max_idle:
+			return False
+
+		if idle_time > self.keepalive:
+			try:
+				status = assoc.send_c_echo()
+			except Exception as e:
+				logger.warning(f"C-ECHO to {self.name} failed: {e}")
+				return False
+
+			return bool(status) and status.Status == 0x0000
+
+		return True
+
+	def acquire(self):
+		"""Returns a healthy association, waiting if max_associations are already in use."""
+
+		self.slots.acquire()
+
+		try:
+			while True:
+				with self.lock:
+					if not self.idle:
+						break
+					assoc, last_used = self.idle.pop()
+
+				if self.is_healthy(assoc, last_used):
+					return assoc
+
+				logger.info(f"Reconnecting stale association to {self.name}")
+				self.close_association(assoc)
+
+			return self.connect()
+
+		except Exception:
+			self.slots.release()
+			raise
+
+	def release(self, assoc, discard: bool = False) -> None:
+		if discard or not assoc.is_established or assoc.is_aborted:
+			self.close_association(assoc)
+		else:
+			with self.lock:
+				self.idle.append((assoc, time.monotonic()))
+
+		self.slots.release()
+
+	@contextmanager
+	def association(self):
+		assoc = self.acquire()
+		discard = False
+		try:
+			yield assoc
+		except Exception:
+			# The association may be in an unknown state after a failed request
+			discard = True
+			raise
+		finally:
+			self.release(assoc, discard=discard)
+
+	def close_association(self, assoc) -> None:
+		stats = getattr(assoc, "stats", None)
+		if stats:
+			stats.closed_dt = datetime.datetime.now()
+			logger.info(f"Closed association: {stats}")
+
+			# The bytes are counted per association by its own thread, and added up here
+			with self.lock:
+				self.totals.bytes_sent += stats.bytes_sent
+				self.totals.bytes_received += stats.bytes_received
+
+		try:
+			if assoc.is_established:
+				assoc.release()
+			else:
+				assoc.abort()
+		except Exception as e:
+			logger.warning(f"Closing association to {self.name} failed: {e}")
+
+	def close(self) -> None:
+		with self.lock:
+			idle, self.idle = self.idle, deque()
+
+		for assoc, _ in idle:
+			self.close_association(assoc)
+
+_pools = dict()
+_pools_lock = threading.Lock()
+
+def get_pool(peer: str) -> AssociationPool:
+	with _pools_lock:
+		if peer not in _pools:
+			if peer not in PEERS:
+				raise KeyError(f"Unknown DICOM peer {peer}, expected one of {list(PEERS)}")
+
+			ae_title, pacs, contexts = PEERS[peer][0](), PEERS[peer][1](), PEERS[peer][2]
+			_pools[peer] = AssociationPool(
+				peer,
+				ae_title,
+				pacs.dicom.server,
+				pacs.dicom.port,
+				pacs.dicom.aet,
+				contexts=contexts,
+				max_associations=pacs.dicom.max_associations,
+				keepalive=pacs.dicom.keepalive,
+				max_idle=pacs.dicom.max_idle,
+				transfer_syntaxes=pacs.dicom.transfer_syntaxes,
+			)
+
+		return _pools[peer]
+
+def association(peer: str):
+	return get_pool(peer).association()
+
+def close_all() -> None:
+	with _pools_lock:
+		pools = list(_pools.values())
+
+	for pool in pools:
+		pool.close()
+
+def report() -> str:
+	"""Negotiated transfer syntaxes and bytes per peer of this run"""
+
+	with _pools_lock:
+		pools = list(_pools.values())
+
+	lines = [f"{pool.totals}  ({pool.n_associations} associations)" for pool in pools if pool.n_associations]
+	return "\n".join(lines)
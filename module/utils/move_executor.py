@@ -0,0 +1,239 @@
+import datetime
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
+
+from pydicom.dataset import Dataset
+from pynetdicom.sop_class import PatientRootQueryRetrieveInformationModelMove
+
+from config import Config
+
+from module.utils import association_pool, transfer_scheduler, retry
+
+"""
+C-MOVE with progress reporting and per-request results.
+
+The SCP sends a Pending response with the number of remaining, completed, failed and
+warning sub-operations while the move runs. c_move() hands every Pending response to
+the progress callback (a function, or a queue with put()), and returns a MoveResult
+with the final counts and timings, so a slow transfer can be told apart from a stall.
+
+MoveExecutor runs several C-MOVEs at once, each on its own association from the
+association pool of the peer, within the limits of the peer's transfer_scheduler:
+
+	with MoveExecutor("aria", config.conquest_aria.dicom.aet) as executor:
+		results = executor.map([(request, identifier), ...])
+
+map_retry() retries the failed requests with exponential backoff and jitter. A request
+is not retried if the source answered Success without sending anything, since the
+source does not have the object.
+"""
+
+config = Config()
+logger = logging.getLogger(__name__)
+
+PENDING = (0xFF00, 0xFF01)
+
+@dataclass
+class MoveProgress:
+	request: object
+	remaining: Optional[int]
+	completed: Optional[int]
+	failed: Optional[int]
+	warning: Optional[int]
+	elapsed: float
+
+	def __str__(self) -> str:
+		return f"{self.request}: {self.completed} completed, {self.remaining} remaining, {self.failed} failed, {self.warning} warning ({self.elapsed:.1f} s)"
+
+@dataclass
+class MoveResult:
+	request: object
+	status: Optional[int] = None # Final status, None if the association timed out or was aborted
+	completed: int = 0
+	failed: int = 0
+	warning: int = 0
+	n_pending: int = 0 # Number of Pending responses
+	started: Optional[datetime.datetime] = None
+	duration: float = 0.0 # Seconds from the request to the final response
+	first_response: Optional[float] = None # Seconds from the request to the first response
+	error: Optional[str] = None
+	attempt: int = 1
+	counts_reported: bool = field(default=False, repr=False)
+
+	@property
+	def succeeded(self) -> bool:
+		"""Success, and at least one object was sent. A C-MOVE of an object the source
+		does not have also ends with status Success, but with no sub-operations."""
+		return self.status == 0x0000 and (self.completed > 0 or not self.counts_reported)
+
+	@property
+	def not_found(self) -> bool:
+		"""Success without any sub-operations: the source does not have the object"""
+		return self.status == 0x0000 and self.counts_reported and self.completed == 0 and self.failed == 0
+
+	@property
+	def journal_status(self) -> str:
+		if self.succeeded:
+			return "succeeded"
+		return "not_found" if self.not_found else "failed"
+
+	@property
+	def retryable(self) -> bool:
+		return not self.succeeded and not self.not_found
+
+	@property
+	def objects_per_second(self) -> float:
+		return self.completed / self.duration if self.duration else 0.0
+
+	def __str__(self) -> str:
+		status = f"0x{self.status:04X}" if self.status is not None else self.error or "no response"
+		return f"{self.request}: {status}, {self.completed} completed, {self.failed} failed, {self.warning} warning in {self.duration:.1f} s"
+
+def move_identifier(request) -> Dataset:
+	"""C-MOVE identifier of a MoveRequest (see transfer_planner). Several UIDs are
+	sent as a List of UID, which the source must support."""
+
+	ds = Dataset()
+	ds.QueryRetrieveLevel = request.level
+	if request.patient_id:
+		ds.PatientID = request.patient_id
+
+	uid = request.uids if len(request.uids) > 1 else request.uids[0]
+	if request.level == "STUDY":
+		ds.StudyInstanceUID = uid
+	elif request.level == "SERIES":
+		ds.SeriesInstanceUID = uid
+	else:
+		ds.SOPInstanceUID = uid
+
+	return ds
+
+def _report(progress, item) -> None:
+	if progress is None:
+		return
+	if hasattr(progress, "put"):
+		progress.put(item)
+	else:
+		progress(item)
+
+def _update_counts(result: MoveResult, status) -> None:
+	for attr, keyword in (("completed", "NumberOfCompletedSuboperations"),
+			("failed", "NumberOfFailedSuboperations"),
+			("warning", "NumberOfWarningSuboperations")):
+		value = status.get(keyword)
+		if value is not None:
+			setattr(result, attr, int(value))
+			result.counts_reported = True
+
+def c_move(association, identifier, move_aet: str, request=None, progress=None,
+		query_model=PatientRootQueryRetrieveInformationModelMove) -> MoveResult:
+	"""Sends the C-MOVE and consumes its responses. The sub-operation counts of the final
+	response are used if present, otherwise those of the last Pending response."""
+
+	result = MoveResult(request if request is not None else identifier, started=datetime.datetime.now())
+	t0 = time.monotonic()
+
+	responses = association.send_c_move(identifier, move_aet=move_aet, query_model=query_model)
+
+	for status, _ in responses:
+		elapsed = time.monotonic() - t0
+		if result.first_response is None:
+			result.first_response = elapsed
+
+		if not status:
+			result.error = "Connection timed out or aborted"
+			logger.warning(f"C-MOVE {result.request}: {result.error}")
+			continue
+
+		_update_counts(result, status)
+
+		if status.Status in PENDING:
+			result.n_pending += 1
+			_report(progress, MoveProgress(
+				result.request,
+				status.get("NumberOfRemainingSuboperations"),
+				status.get("NumberOfCompletedSuboperations"),
+				status.get("NumberOfFailedSuboperations"),
+				status.get("NumberOfWarningSuboperations"),
+				elapsed,
+			))
+		else:
+			result.status = status.Status
+
+	result.duration = time.monotonic() - t0
+	return result
+
+class MoveExecutor:
+	def __init__(self, peer: str, move_aet: str, max_workers: int = None, progress=None):
+		self.peer = peer
+		self.pool = association_pool.get_pool(peer)
+		self.move_aet = move_aet
+		self.progress = progress
+		# More workers than associations would only wait for the pool
+		self.executor = ThreadPoolExecutor(
+			max_workers=max_workers or self.pool.max_associations,
+			thread_name_prefix=f"move-{peer}",
+		)
+
+	def _run(self, request, identifier, progress) -> MoveResult:
+		n_objects = max(1, getattr(request, "n_objects", 1) or 1)
+
+		try:
+			with transfer_scheduler.slot(self.peer, n_objects), self.pool.association() as assoc:
+				result = c_move(assoc, identifier, self.move_aet, request, progress)
+		except Exception as e:
+			logger.exception(f"C-MOVE {request} to {self.move_aet} failed")
+			return MoveResult(request, started=datetime.datetime.now(), error=str(e))
+
+		# The size of a series is not always known up front, so the sub-operations are charged
+		transfer_scheduler.debit(self.peer, result.completed + result.failed + result.warning - n_objects)
+		return result
+
+	def submit(self, identifier, request=None, progress=None):
+		"""Queues the C-MOVE, returns a Future of the MoveResult"""
+		return self.executor.submit(self._run, request, identifier, progress or self.progress)
+
+	def map(self, items, progress=None) -> list:
+		"""Runs the C-MOVEs of (request, identifier) concurrently, and returns the
+		MoveResults in the same order"""
+		futures = [self.submit(identifier, request, progress) for request, identifier in items]
+		return [future.result() for future in futures]
+
+	def map_retry(self, items, attempts: int = None, progress=None, on_result=None) -> list:
+		"""As map(), but the failed requests are retried up to attempts times
+		(export.retry_attempts) with backoff. on_result(result) is called for every attempt.
+		Returns the result of the last attempt of each request, in order."""
+
+		attempts = attempts or config.export.retry_attempts
+		items = list(items)
+		results = [None] * len(items)
+		pending = list(range(len(items)))
+
+		for attempt in range(1, attempts + 1):
+			for i, result in zip(pending, self.map([items[i] for i in pending], progress)):
+				result.attempt = attempt
+				results[i] = result
+				if on_result:
+					on_result(result)
+
+			pending = [i for i in pending if results[i].retryable]
+			if not pending or attempt == attempts:
+				break
+
+			delay = retry.backoff_delay(attempt)
+			print(f"- {len(pending)} C-MOVEs to {self.move_aet} failed, retrying in {delay:.0f} s ({attempt}/{attempts})")
+			time.sleep(delay)
+
+		return results
+
+	def shutdown(self, wait: bool = True) -> None:
+		self.executor.shutdown(wait=wait)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.shutdown()
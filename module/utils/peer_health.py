@@ -0,0 +1,222 @@
+import datetime
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+from pynetdicom import AE
+from pynetdicom.sop_class import Verification
+from sqlalchemy import create_engine, text
+
+from config import Config
+from module.utils import association_pool
+
+"""
+Health of the configured peers: C-ECHO against every DICOM node and SELECT 1 against every
+SQL database, on a schedule, with rolling latency percentiles.
+
+	monitor = HealthMonitor()
+	monitor.check_all()			# One round, e.g. before a run
+	print(monitor.report())
+	monitor.start()				# Every export.health_interval seconds in the background
+
+A check is "down" after health_failures failures in a row, and "degraded" when the 95th
+percentile of the latency exceeds health_latency_ms. transfer_scheduler asks the monitor
+before every transfer: a down peer is waited for, and a degraded peer gets one transfer
+at a time.
+
+The C-ECHO opens a new association every time, so the latency includes the association
+setup, which is usually what makes a slow ARIA slow.
+"""
+
+config = Config()
+logger = logging.getLogger(__name__)
+
+OK = "ok"
+DEGRADED = "degraded"
+DOWN = "down"
+UNKNOWN = "unknown"
+
+def percentile(values: list, p: float):
+	"""Nearest-rank percentile, None for no values"""
+
+	if not values:
+		return None
+
+	values = sorted(values)
+	rank = max(0, math.ceil(p / 100 * len(values)) - 1)
+	return values[rank]
+
+class Check:
+	def __init__(self, peer: str, kind: str, func, window: int = None):
+		self.peer = peer
+		self.kind = kind
+		self.func = func
+		self.samples = deque(maxlen=window or config.export.health_window) # (dt, latency in ms or None)
+		self.consecutive_failures = 0
+		self.last_error = None
+		self.lock = threading.Lock()
+
+	def run(self) -> None:
+		t0 = time.monotonic()
+		try:
+			self.func()
+		except Exception as e:
+			with self.lock:
+				self.samples.append((datetime.datetime.now(), None))
+				self.consecutive_failures += 1
+				self.last_error = str(e)
+			logger.warning(f"{self.kind} to {self.peer} failed: {e}")
+			return
+
+		latency = (time.monotonic() - t0) * 1000
+		with self.lock:
+			self.samples.append((datetime.datetime.now(), latency))
+			self.consecutive_failures = 0
+			self.last_error = None
+
+	@property
+	def latencies(self) -> list:
+		with self.lock:
+			return [latency for _, latency in self.samples if latency is not None]
+
+	@property
+	def failure_rate(self) -> float:
+		with self.lock:
+			if not self.samples:
+				return 0.0
+			return sum(1 for _, latency in self.samples if latency is None) / len(self.samples)
+
+	@property
+	def last_latency(self):
+		with self.lock:
+			return self.samples[-1][1] if self.samples else None
+
+	@property
+	def state(self) -> str:
+		if not self.samples:
+			return UNKNOWN
+		if self.consecutive_failures >= config.export.health_failures:
+			return DOWN
+
+		p95 = percentile(self.latencies, 95)
+		if self.consecutive_failures or (p95 is not None and p95 > config.export.health_latency_ms):
+			return DEGRADED
+
+		return OK
+
+def echo(peer: str):
+	# Verification only, and outside the pool, so the checks do not show up in its statistics
+	pool = association_pool.get_pool(peer)
+	ae = AE(ae_title=pool.ae_title)
+	ae.add_requested_context(Verification)
+
+	def func():
+		assoc = ae.associate(pool.server, pool.port, ae_title=pool.called_aet)
+		if not assoc.is_established:
+			raise RuntimeError(f"Association to {peer} ({pool.called_aet}) failed")
+		try:
+			status = assoc.send_c_echo()
+			if not status or status.Status != 0x0000:
+				raise RuntimeError(f"C-ECHO status {status.Status if status else 'none'}")
+		finally:
+			assoc.release()
+	return func
+
+def sql_ping(uri: str):
+	engine = create_engine(uri)
+
+	def func():
+		with engine.connect() as connection:
+			connection.execute(text("SELECT 1"))
+	return func
+
+def configured_checks() -> list:
+	"""A C-ECHO for every DICOM node with a server, and a SQL ping for every database"""
+
+	checks = list()
+	peers = (
+		("aria", config.aria, "aria"),
+		("conquest_aria", config.conquest_aria, "conquest_aria"),
+		("conquest_krest", config.conquest_krest, "conquest_krest"),
+		("krest", config.krest, "krest"),
+	)
+
+	for name, pacs, pool_peer in peers:
+		if pacs.dicom.server and pacs.dicom.port:
+			checks.append(Check(name, "C-ECHO", echo(pool_peer)))
+
+		sql = getattr(pacs, "sql", None)
+		if sql and sql.uri:
+			checks.append(Check(name, "SQL", sql_ping(sql.uri)))
+
+	return checks
+
+def required_peers() -> set:
+	"""The peers the configured export path talks to. KREST is only contacted directly
+	when forwarding with C-STORE, otherwise conquest_krest moves the patients to it."""
+
+	peers = {"aria", "conquest_aria", "conquest_krest"}
+	if config.krest.forward_mode == "store":
+		peers.add("krest")
+	return peers
+
+class HealthMonitor:
+	def __init__(self, checks: list = None, interval: int = None):
+		self.checks = checks if checks is not None else configured_checks()
+		self.interval = config.export.health_interval if interval is None else interval
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def check_all(self) -> None:
+		for check in self.checks:
+			check.run()
+
+	def state(self, peer: str) -> str:
+		"""Worst state of the checks of the peer"""
+
+		states = [check.state for check in self.checks if check.peer == peer]
+		for state in (DOWN, DEGRADED, OK):
+			if state in states:
+				return state
+		return UNKNOWN
+
+	def state_for_aet(self, aet: str) -> str:
+		peers = {
+			config.aria.dicom.aet: "aria",
+			config.conquest_aria.dicom.aet: "conquest_aria",
+			config.conquest_krest.dicom.aet: "conquest_krest",
+			config.krest.dicom.aet: "krest",
+		}
+		return self.state(peers[aet]) if aet in peers else UNKNOWN
+
+	def _run(self) -> None:
+		while not self.stopped.wait(self.interval):
+			self.check_all()
+
+	def failing(self, peers=None) -> list:
+		"""The checks whose last run failed, of the given peers if not None"""
+		return [check for check in self.checks if check.consecutive_failures and (peers is None or check.peer in peers)]
+
+	def start(self) -> None:
+		self.thread = threading.Thread(target=self._run, name="peer-health", daemon=True)
+		self.thread.start()
+
+	def stop(self) -> None:
+		self.stopped.set()
+
+	def report(self) -> str:
+		def ms(value):
+			return f"{value:.0f}" if value is not None else "-"
+
+		lines = [f"{'Peer':<16}{'Check':<8}{'State':<10}{'Last ms':>8}{'p50':>8}{'p95':>8}{'p99':>8}{'Failed':>8}  Error"]
+		for check in self.checks:
+			latencies = check.latencies
+			lines.append(
+				f"{check.peer:<16}{check.kind:<8}{check.state:<10}{ms(check.last_latency):>8}"
+				f"{ms(percentile(latencies, 50)):>8}{ms(percentile(latencies, 95)):>8}{ms(percentile(latencies, 99)):>8}"
+				f"{check.failure_rate:>8.0%}  {check.last_error or ''}"
+			)
+
+		return "\n".join(lines)
@@ -0,0 +1,49 @@
+import logging
+import random
+import time
+
+from config import Config
+
+"""
+Retry with exponential backoff and jitter.
+
+The delay before attempt n + 1 is drawn between half and all of
+min(retry_max_delay, retry_base_delay * 2 ** (n - 1)), so the workers that failed
+on the same ARIA hiccup do not all come back at the same moment.
+"""
+
+config = Config()
+logger = logging.getLogger(__name__)
+
+def backoff_delay(attempt: int, base_delay: float = None, max_delay: float = None) -> float:
+	"""Seconds to wait after the failed attempt (1, 2, ...)"""
+
+	base_delay = config.export.retry_base_delay if base_delay is None else base_delay
+	max_delay = config.export.retry_max_delay if max_delay is None else max_delay
+
+	cap = min(max_delay, base_delay * 2 ** (attempt - 1))
+	return cap / 2 + random.uniform(0, cap / 2)
+
+def retry_call(func, attempts: int = None, is_done=None, exceptions=(Exception,), description: str = None):
+	"""Calls func() until it returns a result accepted by is_done (any result if None),
+	at most attempts times. The exception of the last attempt is raised, and the
+	result of the last attempt is returned even if it is not accepted."""
+
+	attempts = attempts or config.export.retry_attempts
+	description = description or getattr(func, "__name__", "call")
+
+	for attempt in range(1, attempts + 1):
+		try:
+			result = func()
+		except exceptions as e:
+			if attempt == attempts:
+				raise
+			logger.warning(f"{description} failed (attempt {attempt}/{attempts}): {e}")
+		else:
+			if is_done is None or is_done(result) or attempt == attempts:
+				return result
+			logger.warning(f"{description} did not succeed (attempt {attempt}/{attempts})")
+
+		delay = backoff_delay(attempt)
+		print(f"- {description} failed, retrying in {delay:.0f} s ({attempt}/{attempts})")
+		time.sleep(delay)
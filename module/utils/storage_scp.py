@@ -0,0 +1,224 @@
+import logging
+import json
+import os
+import shutil
+import threading
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Optional
+
+import pydicom
+from pydicom.uid import UID
+from pynetdicom import AE, evt, StoragePresentationContexts, _config
+from pynetdicom.sop_class import Verification
+
+from config import Config
+from module.Dataclasses.plan_set_dataclass import intern_uid
+from module.utils import transfer_syntax
+
+"""
+Embedded C-STORE SCP that receives the C-MOVE output of ARIA directly, instead of
+going through Conquest (Medfys-1).
+
+The received datasets are streamed to a file by pynetdicom as they come off the network
+(STORE_RECV_CHUNKED_DATASET), without being decoded and encoded again, and the file is
+moved into storage_dir. Every stored file is added to an ArrivalIndex, which the exporter
+uses in place of the Conquest SQL lookups for these objects. An object whose SOP Instance
+UID is not a valid UID is refused, since the UID is used as its file name.
+
+The index is kept in storage_dir/index.jsonl, one line per stored file, so a restart
+only reads the header of the files that are not in it.
+
+	[export.scp]
+	enabled = true
+	aet = "EKSPORT"
+	port = 11112
+	storage_dir = "D:/Brokers/eksportplattform_aria/scp_storage"
+
+ARIA must know the AE title as a move destination.
+"""
+
+config = Config()
+logger = logging.getLogger(__name__)
+
+# Only these are read back from a stored file to index it
+INDEX_TAGS = ["PatientID", "StudyInstanceUID", "SeriesInstanceUID", "Modality"]
+
+INDEX_FILE = "index.jsonl"
+
+@dataclass
+class Arrival:
+	sop_instance_uid: str
+	sop_class_uid: str
+	path: str
+	patient_id: Optional[str] = None
+	study_instance_uid: Optional[str] = None
+	series_instance_uid: Optional[str] = None
+	modality: Optional[str] = None
+
+class ArrivalIndex:
+	"""The objects received by the SCP, by SOP Instance UID and by Series Instance UID"""
+
+	def __init__(self):
+		self.arrivals = dict()
+		self.series = dict()
+		self.lock = threading.Lock()
+
+	def add(self, arrival: Arrival) -> None:
+		with self.lock:
+			self.arrivals[arrival.sop_instance_uid] = arrival
+			if arrival.series_instance_uid:
+				self.series.setdefault(arrival.series_instance_uid, set()).add(arrival.sop_instance_uid)
+
+	def existing_sops(self, uids) -> set:
+		with self.lock:
+			return {uid for uid in uids if uid in self.arrivals}
+
+	def existing_series(self, uids) -> set:
+		with self.lock:
+			return {uid for uid in uids if uid in self.series}
+
+	def files(self, uids) -> dict:
+		"""{SOP Instance UID: path} of the received UIDs, as conquest_db_interface.get_object_files"""
+		with self.lock:
+			return {uid: self.arrivals[uid].path for uid in uids if uid in self.arrivals}
+
+	def series_counts(self, series_uids) -> dict:
+		"""{Series Instance UID: number of received instances} of the received series"""
+		with self.lock:
+			return {uid: len(self.series[uid]) for uid in series_uids if uid in self.series}
+
+	def series_files(self, series_uids) -> dict:
+		"""{SOP Instance UID: path} of all received instances of the series"""
+		with self.lock:
+			return {sop_uid: self.arrivals[sop_uid].path
+				for series_uid in series_uids for sop_uid in self.series.get(series_uid, ())}
+
+	def __len__(self) -> int:
+		return len(self.arrivals)
+
+def read_arrival(path, sop_instance_uid: str = None, sop_class_uid: str = None) -> Arrival:
+	ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=INDEX_TAGS + ["SOPInstanceUID", "SOPClassUID"])
+	return arrival_from_dataset(ds, path, sop_instance_uid, sop_class_uid)
+
+def arrival_from_dataset(ds, path, sop_instance_uid: str = None, sop_class_uid: str = None) -> Arrival:
+	return Arrival(
+		sop_instance_uid=intern_uid(sop_instance_uid or ds.SOPInstanceUID),
+		sop_class_uid=str(sop_class_uid or ds.get("SOPClassUID", "")),
+		path=str(path),
+		patient_id=ds.get("PatientID"),
+		study_instance_uid=intern_uid(ds.get("StudyInstanceUID")),
+		series_instance_uid=intern_uid(ds.get("SeriesInstanceUID")),
+		modality=ds.get("Modality"),
+	)
+
+class StorageSCP:
+	def __init__(self, ae_title: str = None, port: int = None, storage_dir: str = None):
+		self.ae_title = ae_title or config.export.scp.aet
+		self.port = port or config.export.scp.port
+		self.storage_dir = Path(storage_dir or config.export.scp.storage_dir)
+		self.index = ArrivalIndex()
+		self.index_path = self.storage_dir / INDEX_FILE
+		self.index_lock = threading.Lock()
+		self.server = None
+
+		self.storage_dir.mkdir(parents=True, exist_ok=True)
+		self.load()
+
+	def load(self) -> None:
+		"""Indexes the files kept from earlier runs, from the index file. Only the files
+		missing from it are read, and the index is rewritten without the deleted files."""
+
+		indexed = dict()
+		if self.index_path.exists():
+			with open(self.index_path, "r", encoding="utf-8") as input_file:
+				for line in input_file:
+					try:
+						arrival = Arrival(**json.loads(line))
+						for attr in ("sop_instance_uid", "study_instance_uid", "series_instance_uid"):
+							setattr(arrival, attr, intern_uid(getattr(arrival, attr)))
+					except (ValueError, TypeError):
+						# Last line may be cut off by a crash during the write
+						logger.warning(f"Skipping unreadable line in {self.index_path}")
+						continue
+					indexed[Path(arrival.path).name] = arrival
+
+		arrivals = list()
+		for path in self.storage_dir.glob("*.dcm"):
+			arrival = indexed.get(path.name)
+			if arrival is None:
+				try:
+					arrival = read_arrival(path)
+				except Exception as e:
+					logger.warning(f"Cannot index {path}: {e}")
+					continue
+
+			arrival.path = str(path)
+			arrivals.append(arrival)
+
+		with self.index_lock:
+			part_path = self.index_path.with_suffix(".part")
+			with open(part_path, "w", encoding="utf-8") as output_file:
+				for arrival in arrivals:
+					output_file.write(json.dumps(asdict(arrival)) + "\n")
+			os.replace(part_path, self.index_path)
+
+		for arrival in arrivals:
+			self.index.add(arrival)
+
+		print(f"Found {len(self.index)} objects in {self.storage_dir}.")
+
+	def add(self, arrival: Arrival) -> None:
+		with self.index_lock:
+			with open(self.index_path, "a", encoding="utf-8") as output_file:
+				output_file.write(json.dumps(asdict(arrival)) + "\n")
+
+		self.index.add(arrival)
+
+	def handle_store(self, event):
+		sop_instance_uid = event.request.AffectedSOPInstanceUID
+		if not sop_instance_uid or not UID(sop_instance_uid).is_valid:
+			logger.warning(f"Refusing C-STORE with invalid SOP Instance UID {sop_instance_uid!r}")
+			return 0xA900 # Dataset does not match SOP Class
+
+		path = self.storage_dir / f"{sop_instance_uid}.dcm"
+		part_path = path.with_suffix(".part")
+
+		try:
+			# The header is read before the file is moved, the pixel data is deferred
+			arrival = arrival_from_dataset(event.dataset, path, sop_instance_uid, event.request.AffectedSOPClassUID)
+
+			# pynetdicom wrote the file with its file meta information as it was received.
+			# It is only visible under its final name once it is complete
+			shutil.move(event.dataset_path, part_path)
+			os.replace(part_path, path)
+			self.add(arrival)
+		except Exception as e:
+			logger.exception(f"Storing {sop_instance_uid} failed")
+			return 0xA700 # Out of resources
+
+		return 0x0000
+
+	def start(self) -> None:
+		# The datasets are written to a file as they arrive, instead of being held in memory
+		_config.STORE_RECV_CHUNKED_DATASET = True
+
+		ae = AE(ae_title=self.ae_title)
+		# The files are stored as received, so compressed syntaxes cost nothing here
+		transfer_syntaxes = transfer_syntax.preferences(config.export.scp.transfer_syntaxes)
+		for context in StoragePresentationContexts:
+			ae.add_supported_context(context.abstract_syntax, transfer_syntaxes + [
+				ts for ts in context.transfer_syntax if ts not in transfer_syntaxes])
+		ae.add_supported_context(Verification)
+
+		self.server = ae.start_server(
+			("", self.port),
+			block=False,
+			evt_handlers=[(evt.EVT_C_STORE, self.handle_store)],
+		)
+		print(f"Storage SCP {self.ae_title} listening on port {self.port}")
+
+	def shutdown(self) -> None:
+		if self.server:
+			self.server.shutdown()
+			self.server = None
@@ -0,0 +1,145 @@
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+"""
+Planner for the C-MOVE requests against ARIA.
+
+Every C-MOVE against ARIA has a large fixed cost, so the missing objects of a patient
+are grouped, and the cheapest set of requests is chosen:
+
+	STUDY	when at least study_threshold of the objects in the study are missing
+	SERIES	when at least series_threshold of the objects in the series are missing,
+			and for missing CT series
+	IMAGE	for the rest, several SOP Instance UIDs per request if ARIA supports
+			List of UID matching (multi_uid), otherwise one request per UID
+
+The planner only works on an AriaInventory (where the missing objects are and how many
+objects each series holds, from C-FIND), and does not talk to ARIA itself, so the
+decisions can be inspected with TransferPlan.report() before anything is moved.
+Without inventory for an object, the planner falls back to one IMAGE request per UID.
+"""
+
+@dataclass
+class AriaInventory:
+	"""Location of objects in ARIA, from C-FIND"""
+
+	patient_id: Optional[str] = None
+	sop_locations: dict = field(default_factory=dict) # SOP Instance UID: (Study UID, Series UID)
+	series_study: dict = field(default_factory=dict) # Series UID: Study UID
+	series_counts: dict = field(default_factory=dict) # Series UID: NumberOfSeriesRelatedInstances
+
+	def study_count(self, study_uid: str) -> int:
+		return sum(self.series_counts.get(series_uid, 0) for series_uid, study in self.series_study.items() if study == study_uid)
+
+@dataclass
+class MoveRequest:
+	level: str # IMAGE, SERIES or STUDY
+	uids: List[str]
+	n_objects: int
+	reason: str
+	patient_id: Optional[str] = None
+	covers: set = field(default_factory=set, repr=False) # The missing SOP / Series UIDs the request moves
+
+	def __str__(self) -> str:
+		uids = self.uids[0] if len(self.uids) == 1 else f"{self.uids[0]} (+{len(self.uids) - 1})"
+		return f"{self.level:<6} {self.n_objects:>5} objects  {uids}  [{self.reason}]"
+
+@dataclass
+class TransferPlan:
+	patient_ser: object
+	requests: List[MoveRequest] = field(default_factory=list)
+
+	@property
+	def n_requests(self) -> int:
+		return len(self.requests)
+
+	@property
+	def n_objects(self) -> int:
+		return sum(request.n_objects for request in self.requests)
+
+	def report(self) -> str:
+		lines = [f"Patient {self.patient_ser}: {self.n_requests} C-MOVE requests, ~{self.n_objects} objects"]
+		lines += [f"  {request}" for request in self.requests]
+		return "\n".join(lines)
+
+class TransferPlanner:
+	def __init__(self, multi_uid: bool = False, max_uids_per_request: int = 100,
+			series_threshold: float = 0.5, study_threshold: float = 0.8):
+		self.multi_uid = multi_uid
+		self.max_uids_per_request = max_uids_per_request
+		self.series_threshold = series_threshold
+		self.study_threshold = study_threshold
+
+	def plan(self, patient_ser, missing_sops: set = None, missing_series: set = None,
+			inventory: AriaInventory = None) -> TransferPlan:
+
+		inventory = inventory or AriaInventory()
+		missing_sops = set(missing_sops or [])
+		missing_series = set(missing_series or [])
+
+		transfer_plan = TransferPlan(patient_ser)
+
+		# Missing SOPs per series, and SOPs with unknown location
+		series_missing_sops = dict()
+		unlocated = set()
+		for sop_uid in missing_sops:
+			location = inventory.sop_locations.get(sop_uid)
+			if location:
+				series_missing_sops.setdefault(location[1], set()).add(sop_uid)
+			else:
+				unlocated.add(sop_uid)
+
+		# Series level: whole CT series, and series where most of the objects are missing
+		series_requests = {series_uid: "CT series" for series_uid in missing_series}
+		series_covers = {series_uid: {series_uid} for series_uid in missing_series}
+		image_sops = set(unlocated)
+
+		for series_uid, sop_uids in series_missing_sops.items():
+			n_series = inventory.series_counts.get(series_uid)
+			if series_uid in series_requests:
+				continue
+			if n_series and len(sop_uids) / n_series >= self.series_threshold:
+				series_requests[series_uid] = f"{len(sop_uids)}/{n_series} of series missing"
+				series_covers[series_uid] = set(sop_uids)
+			else:
+				image_sops |= sop_uids
+
+		# Study level: replaces the series and image requests of a study
+		study_objects = dict()
+		for series_uid in series_requests:
+			study_uid = inventory.series_study.get(series_uid)
+			if study_uid:
+				study_objects[study_uid] = study_objects.get(study_uid, 0) + inventory.series_counts.get(series_uid, 0)
+		for sop_uid in image_sops:
+			location = inventory.sop_locations.get(sop_uid)
+			if location:
+				study_objects[location[0]] = study_objects.get(location[0], 0) + 1
+
+		studies = set()
+		for study_uid, n_missing in study_objects.items():
+			n_study = inventory.study_count(study_uid)
+			if n_study and n_missing / n_study >= self.study_threshold:
+				studies.add(study_uid)
+				covers = {uid for series_uid, uids in series_covers.items() if inventory.series_study.get(series_uid) == study_uid for uid in uids}
+				covers |= {sop_uid for sop_uid in image_sops if inventory.sop_locations.get(sop_uid, (None,))[0] == study_uid}
+				transfer_plan.requests.append(MoveRequest("STUDY", [study_uid], n_study,
+					f"{n_missing}/{n_study} of study missing", inventory.patient_id, covers))
+
+		for series_uid, reason in series_requests.items():
+			if inventory.series_study.get(series_uid) in studies:
+				continue
+			transfer_plan.requests.append(MoveRequest("SERIES", [series_uid],
+				inventory.series_counts.get(series_uid, 0), reason, inventory.patient_id, series_covers[series_uid]))
+
+		image_sops = sorted(sop_uid for sop_uid in image_sops
+			if inventory.sop_locations.get(sop_uid, (None,))[0] not in studies)
+
+		if self.multi_uid:
+			for i in range(0, len(image_sops), self.max_uids_per_request):
+				chunk = image_sops[i:i + self.max_uids_per_request]
+				transfer_plan.requests.append(MoveRequest("IMAGE", chunk, len(chunk), "UID list", inventory.patient_id, set(chunk)))
+		else:
+			for sop_uid in image_sops:
+				transfer_plan.requests.append(MoveRequest("IMAGE", [sop_uid], 1, "single UID", inventory.patient_id, {sop_uid}))
+
+		return transfer_plan
@@ -0,0 +1,229 @@
+import datetime
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from config import Config
+from module.utils import association_pool, peer_health
+
+"""
+Limits on the transfers per peer, by time of day.
+
+ARIA is shared with the clinic, so the number of concurrent transfers and the number
+of objects per minute can be limited in windows, set per peer under [*.dicom]:
+
+	[[aria.dicom.windows]]			# Daytime: trickle
+	start = 07:00:00
+	end = 17:00:00
+	max_concurrent = 1
+	max_objects_per_minute = 60
+
+	[[aria.dicom.windows]]			# Night: full speed
+	start = 17:00:00
+	end = 07:00:00
+	max_concurrent = 4
+
+Outside all windows, the transfers wait for the next window to open. A peer without
+windows is only limited by max_associations.
+
+	with transfer_scheduler.slot("aria", n_objects):
+		...
+
+The objects per minute are a token bucket with a burst of one minute. A transfer larger
+than the bucket is let through and the following ones wait until the debt is paid,
+so the average rate is kept. A transfer whose size is only known afterwards (a C-MOVE
+of a series or a patient) is charged its estimate up front, and the objects moved beyond
+it with debit(peer, n_objects).
+
+With a peer_health.HealthMonitor set (set_health_monitor), a peer that is down gets no
+new transfers until it answers again, and a degraded peer gets one transfer at a time.
+A transfer that has waited export.health_max_wait seconds for a peer that is down
+raises PeerDownError, so that it is retried or the patient fails and is resumed.
+"""
+
+config = Config()
+logger = logging.getLogger(__name__)
+
+# Seconds between re-evaluations of the window while waiting
+POLL_INTERVAL = 60
+
+class PeerDownError(RuntimeError):
+	pass
+
+def in_window(window, t: datetime.time) -> bool:
+	if window.start == window.end:
+		return True
+	if window.start < window.end:
+		return window.start <= t < window.end
+	# Over midnight
+	return t >= window.start or t < window.end
+
+def seconds_until(t: datetime.time, now: datetime.datetime) -> float:
+	start = datetime.datetime.combine(now.date(), t)
+	if start <= now:
+		start += datetime.timedelta(days=1)
+	return (start - now).total_seconds()
+
+class PeerScheduler:
+	def __init__(self, name: str, windows: list = None, aet: str = None):
+		self.name = name
+		self.aet = aet
+		self.windows = windows or list()
+		self.health = None
+		self.condition = threading.Condition()
+		self.active = 0
+		self.queued = 0
+		self.tokens = None
+		self.last_refill = time.monotonic()
+
+	def window(self, now: datetime.datetime = None):
+		"""The window in effect, None if the peer is closed. Peers without windows are always open."""
+
+		if not self.windows:
+			return True
+
+		t = (now or datetime.datetime.now()).time()
+		for window in self.windows:
+			if in_window(window, t):
+				return window
+
+		return None
+
+	def _refill(self, rate: int) -> None:
+		now = time.monotonic()
+		if self.tokens is None:
+			self.tokens = rate
+		else:
+			self.tokens = min(rate, self.tokens + (now - self.last_refill) * rate / 60)
+		self.last_refill = now
+
+	def _health_wait(self):
+		"""POLL_INTERVAL if the health of the peer holds the transfer back, otherwise 0"""
+
+		if _health_monitor is None or not self.aet:
+			return 0
+
+		health = _health_monitor.state_for_aet(self.aet)
+		if health != self.health:
+			if health in (peer_health.DOWN, peer_health.DEGRADED):
+				print(f"- {self.name} is {health}, transfers are {'held back' if health == peer_health.DOWN else 'throttled to one at a time'}")
+			elif self.health in (peer_health.DOWN, peer_health.DEGRADED):
+				print(f"- {self.name} is {health} again")
+			self.health = health
+
+		if health == peer_health.DOWN:
+			return POLL_INTERVAL
+		if health == peer_health.DEGRADED and self.active >= 1:
+			return POLL_INTERVAL
+
+		return 0
+
+	def _wait_time(self, n_objects: int):
+		"""Seconds to wait before the transfer may start, 0 if it may start now"""
+
+		health_wait = self._health_wait()
+		if health_wait:
+			return health_wait
+
+		now = datetime.datetime.now()
+		window = self.window(now)
+
+		if window is None:
+			return min(seconds_until(w.start, now) for w in self.windows)
+
+		if window is True:
+			return 0
+
+		if window.max_concurrent and self.active >= window.max_concurrent:
+			return POLL_INTERVAL
+
+		if window.max_objects_per_minute:
+			self._refill(window.max_objects_per_minute)
+			if self.tokens < 0:
+				return -self.tokens * 60 / window.max_objects_per_minute
+			self.tokens -= n_objects
+
+		return 0
+
+	def acquire(self, n_objects: int = 1) -> None:
+		with self.condition:
+			self.queued += 1
+			announced = False
+			down_since = None
+			try:
+				while True:
+					wait = self._wait_time(n_objects)
+					if not wait:
+						break
+
+					if self.health != peer_health.DOWN:
+						down_since = None
+					elif down_since is None:
+						down_since = time.monotonic()
+					elif config.export.health_max_wait and time.monotonic() - down_since >= config.export.health_max_wait:
+						raise PeerDownError(f"{self.name} has been down for {config.export.health_max_wait} s")
+
+					if wait > POLL_INTERVAL and not announced:
+						print(f"- Transfers to {self.name} wait {wait / 60:.0f} min for the next window ({self.queued} queued)")
+						announced = True
+					self.condition.wait(timeout=min(wait, POLL_INTERVAL))
+
+				self.active += 1
+			finally:
+				self.queued -= 1
+
+	def release(self) -> None:
+		with self.condition:
+			self.active -= 1
+			self.condition.notify_all()
+
+	def debit(self, n_objects: int) -> None:
+		"""Charges objects transferred beyond the estimate given to acquire"""
+
+		if n_objects <= 0:
+			return
+
+		with self.condition:
+			window = self.window()
+			if window is None or window is True or not window.max_objects_per_minute:
+				return
+
+			self._refill(window.max_objects_per_minute)
+			self.tokens -= n_objects
+
+	@contextmanager
+	def slot(self, n_objects: int = 1):
+		self.acquire(n_objects)
+		try:
+			yield
+		finally:
+			self.release()
+
+_schedulers = dict()
+_schedulers_lock = threading.Lock()
+_health_monitor = None
+
+def set_health_monitor(monitor) -> None:
+	"""Consults monitor (a peer_health.HealthMonitor, None to stop) before every transfer"""
+
+	global _health_monitor
+	_health_monitor = monitor
+
+def get_scheduler(peer: str) -> PeerScheduler:
+	"""Scheduler of the peer. The peers of association_pool that share a node
+	(e.g. conquest_krest and conquest_krest_store) share the scheduler."""
+
+	pacs = association_pool.PEERS[peer][1]()
+	key = pacs.dicom.aet
+
+	with _schedulers_lock:
+		if key not in _schedulers:
+			_schedulers[key] = PeerScheduler(peer, pacs.dicom.windows, key)
+		return _schedulers[key]
+
+def slot(peer: str, n_objects: int = 1):
+	return get_scheduler(peer).slot(n_objects)
+
+def debit(peer: str, n_objects: int) -> None:
+	get_scheduler(peer).debit(n_objects)
@@ -0,0 +1,112 @@
+import logging
+
+import pydicom
+from pydicom import uid as dicom_uid
+from pydicom.filereader import read_file_meta_info
+
+try:
+	from pydicom.pixels import get_encoder
+except ImportError: # pydicom 2
+	from pydicom.encoders import get_encoder
+
+"""
+Transfer syntax preferences for the C-STORE peers.
+
+The syntaxes are set per peer under [*.dicom], by pydicom name or UID, most preferred first:
+
+	transfer_syntaxes = ["JPEGLSLossless", "JPEG2000Lossless", "DeflatedExplicitVRLittleEndian"]
+
+The uncompressed syntaxes are always proposed after them. Each syntax is proposed in its
+own presentation context, so the peer can accept several of them per SOP class.
+prepare_for_store() then picks the first preferred syntax the peer accepted. A file in
+an uncompressed syntax is compressed on the fly (lossless only, with the pydicom encoder
+plugins that are installed); a file that is already compressed is sent as stored.
+
+Note: the C-STORE sub-operations of a C-MOVE are negotiated between the moving node and
+the destination (for Conquest in dicom.ini / acrnema.map), not by the exporter.
+"""
+
+logger = logging.getLogger(__name__)
+
+# {transfer syntax: an encoder plugin is installed}, looked up once per syntax
+_encoder_available = dict()
+
+UNCOMPRESSED = [
+	dicom_uid.ExplicitVRLittleEndian,
+	dicom_uid.ImplicitVRLittleEndian,
+]
+
+def resolve(name: str) -> dicom_uid.UID:
+	"""UID of a transfer syntax given by pydicom name (e.g. JPEGLSLossless) or UID"""
+
+	if name[:1].isdigit():
+		return dicom_uid.UID(name)
+
+	transfer_syntax = getattr(dicom_uid, name, None)
+	if not isinstance(transfer_syntax, dicom_uid.UID):
+		raise ValueError(f"Unknown transfer syntax {name}")
+
+	return transfer_syntax
+
+def preferences(names) -> list:
+	"""The preferred transfer syntaxes, followed by the uncompressed ones"""
+
+	transfer_syntaxes = [resolve(name) for name in names or []]
+	return transfer_syntaxes + [ts for ts in UNCOMPRESSED if ts not in transfer_syntaxes]
+
+def name(transfer_syntax) -> str:
+	return getattr(transfer_syntax, "name", None) or str(transfer_syntax)
+
+def encoder_available(transfer_syntax) -> bool:
+	if transfer_syntax not in _encoder_available:
+		try:
+			_encoder_available[transfer_syntax] = get_encoder(transfer_syntax).is_available
+		except (NotImplementedError, ValueError):
+			_encoder_available[transfer_syntax] = False
+
+		if not _encoder_available[transfer_syntax]:
+			logger.info(f"No encoder installed for {name(transfer_syntax)}, files are sent as stored")
+
+	return _encoder_available[transfer_syntax]
+
+def prepare_for_store(assoc, path, transfer_syntaxes: list):
+	"""The file at path, or a Dataset in the first of transfer_syntaxes that the association
+	accepted for its SOP class. Falls back to the file as stored."""
+
+	accepted = {(str(cx.abstract_syntax), str(cx.transfer_syntax[0])) for cx in assoc.accepted_contexts}
+
+	file_meta = read_file_meta_info(path)
+	sop_class = str(file_meta.MediaStorageSOPClassUID)
+	stored_syntax = dicom_uid.UID(file_meta.TransferSyntaxUID)
+
+	ds = None
+	for transfer_syntax in transfer_syntaxes:
+		if (sop_class, str(transfer_syntax)) not in accepted:
+			continue
+
+		if transfer_syntax == stored_syntax:
+			return path
+
+		# Already compressed files are never decoded and compressed again
+		if stored_syntax.is_compressed:
+			continue
+
+		compress = transfer_syntax.is_compressed and transfer_syntax != dicom_uid.DeflatedExplicitVRLittleEndian
+		if compress and not encoder_available(transfer_syntax):
+			continue
+
+		try:
+			# Read once, for all the syntaxes that are tried
+			if ds is None:
+				ds = pydicom.dcmread(path)
+			if compress:
+				if "PixelData" not in ds:
+					continue
+				ds.compress(transfer_syntax)
+			else:
+				ds.file_meta.TransferSyntaxUID = transfer_syntax
+			return ds
+		except Exception as e:
+			logger.debug(f"Cannot encode {path} as {name(transfer_syntax)}: {e}")
+
+	return path